@@ -0,0 +1,121 @@
+import statistics
+import sys
+import time
+
+from glass_driver import GlassDriver
+from gpio_backend import SimGPIOBackend
+import utils
+
+
+class GlassDriverBench():
+    def __init__(self, cfg_path):
+        self.gpio = SimGPIOBackend()
+        self.driver = GlassDriver(cfg_path, backend=self.gpio)
+        self.ch = self.driver.channels[0]
+
+    def _run(self, n):
+        for _ in range(n):
+            self.driver._process_events()
+            self.driver._cycle()
+
+    def _cmd(self, cmd):
+        self.driver.send(cmd)
+
+    def period_jitter(self, n=500):
+        self._cmd(GlassDriver.CMD_ON)
+        self._run_until(lambda: self.ch.on)
+
+        self.gpio.clear()
+        self._run(n)
+
+        rises = self.gpio.edges(self.ch.A_PIN, self.gpio.HIGH)
+        periods = [(b - a) / 1e6 for a, b in zip(rises, rises[1:])]
+        err = [p - GlassDriver.PERIOD * 1e3 for p in periods]
+
+        print(f"Period: {GlassDriver.PERIOD * 1e3:.3f} ms nominal, "
+              f"mean {statistics.mean(periods):.3f} ms, "
+              f"stdev {statistics.stdev(periods):.3f} ms, "
+              f"p99 error {utils.percentile([abs(e) for e in err], 99):.3f} ms")
+
+    def duty_accuracy(self, dcs=(10, 33, 50, 66, 90), n=200):
+        for dc in dcs:
+            self.ch.target_on = True
+            self.ch.on = True
+            self.ch.DC_ON_L3 = dc
+            self.ch._dc = dc
+
+            self.gpio.clear()
+            self._run(n)
+
+            widths = [w / 1e6 for _, w in self.gpio.pulses(self.ch.A_PIN)]
+            measured = statistics.mean(widths) / (GlassDriver.HALF_PERIOD * 1e3) * 100
+
+            print(f"Duty {dc:5.1f} %: measured {measured:6.2f} % "
+                  f"(pulse stdev {statistics.stdev(widths) * 1e3:.1f} us)")
+
+        self.driver.configure(self.driver.cfg)
+
+    def overlap(self, n=200):
+        # The A and B halves must never be high together, at full duty
+        # least of all; bit-banged and as a hardware waveform.
+        self.ch.target_on = True
+        self.ch.on = True
+        self.ch.DC_ON_L3 = 100
+        self.ch._dc = 100
+
+        self.gpio.clear()
+        self._run(n)
+        n_bitbang = len(self.gpio.overlaps(self.ch.A_PIN, self.ch.B_PIN))
+
+        gpio = SimGPIOBackend(waveform=True)
+        pulse = self.ch.pulse(GlassDriver.HALF_PERIOD)
+        gpio.start_waveform(self.ch.A_PIN, self.ch.B_PIN, GlassDriver.PERIOD, pulse)
+        gpio.stop_waveform(self.ch.A_PIN, self.ch.B_PIN)
+        n_waveform = len(gpio.overlaps(self.ch.A_PIN, self.ch.B_PIN))
+
+        print(f"A/B overlap at 100 % duty: {n_bitbang} bit-banged, {n_waveform} waveform")
+        if n_bitbang or n_waveform:
+            raise Exception("A and B are high at the same time.")
+
+        self.driver.configure(self.driver.cfg)
+
+    def ramp_duration(self):
+        for cmd in (GlassDriver.CMD_OFF, GlassDriver.CMD_ON, GlassDriver.CMD_OFF):
+            self.gpio.clear()
+            start_ns = time.perf_counter_ns()
+            self._cmd(cmd)
+
+            if cmd == GlassDriver.CMD_ON:
+                self._run_until(lambda: self.ch.on)
+            else:
+                self._run_until(lambda: not self.ch.on and self.ch.ramp_start_ts is None)
+
+            pulses = self.gpio.pulses(self.ch.A_PIN)
+            end_ns = pulses[-1][0] if pulses else start_ns
+            print(f"Ramp '{cmd}': {(end_ns - start_ns) / 1e9:.3f} s "
+                  f"({len(pulses)} pulses)")
+
+    def _run_until(self, cond, limit=100000):
+        for _ in range(limit):
+            if cond():
+                return
+            self._run(1)
+        raise Exception("Condition is not reached.")
+
+
+if __name__ == "__main__":
+    try:
+        cfg_path = sys.argv[1]
+    except:
+        print("No path for configuration provided")
+        sys.exit(1)
+
+    bench = GlassDriverBench(cfg_path)
+
+    try:
+        bench.ramp_duration()
+        bench.period_jitter()
+        bench.duty_accuracy()
+        bench.overlap()
+    finally:
+        bench.driver.cleanup()
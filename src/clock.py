@@ -0,0 +1,57 @@
+from datetime import datetime
+import time
+
+
+class Clock():
+    # Time as the system keeps it. Classes deciding on time take a clock,
+    # so that replays can run them on a VirtualClock instead.
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, delay):
+        time.sleep(delay)
+
+
+class VirtualClock(Clock):
+    # Time that moves only when told to: set() to the time of the next
+    # recorded frame, and sleep() returns at once, having moved the clock
+    # by the delay. Monotonic and performance counter times are the same;
+    # wall time follows them from `wall` at `ts`.
+
+    def __init__(self, ts=0.0, wall=0.0):
+        self.ts = ts
+        self._wall_offset = wall - ts
+
+    def monotonic(self):
+        return self.ts
+
+    def perf_counter(self):
+        return self.ts
+
+    def time(self):
+        return self.ts + self._wall_offset
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+    def sleep(self, delay):
+        if delay > 0:
+            self.ts += delay
+
+    def set(self, ts):
+        # Never backwards, as monotonic time.
+        if ts > self.ts:
+            self.ts = ts
+
+
+SYSTEM_CLOCK = Clock()
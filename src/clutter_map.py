@@ -0,0 +1,97 @@
+from array import array
+import math
+
+
+class ClutterMap():
+    # Static clutter over the field of a radar, on a coarse grid. A cell
+    # scores a hit whenever a target in it is reported at exactly the
+    # position of a target of the frame before: reflections off walls and
+    # furniture stay put to the millimetre, people never do. Scores decay
+    # with time constant TAU, lazily when a cell is looked at, so each
+    # lookup costs the same whatever the history. A cell turns to clutter
+    # above CLUTTER_SCORE and back below RELEASE_SCORE; targets in clutter
+    # cells are ignored, targets elsewhere pass.
+
+    # Cell size and field, mm.
+    CELL = 200
+    X_MIN = -6000
+    X_MAX = 6000
+    Y_MAX = 6000
+
+    TAU = 600.0
+
+    # In hits; at 10 frames/s a fixed reflection is clutter in 1.5 s, and
+    # one seen for long is released some 30 min after it has gone.
+    CLUTTER_SCORE = 15.0
+    RELEASE_SCORE = 5.0
+    MAX_SCORE = 100.0
+
+    def __init__(self):
+        self.nx = (self.X_MAX - self.X_MIN) // self.CELL
+        self.ny = self.Y_MAX // self.CELL
+        n = self.nx * self.ny
+
+        self.score = array('d', bytes(8 * n))
+        self.ts = array('d', bytes(8 * n))
+        self.clutter = bytearray(n)
+
+    def cell(self, x, y):
+        # Cell index of a position, -1 outside the grid.
+        ix = (x - self.X_MIN) // self.CELL
+        iy = y // self.CELL
+        if (0 <= ix < self.nx) and (0 <= iy < self.ny):
+            return iy * self.nx + ix
+        return -1
+
+    def _decay(self, i, ts):
+        dt = ts - self.ts[i]
+        if dt > 0:
+            self.score[i] *= math.exp(-dt / self.TAU)
+            self.ts[i] = ts
+        return self.score[i]
+
+    def hit(self, i, ts):
+        if i < 0:
+            return
+        self.score[i] = min(self._decay(i, ts) + 1.0, self.MAX_SCORE)
+
+    def is_clutter(self, i, ts):
+        if i < 0:
+            return False
+
+        score = self._decay(i, ts)
+        if self.clutter[i]:
+            if score < self.RELEASE_SCORE:
+                self.clutter[i] = 0
+        elif score > self.CLUTTER_SCORE:
+            self.clutter[i] = 1
+        return self.clutter[i] == 1
+
+    @property
+    def n_clutter(self):
+        return sum(self.clutter)
+
+    def dump(self, ts):
+        # Scores as of monotonic time `ts`, for saving; cells with next to
+        # nothing are left out. Only reads, so that another thread may dump
+        # while frames come in.
+        cells = {}
+        for i in range(len(self.score)):
+            score = self.score[i] * math.exp(-max(ts - self.ts[i], 0.0) / self.TAU)
+            if score >= 0.1:
+                cells[str(i)] = [round(score, 2), self.clutter[i]]
+        return {'cell': self.CELL, 'cells': cells}
+
+    def load(self, state, ts, age=0.0):
+        # Restores a dump taken `age` seconds ago; a dump of another grid
+        # is ignored.
+        if state.get('cell') != self.CELL:
+            return
+
+        decay = math.exp(-max(age, 0.0) / self.TAU)
+        for i, (score, clutter) in state.get('cells', {}).items():
+            i = int(i)
+            if 0 <= i < len(self.score):
+                self.score[i] = score * decay
+                self.ts[i] = ts
+                self.clutter[i] = clutter
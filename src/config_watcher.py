@@ -0,0 +1,206 @@
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import select
+import struct
+import time
+
+import utils
+
+
+class ConfigWatcher():
+    # inotify(7) constants.
+    IN_NONBLOCK           = 0o4000
+    IN_CLOEXEC            = 0o2000000
+    IN_CLOSE_WRITE        = 0x00000008
+    IN_MOVED_TO           = 0x00000080
+    IN_CREATE             = 0x00000100
+
+    EVENT_HEADER          = struct.Struct("iIII")
+
+    POLL_INTERVAL         = 1.0
+
+    def __init__(self, cfg_path, poll_interval=None):
+        self.cfg_path = Path(cfg_path).absolute()
+
+        if poll_interval is None:
+            poll_interval = self.POLL_INTERVAL
+        self.poll_interval = poll_interval
+
+        self._subscribers = []
+        # Per subscriber, the section as last applied.
+        self._applied = []
+
+        self._fd = None
+        self._init_inotify()
+
+        self.cfg_mtime = self._get_mtime()
+        self._poll_dt = time.monotonic()
+
+        self.cfg = utils.load_json(self.cfg_path)
+
+        # A new config some subscriber failed on, retried once per poll
+        # interval until all of them take it.
+        self._cfg_new = None
+        self._retry_dt = 0.0
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+            # The directory is watched rather than the file itself, since
+            # editors usually replace the file instead of writing into it.
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            wd = libc.inotify_add_watch(fd, bytes(self.cfg_path.parent), mask)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except Exception as e:
+            print(f"Config watcher: inotify is not available, polling instead ({e})")
+            return
+
+        self._fd = fd
+
+    def _get_mtime(self):
+        try:
+            return self.cfg_path.stat().st_mtime
+        except:
+            return None
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def subscribe(self, section, callback, keys=()):
+        # `callback(cfg_section)` is called whenever `section` changes.
+        # A new config missing any of `keys` is rejected as a whole; a
+        # section without required keys is optional and defaults to {}.
+        self._subscribers.append((section, callback, tuple(keys)))
+        self._applied.append(self.cfg.get(section, {}))
+
+    def _changed_inotify(self):
+        changed = False
+        name = os.fsencode(self.cfg_path.name)
+
+        while True:
+            try:
+                buf = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+
+            if not buf:
+                break
+
+            i = 0
+            while i < len(buf):
+                _, _, _, n = self.EVENT_HEADER.unpack_from(buf, i)
+                i += self.EVENT_HEADER.size
+                event_name = buf[i:i+n].rstrip(b"\0")
+                i += n
+
+                if event_name == name:
+                    changed = True
+
+        return changed
+
+    def _changed_polling(self):
+        dt = time.monotonic()
+        if dt - self._poll_dt < self.poll_interval:
+            return False
+        self._poll_dt = dt
+
+        cfg_mtime = self._get_mtime()
+        if cfg_mtime is None or cfg_mtime == self.cfg_mtime:
+            return False
+
+        self.cfg_mtime = cfg_mtime
+        return True
+
+    def _validate(self, cfg):
+        if not isinstance(cfg, dict):
+            raise ValueError("top level must be an object")
+
+        for section, _, keys in self._subscribers:
+            if not keys:
+                continue
+
+            if section not in cfg:
+                raise ValueError(f"no section '{section}'")
+
+            missing = [k for k in keys if k not in cfg[section]]
+            if missing:
+                raise ValueError(f"section '{section}' misses {', '.join(missing)}")
+
+    def check(self):
+        # Non-blocking and cheap enough for a hot loop: with inotify this is
+        # a single failing read, otherwise the file is stat()ed at most once
+        # per poll interval. Returns True if a new config was applied.
+        if self._fd is not None:
+            changed = self._changed_inotify()
+        else:
+            changed = self._changed_polling()
+
+        if changed:
+            try:
+                cfg = utils.load_json(self.cfg_path)
+                self._validate(cfg)
+                self._cfg_new = cfg
+            except Exception as e:
+                # Partially written file or a bad edit: keep running on the
+                # old config, a later write triggers another check.
+                print(f"Config watcher: new config ignored ({e})")
+                return False
+        elif (self._cfg_new is None) or \
+             (time.monotonic() - self._retry_dt < self.poll_interval):
+            return False
+
+        return self._apply()
+
+    def _apply(self):
+        # Calls the subscribers of the sections that differ from what they
+        # last took. One failing does not hold up the others; the config
+        # becomes current once all have it.
+        cfg = self._cfg_new
+        self._retry_dt = time.monotonic()
+
+        failed = False
+        for k, (section, callback, _) in enumerate(self._subscribers):
+            cfg_section = cfg.get(section, {})
+            if cfg_section == self._applied[k]:
+                continue
+
+            try:
+                callback(cfg_section)
+                self._applied[k] = cfg_section
+            except Exception as e:
+                print(f"Config watcher: section '{section}' not applied, retrying ({e})")
+                failed = True
+
+        if failed:
+            return False
+
+        self.cfg = cfg
+        self._cfg_new = None
+        print("Config reloaded")
+        return True
+
+    def wait(self, timeout=None):
+        # Blocks until the config file may have changed or `timeout` passes.
+        if self._fd is not None:
+            r, _, _ = select.select([self._fd], [], [], timeout)
+            return bool(r)
+
+        delay = self.poll_interval - (time.monotonic() - self._poll_dt)
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0:
+            time.sleep(delay)
+        return True
@@ -1,12 +1,21 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import os
 from pathlib import Path
+import selectors
+import signal
 import subprocess
 import sys
+import threading
 import traceback
 
+from clock import SYSTEM_CLOCK
+from config_watcher import ConfigWatcher
 from glass_driver import GlassDriver
 from glass_radar import GlassRadar
-import utils
+from glass_unit import GlassUnit
+import metrics
+from radar_hub import hub_path
+from stats_retention import SESSION_FORMAT, StatsRetention
 
 SCRIPT_DIR = Path(__file__).parent
 
@@ -14,47 +23,107 @@ sys.stdout.reconfigure(line_buffering=True)
 
 
 class Glass():
-    STAT_COLS = [
-        "timestamp",
-
-        "glass_on",
-        "cmd_allowed",
-        "both_present",
-
-        "r1_in_waiting",
-        "r1_stuck",
-        "r1_distance_raw",
-        "r1_distance_reliable",
-        "r1_angle_abs_raw",
-        "r1_angle_abs_reliable",
-        "r1_human_present_reliable",
-
-        "r2_in_waiting",
-        "r2_stuck",
-        "r2_distance_raw",
-        "r2_distance_reliable",
-        "r2_angle_abs_raw",
-        "r2_angle_abs_reliable",
-        "r2_human_present_reliable",
-    ]
-
-    def __init__(self, cfg_path):
+    # A unit taken out of service by a failure is rebuilt after this delay.
+    UNIT_RETRY_DELAY = 10.0
+
+    DRIVER_READY_TIMEOUT = 10.0
+
+    # A dead glass driver is respawned after a delay doubling from the first
+    # to the last while it keeps dying within DRIVER_STABLE_TIME of a start.
+    DRIVER_RESTART_DELAY_MIN = 0.1
+    DRIVER_RESTART_DELAY_MAX = 10.0
+    DRIVER_STABLE_TIME = 30.0
+
+    def __init__(self, cfg_path, clock=None):
+        self.clock = SYSTEM_CLOCK if clock is None else clock
+
+        t0 = self.clock.monotonic()
+
         self.dt = None
 
         self.cfg_path = Path(cfg_path)
-        self.cfg_mtime = self.cfg_path.stat().st_mtime
-
-        self.cfg = utils.load_json(self.cfg_path)
 
-        self.radar_1 = GlassRadar(self.cfg['radar_1'])
-        self.radar_2 = GlassRadar(self.cfg['radar_2'])
+        self.cfg_watcher = ConfigWatcher(self.cfg_path)
+        self.cfg = self.cfg_watcher.cfg
 
-        self.STATE_DELAY = self.cfg['glass_driver']['state_delay']
+        self.units_cfg = self._units_cfg(self.cfg)
 
         self.stat_dir = Path.cwd() / "stats"
         self.stat_dir.mkdir(exist_ok=True)
-
-        self.stat_f = None
+        self.stat_name = None
+        self.retention = None
+
+        # The driver sets up GPIO in its own process while the radars are
+        # configured here; units start in parallel as well.
+        self._glass_driver_lock = threading.Lock()
+        self._glass_driver_ready = threading.Event()
+        self._glass_driver_restart_delay = self.DRIVER_RESTART_DELAY_MIN
+        self._stopping = False
+
+        # Last command per channel (None for all), replayed to a respawned
+        # driver.
+        self.channel_cmds = {}
+
+        self.m_driver_restarts = metrics.REGISTRY.counter(
+            "glass_driver_restarts_total", "Respawns of the glass driver process.")
+        self._start_glass_driver()
+
+        # With a radar hub, the hub owns the devices.
+        for cfg_unit in self.units_cfg.values():
+            for radar_name in cfg_unit['radars']:
+                uartdev = self.cfg[radar_name]['uartdev']
+                if uartdev != "/dev/ttyUSBx" and hub_path(self.cfg) is None:
+                    GlassRadar.reserve_device(uartdev)
+
+        # Unit name -> GlassUnit, or None while the unit is out of service.
+        self.units = {name: None for name in self.units_cfg}
+        self.unit_retry_ts = {}
+        with ThreadPoolExecutor(max_workers=len(self.units_cfg)) as pool:
+            pool.map(self._start_unit, self.units_cfg)
+
+        for name in self.units_cfg:
+            metrics.REGISTRY.gauge_func(
+                "glass_unit_up", "Whether the unit is in service.",
+                lambda name=name: int(self.units.get(name) is not None), unit=name)
+
+        if not self._glass_driver_ready.wait(timeout=self.DRIVER_READY_TIMEOUT):
+            print(f"Glass driver is not ready after {self.DRIVER_READY_TIMEOUT} s")
+
+        n_up = sum(unit is not None for unit in self.units.values())
+        print(f"Controller ready ({self.clock.monotonic() - t0:.2f} s, "
+              f"{n_up} of {len(self.units)} units in service)")
+
+        for name, cfg_unit in self.units_cfg.items():
+            for i, radar_name in enumerate(cfg_unit['radars']):
+                self.cfg_watcher.subscribe(
+                    radar_name,
+                    lambda cfg, name=name, i=i: self._configure_radar(name, i, cfg),
+                    GlassRadar.CFG_KEYS)
+        self.configure_controller(self.cfg.get('controller', {}))
+        self.profile_dump_ts = self.clock.monotonic()
+
+        self.cfg_watcher.subscribe(
+            'glass_driver', self.configure, ['state_delay'])
+        self.cfg_watcher.subscribe(
+            'controller', self.configure_controller)
+        self.cfg_watcher.subscribe(
+            'units', self.configure_units)
+
+    def _units_cfg(self, cfg):
+        # Without 'units' there is a single unit deciding on both radars and
+        # switching all glass channels, as before units existed.
+        default = [{
+            'name': "glass",
+            'radars': ["radar_1", "radar_2"],
+            'policy': GlassUnit.POLICY_ALL}]
+        units = cfg.get('units', default)
+        if not units:
+            raise ValueError("At least one unit must be configured.")
+        return {u['name']: u for u in units}
+
+    def _start_glass_driver(self):
+        self._glass_driver_t0 = self.clock.monotonic()
+        self._glass_driver_ready.clear()
 
         cmd = [
             "python",
@@ -66,156 +135,250 @@ class Glass():
             stdout=subprocess.PIPE,
             text=True)
 
-        self.glass_on = False
-        self.no_cmd_until_dt = datetime.now()
+        thread = threading.Thread(
+            target=self._read_glass_driver, args=(self.glass_driver_proc,), daemon=True)
+        thread.start()
+
+    def _read_glass_driver(self, proc):
+        # Drains the driver output, so that it never blocks on a full pipe,
+        # watches for its readiness and respawns it once it exits.
+        for line in proc.stdout:
+            line = line.rstrip()
+            if line == GlassDriver.READY_TEXT:
+                dt = self.clock.monotonic() - self._glass_driver_t0
+                print(f"Glass driver ready ({dt:.2f} s)")
+                self._glass_driver_ready.set()
+            else:
+                print(f"[driver] {line}")
+
+        code = proc.wait()
+
+        # A respawned driver gets new pipes; the old ones would stay open
+        # until garbage collection otherwise.
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except:
+                pass
+
+        if self._stopping:
+            return
+
+        self._restart_glass_driver(code)
+
+    def _restart_glass_driver(self, code):
+        if self.clock.monotonic() - self._glass_driver_t0 > self.DRIVER_STABLE_TIME:
+            self._glass_driver_restart_delay = self.DRIVER_RESTART_DELAY_MIN
+        delay = self._glass_driver_restart_delay
+        self._glass_driver_restart_delay = min(2 * delay, self.DRIVER_RESTART_DELAY_MAX)
+
+        print(f"{self.clock.now()}: glass driver stopped (its returncode is {code}), "
+              f"restarting in {delay:.1f} s")
+        self.clock.sleep(delay)
+
+        # Commands wait on the lock until the new driver has the last state.
+        with self._glass_driver_lock:
+            self._start_glass_driver()
+
+            for channel, cmd in self.channel_cmds.items():
+                self._write_cmd(cmd, channel)
+        self.m_driver_restarts.inc()
+
+    def _start_unit(self, name):
+        t0 = self.clock.monotonic()
 
-    def cleanup(self):
         try:
-            self.stat_f.close()
+            unit = GlassUnit(name, self.units_cfg[name], self.cfg_watcher.cfg, self.send_cmd, self.clock)
+        except Exception as e:
+            text = f"{self.clock.now()}: failed to start unit '{name}' ({e})"
+            print(text)
+            self.units[name] = None
+            self.unit_retry_ts[name] = self.clock.monotonic()
+            return
+
+        if self.stat_name is not None:
+            unit.open_stats(self.stat_dir, self.stat_name)
+
+        self.units[name] = unit
+        print(f"Unit '{name}' started ({self.clock.monotonic() - t0:.2f} s)")
+
+    def _stop_unit(self, name, unit, e):
+        text = f"{self.clock.now()}: unit '{name}' is out of service ({e})"
+        print(text)
+
+        self.units[name] = None
+        self.unit_retry_ts[name] = self.clock.monotonic()
+
+        try:
+            self.send_cmd(GlassDriver.CMD_OFF, unit.CHANNEL)
         except:
             pass
 
-    def check_config(self):
+        unit.cleanup()
+
+    def cleanup(self):
+        self._stopping = True
+
+        self.cfg_watcher.close()
+
+        if self.retention is not None:
+            self.retention.stop()
+
+        for unit in self.units.values():
+            if unit is not None:
+                unit.cleanup()
+
+    def configure(self, cfg):
+        for unit in self.units.values():
+            if unit is not None:
+                unit.configure(cfg)
+
+    def configure_controller(self, cfg):
+        self.PROFILE_DUMP_INTERVAL = (cfg.get('profile') or {}).get('dump_interval')
+
+        for unit in self.units.values():
+            if unit is not None:
+                unit.configure_controller(cfg)
+
+    def dump_profiles(self, *args):
+        # Also the SIGUSR1 handler.
+        for unit in self.units.values():
+            if (unit is not None) and (unit.prof is not None):
+                unit.prof.dump()
+
+    def configure_units(self, cfg):
+        print("Unit changes are applied on next start")
+
+    def _configure_radar(self, name, i, cfg):
+        unit = self.units.get(name)
+        if unit is not None:
+            unit.post_radar_config(i, cfg)
+
+    def send_cmd(self, cmd, channel=None, origin_ts=None):
+        # `origin_ts` is the monotonic time of the radar frame behind the
+        # command; the driver measures the latency up to full duty from it.
+        with self._glass_driver_lock:
+            if channel is None:
+                self.channel_cmds.clear()
+            self.channel_cmds.pop(channel, None)
+            self.channel_cmds[channel] = cmd
+
+            self._write_cmd(cmd, channel, origin_ts)
+
+    def _write_cmd(self, cmd, channel, origin_ts=None):
+        line = cmd
+        if channel is not None:
+            line += f" {channel}"
+        if origin_ts is not None:
+            line += f" origin={origin_ts:.6f}"
+        line += f" sent={self.clock.monotonic():.6f}\n"
+
+        # A dead driver gets the command on respawn.
         try:
-            cfg_mtime = self.cfg_path.stat().st_mtime
-        except:
-            return
+            self.glass_driver_proc.stdin.write(line)
+            self.glass_driver_proc.stdin.flush()
+        except (OSError, ValueError):
+            print(f"{self.clock.now()}: glass driver is down, '{line.strip()}' is sent on restart")
 
-        if cfg_mtime != self.cfg_mtime:
-            text = f"{self.dt}: exiting due to config file change"
-            print(text)
-            sys.exit(1)
+    def _run_worker(self, names):
+        # Runs the pipelines of a group of units: waits until any of their
+        # radars has bytes and lets each unit handle its ready radars.
+        selector = selectors.DefaultSelector()
+        registered = {}
 
-    def process(self):
-        self.dt = datetime.now()
+        while True:
+            # Re-registers a unit that was replaced or taken out of service,
+            # or whose radars were reconnected.
+            timeout = GlassUnit.FRAME_TIMEOUT
+            for name in names:
+                unit = self.units.get(name)
+                fds = () if unit is None else unit.fds()
+                if unit is not None:
+                    timeout = min(timeout, unit.select_timeout())
 
-        self.check_config()
+                if registered.get(name, (None, ())) == (unit, fds):
+                    continue
 
-        f1 = self.radar_1.process()
-        f2 = self.radar_2.process()
+                for fd, _, _ in registered.get(name, (None, ()))[1]:
+                    selector.unregister(fd)
 
-        if (not f1) and (self.radar_1.n_frame_failures >= self.radar_1.MAX_FRAME_FAILURES):
-            text = f"{self.dt}: exiting due to radar 1 failures"
-            print(text)
-            sys.exit(1)
+                for fd, i, _ in fds:
+                    selector.register(fd, selectors.EVENT_READ, (name, i))
 
-        if (not f2) and (self.radar_2.n_frame_failures >= self.radar_2.MAX_FRAME_FAILURES):
-            text = f"{self.dt}: exiting due to radar 2 failures"
-            print(text)
-            sys.exit(1)
+                registered[name] = (unit, fds)
 
-        if self.glass_driver_proc.poll():
-            code = self.glass_driver_proc.returncode
-            text = f"{self.dt}: exiting due to glass driver stop (its returncode is {code})"
-            print(text)
-            sys.exit(1)
+            events = selector.select(timeout=timeout)
 
-        if (not f1) or (not f2):
-            return
+            ready = {}
+            for key, _ in events:
+                name, i = key.data
+                ready.setdefault(name, set()).add(i)
 
-        # Uncomment to always enable according side(s).
-        #self.radar_1.human_present_reliable = True
-        #self.radar_2.human_present_reliable = True
+            for name in names:
+                unit, fds = registered[name]
+                if unit is None:
+                    continue
 
-        cmd_allowed = self.dt > self.no_cmd_until_dt
-        both_present = self.radar_1.human_present_reliable and \
-                       self.radar_2.human_present_reliable
+                try:
+                    unit.process(ready.get(name, ()))
+                except Exception as e:
+                    traceback.print_exc()
 
-        cmd = None
-        if cmd_allowed:
-            if (not self.glass_on) and both_present:
-                cmd = GlassDriver.CMD_ON
-            elif self.glass_on and (not both_present):
-                cmd = GlassDriver.CMD_OFF
+                    for fd, _, _ in fds:
+                        selector.unregister(fd)
+                    registered[name] = (None, ())
 
-        if cmd is not None:
-            self.glass_driver_proc.stdin.write(f"{cmd}\n")
-            self.glass_driver_proc.stdin.flush()
+                    self._stop_unit(name, unit, e)
 
-            if cmd == GlassDriver.CMD_ON:
-                self.glass_on = True
-            elif cmd == GlassDriver.CMD_OFF:
-                self.glass_on = False
-
-            self.no_cmd_until_dt = self.dt + timedelta(seconds=self.STATE_DELAY)
-
-        if self.radar_1.distance_raw is None:
-            d1_raw_text = "-----"
-        else:
-            d1_raw_text = f"{self.radar_1.distance_raw:5.0f}"
-
-        if self.radar_1.angle_abs_raw is None:
-            a1_raw_text = "-----"
-        else:
-            a1_raw_text = f"{self.radar_1.angle_abs_raw:5.0f}"
-
-        if self.radar_2.distance_raw is None:
-            d2_raw_text = "-----"
-        else:
-            d2_raw_text = f"{self.radar_2.distance_raw:5.0f}"
-
-        if self.radar_2.angle_abs_raw is None:
-            a2_raw_text = "-----"
-        else:
-            a2_raw_text = f"{self.radar_2.angle_abs_raw:5.0f}"
-
-        text =   f"Glass: {' ON' if self.glass_on else 'OFF'}"
-        text +=  f"\nCMD allowed: {cmd_allowed}"
-        text +=  f"\nBoth present: {both_present}"
-        text += (f"\n[1] {self.radar_1.in_waiting:4} | "
-                 f"{'stuck' if self.radar_1.stuck else '-----'} | "
-                 f"{d1_raw_text} / {self.radar_1.distance_reliable:5.0f} | "
-                 f"{a1_raw_text} / {self.radar_1.angle_abs_reliable:5.0f} | "
-                 f"{self.radar_1.human_present_reliable}")
-        text += (f"\n[2] {self.radar_2.in_waiting:4} | "
-                 f"{'stuck' if self.radar_2.stuck else '-----'} | "
-                 f"{d2_raw_text} / {self.radar_2.distance_reliable:5.0f} | "
-                 f"{a2_raw_text} / {self.radar_2.angle_abs_reliable:5.0f} | "
-                 f"{self.radar_2.human_present_reliable}")
-
-        #if cmd == GlassDriver.CMD_ON:
-        #    text += (f"\n================================="
-        #             f"\n=====           ON          ====="
-        #             f"\n=================================")
-        #elif cmd == GlassDriver.CMD_OFF:
-        #    text += (f"\n================================="
-        #             f"\n=====          OFF          ====="
-        #             f"\n=================================")
-
-        text += "\n"
-        print(text)
+    def process(self):
+        self.cfg_watcher.wait(timeout=1.0)
 
-        stat = (f"{self.dt},"
+        self.dt = self.clock.now()
+        ts = self.clock.monotonic()
 
-                f"{self.glass_on},"
-                f"{cmd_allowed},"
-                f"{both_present},"
+        self.cfg_watcher.check()
 
-                f"{self.radar_1.in_waiting},"
-                f"{self.radar_1.stuck},"
-                f"{self.radar_1.distance_raw},"
-                f"{self.radar_1.distance_reliable},"
-                f"{self.radar_1.angle_abs_raw},"
-                f"{self.radar_1.angle_abs_reliable},"
-                f"{self.radar_1.human_present_reliable},"
+        for name, unit in self.units.items():
+            if unit is not None:
+                continue
 
-                f"{self.radar_2.in_waiting},"
-                f"{self.radar_2.stuck},"
-                f"{self.radar_2.distance_raw},"
-                f"{self.radar_2.distance_reliable},"
-                f"{self.radar_2.angle_abs_raw},"
-                f"{self.radar_2.angle_abs_reliable},"
-                f"{self.radar_2.human_present_reliable}")
+            if ts - self.unit_retry_ts[name] > self.UNIT_RETRY_DELAY:
+                self._start_unit(name)
 
-        self.stat_f.write(f"{stat}\n")
+        for unit in self.units.values():
+            if unit is not None:
+                unit.maintain()
 
-    def start(self):
-        stat_name = datetime.now().strftime("%Y%m%dT%H%M%S")
-        stat_path = self.stat_dir / f"{stat_name}.csv"
-        self.stat_f = stat_path.open("a")
+        if (self.PROFILE_DUMP_INTERVAL is not None) and \
+           ts - self.profile_dump_ts > self.PROFILE_DUMP_INTERVAL:
+            self.profile_dump_ts = ts
+            self.dump_profiles()
 
-        cols = ",".join(self.STAT_COLS)
-        self.stat_f.write(f"{cols}\n")
+    def start(self):
+        metrics.serve(self.cfg.get('controller', {}).get('metrics'))
+
+        signal.signal(signal.SIGUSR1, self.dump_profiles)
+
+        self.stat_name = self.clock.now().strftime(SESSION_FORMAT)
+        for unit in self.units.values():
+            if unit is not None:
+                unit.open_stats(self.stat_dir, self.stat_name)
+
+        # Older sessions are compressed and pruned in the background.
+        cfg_retention = self.cfg.get('stats_retention')
+        if cfg_retention is not None:
+            self.retention = StatsRetention(self.stat_dir, cfg_retention, self.stat_name)
+            self.cfg_watcher.subscribe('stats_retention', self.retention.configure)
+            self.retention.start()
+
+        # Units are spread over one worker thread per core at most; each
+        # worker multiplexes the radars of its units.
+        names = list(self.units)
+        n_workers = max(1, min(len(names), os.cpu_count() or 1))
+        for k in range(n_workers):
+            worker = threading.Thread(
+                target=self._run_worker, args=(names[k::n_workers],), daemon=True)
+            worker.start()
 
         while True:
             self.process()
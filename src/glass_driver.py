@@ -1,21 +1,167 @@
-from datetime import datetime
-import math
-from pathlib import Path
+import queue
 import sys
 import threading
-import time
 import traceback
 
-import RPi.GPIO as GPIO
-GPIO.setmode(GPIO.BCM)
+from clock import SYSTEM_CLOCK
+from config_watcher import ConfigWatcher
+import gpio_backend
+import metrics
+
+
+class GlassChannel():
+    DC_KEYS = (
+        "dc_off_l1",
+        "dc_off_l2",
+        "dc_off_l3",
+        "dc_off_d1",
+        "dc_off_d2",
+        "dc_off_d3",
+        "dc_on_l1",
+        "dc_on_l2",
+        "dc_on_l3",
+        "dc_on_d1",
+        "dc_on_d2",
+        "dc_on_d3",
+    )
+
+    def __init__(self, index, cfg, cfg_default, clock=None):
+        self.index = index
+        self.clock = SYSTEM_CLOCK if clock is None else clock
+
+        self.ENABLE_PIN = cfg['enable_pin']
+        self.A_PIN = cfg['a_pin']
+        self.B_PIN = cfg['b_pin']
+
+        self.configure(cfg, cfg_default)
 
-import utils
+        self._dc_prev = None
+        self._dc = self.DC_OFF_L3
+
+        self.target_on = False
+        self.on = False
+
+        # Monotonic times of the ramp start and of the radar frame that led
+        # to the command, if the controller sent it.
+        self.ramp_start_ts = None
+        self.origin_ts = None
+        self.ramp_done_ts = None
+
+        # Set while the backend drives the channel on its own.
+        self.waveform = False
+
+        self.m_ramp = metrics.REGISTRY.histogram(
+            "glass_ramp_seconds", "Duration of glass on/off ramps.",
+            buckets=(0.25, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0),
+            channel=str(index))
+        self.m_total = metrics.REGISTRY.histogram(
+            "glass_toggle_latency_seconds", "Toggle latency stages, from the radar frame to full duty.",
+            stage="total", channel=str(index))
+
+    def configure(self, cfg, cfg_default):
+        # Duty levels and steps may be overridden per channel, otherwise
+        # the ones of the 'glass_driver' section apply.
+        dc = {k: cfg.get(k, cfg_default[k]) for k in self.DC_KEYS}
+
+        self.DC_OFF_L1 = dc['dc_off_l1']
+        self.DC_OFF_L2 = dc['dc_off_l2']
+        self.DC_OFF_L3 = dc['dc_off_l3']
+        self.DC_OFF_D1 = dc['dc_off_d1']
+        self.DC_OFF_D2 = dc['dc_off_d2']
+        self.DC_OFF_D3 = dc['dc_off_d3']
+
+        self.DC_ON_L1  = dc['dc_on_l1']
+        self.DC_ON_L2  = dc['dc_on_l2']
+        self.DC_ON_L3  = dc['dc_on_l3']
+        self.DC_ON_D1  = dc['dc_on_d1']
+        self.DC_ON_D2  = dc['dc_on_d2']
+        self.DC_ON_D3  = dc['dc_on_d3']
+
+    def pins(self):
+        return (self.ENABLE_PIN, self.A_PIN, self.B_PIN)
+
+    def set_target(self, on, ts, origin_ts=None):
+        if on == self.target_on:
+            return
+
+        self.target_on = on
+        self.ramp_start_ts = ts
+        self.origin_ts = origin_ts
+
+    def _dc_up(self):
+        if self._dc < self.DC_ON_L1:
+            d = self.DC_ON_D1
+        elif self._dc < self.DC_ON_L2:
+            d = self.DC_ON_D2
+        else:
+            d = self.DC_ON_D3
+
+        self._dc += d
+        if self._dc > self.DC_ON_L3:
+            self._dc = self.DC_ON_L3
+
+    def _dc_down(self):
+        if self._dc > self.DC_OFF_L1:
+            d = self.DC_OFF_D1
+        elif self._dc > self.DC_OFF_L2:
+            d = self.DC_OFF_D2
+        else:
+            d = self.DC_OFF_D3
+
+        self._dc -= d
+        if self._dc < self.DC_OFF_L3:
+            self._dc = self.DC_OFF_L3
+
+    def step(self):
+        # Advances the ramp by one drive cycle.
+        self._dc_prev = self._dc
+
+        if self.target_on:
+            if self._dc < self.DC_ON_L3:
+                self._dc_up()
+            elif self.ramp_start_ts is not None:
+                self.on = True
+                self._ramp_done()
+        else:
+            if self._dc > self.DC_OFF_L3:
+                self._dc_down()
+            elif self.ramp_start_ts is not None:
+                self.on = False
+                self._ramp_done()
+
+    def _ramp_done(self):
+        ts = self.clock.monotonic()
+        self.ramp_done_ts = ts
+
+        ramp = ts - self.ramp_start_ts
+        self.m_ramp.observe(ramp)
+        text = f"Glass {self.index} is {'ON' if self.on else 'OFF'} (ramp {ramp:.3f} s"
+
+        if self.origin_ts is not None:
+            total = ts - self.origin_ts
+            self.m_total.observe(total)
+            text += f", {total:.3f} s from radar frame"
+
+        print(f"{text})")
+
+        self.ramp_start_ts = None
+        self.origin_ts = None
+
+    def steady(self):
+        return self.ramp_start_ts is None
+
+    def pulse(self, half_period):
+        pulse = half_period * self._dc / 100
+        return max(0., min(half_period, pulse))
 
 
 class GlassDriver():
     CMD_OFF               = "off"
     CMD_ON                = "on"
 
+    # Printed once GPIO is set up; the controller waits for it.
+    READY_TEXT            = "Glass driver ready"
+
     FREQ                  = 111
     PERIOD                = 1 / FREQ
     HALF_PERIOD           = PERIOD / 2
@@ -24,183 +170,316 @@ class GlassDriver():
     A_PIN                 = 5
     B_PIN                 = 6
 
-    def __init__(self, cfg_path):
-        self._setup()
+    CFG_KEYS = GlassChannel.DC_KEYS + ("verbose",)
 
-        self.cfg_path = Path(cfg_path)
-        self.cfg_mtime = self.cfg_path.stat().st_mtime
+    EVENT_CMD             = "cmd"
+    EVENT_CONFIG          = "config"
 
-        self.cfg = None
-        self.configure()
+    def __init__(self, cfg_path, backend=None, clock=None):
+        self.clock = SYSTEM_CLOCK if clock is None else clock
 
-        self._dc_prev = None
-        self._dc = self.DC_OFF_L3
+        self._events = queue.Queue()
 
-        self._cmd = None
+        # Config changes are picked up by a watcher thread and applied by the
+        # drive loop, which may be blocked on the event queue while idle.
+        self.cfg_watcher = ConfigWatcher(cfg_path)
+        self.cfg_watcher.subscribe(
+            'glass_driver',
+            lambda cfg: self._events.put((self.EVENT_CONFIG, cfg)),
+            self.CFG_KEYS)
 
-        self.on = False
+        self.cfg = None
+        self.channels = []
+        self.configure(self.cfg_watcher.cfg['glass_driver'])
 
-    def _setup(self):
-        GPIO.setup(self.ENABLE_PIN, GPIO.OUT)
-        GPIO.output(self.ENABLE_PIN, GPIO.HIGH)
+        if backend is None:
+            backend = gpio_backend.get_backend(self.cfg.get('gpio_backend', "rpi"))
+        self.gpio = backend
+
+        self._setup()
 
-        GPIO.setup(self.A_PIN, GPIO.OUT)
-        GPIO.output(self.A_PIN, GPIO.LOW)
+        self._idle = False
+
+        self.m_ipc = metrics.REGISTRY.histogram(
+            "glass_toggle_latency_seconds", "Toggle latency stages, from the radar frame to full duty.",
+            stage="ipc")
+
+        self.m_jitter = metrics.REGISTRY.histogram(
+            "glass_drive_lateness_seconds", "Lateness of half period deadlines in the drive loop.",
+            buckets=(0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01))
+        metrics.REGISTRY.gauge_func(
+            "glass_driver_idle", "Whether the drive loop is blocked with no pin to toggle.",
+            lambda: int(self._idle))
+
+        self._schedule = None
+        self._schedule_key = None
+        self._period_dt = None
+
+    def _channels_cfg(self, cfg):
+        # Without 'channels' a single pane is driven on the default pins.
+        default = [{
+            'enable_pin': self.ENABLE_PIN,
+            'a_pin': self.A_PIN,
+            'b_pin': self.B_PIN}]
+        channels_cfg = cfg.get('channels', default)
+
+        # The config watcher checks the section keys only.
+        if not isinstance(channels_cfg, list) or not channels_cfg:
+            raise ValueError("'channels' must be a non-empty list")
+        for i, c in enumerate(channels_cfg):
+            if not isinstance(c, dict):
+                raise ValueError(f"channel {i} must be an object")
+            missing = [k for k in ('enable_pin', 'a_pin', 'b_pin') if k not in c]
+            if missing:
+                raise ValueError(f"channel {i} misses {', '.join(missing)}")
+        return channels_cfg
 
-        GPIO.setup(self.B_PIN, GPIO.OUT)
-        GPIO.output(self.B_PIN, GPIO.LOW)
+    def _setup(self):
+        for ch in self.channels:
+            self.gpio.setup_output(ch.ENABLE_PIN, self.gpio.HIGH)
+            self.gpio.setup_output(ch.A_PIN, self.gpio.LOW)
+            self.gpio.setup_output(ch.B_PIN, self.gpio.LOW)
 
     def cleanup(self):
-        GPIO.cleanup()
-
-    def configure(self):
-        cfg = utils.load_json(self.cfg_path)
-        self.cfg = cfg['glass_driver']
-
-        self.DC_OFF_L1 = self.cfg['dc_off_l1']
-        self.DC_OFF_L2 = self.cfg['dc_off_l2']
-        self.DC_OFF_L3 = self.cfg['dc_off_l3']
-        self.DC_OFF_D1 = self.cfg['dc_off_d1']
-        self.DC_OFF_D2 = self.cfg['dc_off_d2']
-        self.DC_OFF_D3 = self.cfg['dc_off_d3']
-
-        self.DC_ON_L1  = self.cfg['dc_on_l1']
-        self.DC_ON_L2  = self.cfg['dc_on_l2']
-        self.DC_ON_L3  = self.cfg['dc_on_l3']
-        self.DC_ON_D1  = self.cfg['dc_on_d1']
-        self.DC_ON_D2  = self.cfg['dc_on_d2']
-        self.DC_ON_D3  = self.cfg['dc_on_d3']
-
-        self.VERBOSE   = self.cfg['verbose']
+        self.cfg_watcher.close()
+        self.gpio.cleanup()
 
-    def check_config(self):
+    def configure(self, cfg):
+        # Fatal on start only; a bad edit keeps the running channels.
         try:
-            cfg_mtime = self.cfg_path.stat().st_mtime
-        except:
+            channels_cfg = self._channels_cfg(cfg)
+        except ValueError as e:
+            if not self.channels:
+                raise
+            print(f"Glass driver config not applied ({e})")
             return
 
-        if cfg_mtime != self.cfg_mtime:
-            self.configure()
-            self.cfg_mtime = cfg_mtime
-            print("Config reloaded")
+        self.cfg = cfg
+
+        # Hardware waveforms are restarted with the new duty levels.
+        for ch in self.channels:
+            self._stop_waveform(ch)
+
+        if not self.channels:
+            self.channels = [
+                GlassChannel(i, c, cfg, self.clock) for i, c in enumerate(channels_cfg)]
+        else:
+            pins = [(c['enable_pin'], c['a_pin'], c['b_pin']) for c in channels_cfg]
+            if pins != [ch.pins() for ch in self.channels]:
+                print("Glass channel pin changes are applied on next start")
+
+            for ch, c in zip(self.channels, channels_cfg):
+                ch.configure(c, cfg)
+
+        self.VERBOSE   = self.cfg['verbose']
 
     def start(self):
+        metrics.serve(self.cfg.get('metrics'))
+
         self._read_cmd_thread = threading.Thread(target=self._read_cmd, daemon=True)
         self._read_cmd_thread.start()
 
+        self._watch_config_thread = threading.Thread(target=self._watch_config, daemon=True)
+        self._watch_config_thread.start()
+
         while True:
-            self.check_config()
-
-            if self._cmd == self.CMD_ON:
-                self._turn_on()
-                self._cmd = None
-            elif self._cmd == self.CMD_OFF:
-                self._turn_off()
-                self._cmd = None
+            if self._check_idle():
+                self._process_events(block=True)
             else:
+                self._process_events()
                 self._cycle()
 
-    def _read_cmd(self):
+    def send(self, cmd, index=None, origin_ts=None):
+        trace = {} if origin_ts is None else {'origin': origin_ts}
+        self._events.put((self.EVENT_CMD, (cmd, index, self.clock.monotonic(), trace)))
+
+    def run_until(self, ts):
+        # The drive loop without blocking, up to monotonic time `ts` or
+        # until idle, for replays on a virtual clock.
+        self._process_events()
+        while (self.clock.monotonic() < ts) and (not self._check_idle()):
+            self._cycle()
+            self._process_events()
+
+    def _watch_config(self):
         while True:
-            if self._cmd is not None:
-                time.sleep(0.5)
+            self.cfg_watcher.wait()
+            self.cfg_watcher.check()
+
+    def _start_waveform(self, ch):
+        pulse = ch.pulse(self.HALF_PERIOD)
+        ch.waveform = self.gpio.start_waveform(ch.A_PIN, ch.B_PIN, self.PERIOD, pulse)
+        return ch.waveform
+
+    def _stop_waveform(self, ch):
+        if ch.waveform:
+            self.gpio.stop_waveform(ch.A_PIN, ch.B_PIN)
+            ch.waveform = False
+
+    def _check_idle(self):
+        # Idle when no channel is ramping and every channel is either fully
+        # off or handed over to a backend waveform: no pin needs to toggle
+        # from here, so the loop may block until the next event.
+        for ch in self.channels:
+            if ch.waveform:
                 continue
 
-            line = sys.stdin.readline()
-            line = line.strip().lower()
+            if not ch.steady():
+                break
 
-            if line == self.CMD_ON:
-                self._cmd = self.CMD_ON
-            elif line == self.CMD_OFF:
-                self._cmd = self.CMD_OFF
+            if ch.pulse(self.HALF_PERIOD) > 0 and not self._start_waveform(ch):
+                break
+        else:
+            if not self._idle:
+                self._idle = True
+                if self.VERBOSE:
+                    print("Glass driver is idle")
+            return True
+
+        self._idle = False
+        return False
+
+    def _parse_cmd(self, line):
+        # Commands are "<on|off>" for all channels or "<on|off> <index>",
+        # optionally followed by "origin=<ts>" and "sent=<ts>": monotonic
+        # times of the radar frame behind the command and of its sending.
+        parts = line.strip().lower().split()
+        if not parts or parts[0] not in (self.CMD_ON, self.CMD_OFF):
+            return
 
-    def _cycle(self):
-        pulse = self.HALF_PERIOD * self._dc / 100
-        if pulse < 0:
-            pulse = 0.
+        cmd = parts.pop(0)
 
-        f = pulse > 0
+        trace = {}
+        while parts and "=" in parts[-1]:
+            key, _, value = parts.pop().partition("=")
+            try:
+                trace[key] = float(value)
+            except ValueError:
+                return
 
-        pause = self.HALF_PERIOD  - pulse
-        if pause < 0:
-            pause = 0.
+        if not parts:
+            return (cmd, None, trace)
 
-        match self.VERBOSE:
-            case 1:
-                if self._dc != self._dc_prev:
-                    print(f"{self._dc:6.2f}")
-            case 2:
-                print(f"{self._dc:6.2f}")
+        try:
+            index = int(parts[0])
+        except ValueError:
+            return
 
-        #####
+        if not (0 <= index < len(self.channels)):
+            print(f"No glass channel {index}")
+            return
 
-        # 1st half
-        if f:
-            GPIO.output(self.A_PIN, GPIO.HIGH)
-        time.sleep(pulse)
+        return (cmd, index, trace)
 
-        if f:
-            GPIO.output(self.A_PIN, GPIO.LOW)
-        time.sleep(pause)
+    def _read_cmd(self):
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
 
-        #####
+            ts = self.clock.monotonic()
+            cmd = self._parse_cmd(line)
+            if cmd is not None:
+                cmd, index, trace = cmd
+                self._events.put((self.EVENT_CMD, (cmd, index, ts, trace)))
 
-        # 2nd half
-        if f:
-            GPIO.output(self.B_PIN, GPIO.HIGH)
-        time.sleep(pulse)
+    def _process_events(self, block=False):
+        while True:
+            try:
+                kind, value = self._events.get(block=block)
+            except queue.Empty:
+                return
 
-        if f:
-            GPIO.output(self.B_PIN, GPIO.LOW)
-        time.sleep(pause)
+            block = False
 
-        #####
+            if kind == self.EVENT_CONFIG:
+                self.configure(value)
+                continue
 
-        self._dc_prev = self._dc
+            cmd, index, ts, trace = value
+            if 'sent' in trace:
+                self.m_ipc.observe(ts - trace['sent'])
 
-    def _dc_up(self):
-        if self._dc < self.DC_ON_L1:
-            d = self.DC_ON_D1
-        elif self._dc < self.DC_ON_L2:
-            d = self.DC_ON_D2
-        else:
-            d = self.DC_ON_D3
+            if index is None:
+                channels = self.channels
+            else:
+                channels = [self.channels[index]]
+
+            on = cmd == self.CMD_ON
+            for ch in channels:
+                if ch.target_on != on:
+                    self._stop_waveform(ch)
+                    ch.set_target(on, ts, trace.get('origin'))
+
+    def _get_schedule(self):
+        # Pin transitions of all channels within one half period, merged
+        # into a single list of (offset, pins to set low) sorted by time.
+        # Rebuilt only when some duty cycle changes.
+        key = tuple((ch._dc, ch.waveform) for ch in self.channels)
+        if key == self._schedule_key:
+            return self._schedule
+
+        falls = {}
+        for ch in self.channels:
+            if ch.waveform:
+                continue
 
-        self._dc += d
-        if self._dc > self.DC_ON_L3:
-            self._dc = self.DC_ON_L3
+            pulse = ch.pulse(self.HALF_PERIOD)
+            if pulse > 0:
+                falls.setdefault(pulse, []).append(ch)
 
-    def _turn_on(self):
-        start_dt = datetime.now()
-        while (self._dc < self.DC_ON_L3):
-            self._dc_up()
-            self._cycle()
-        td = datetime.now() - start_dt
+        self._schedule = sorted(falls.items(), key=lambda i: i[0])
+        self._schedule_key = key
+        return self._schedule
 
-        self.on = True
-        print(f"Glass if ON ({td})")
+    def _sleep_until(self, dt):
+        # Returns how late the deadline was met.
+        delay = dt - self.clock.perf_counter()
+        if delay > 0:
+            self.clock.sleep(delay)
+        return self.clock.perf_counter() - dt
 
-    def _dc_down(self):
-        if self._dc > self.DC_OFF_L1:
-            d = self.DC_OFF_D1
-        elif self._dc > self.DC_OFF_L2:
-            d = self.DC_OFF_D2
-        else:
-            d = self.DC_OFF_D3
+    def _half_cycle(self, start_dt, schedule, pin_attr):
+        output = self.gpio.output
 
-        self._dc -= d
-        if self._dc < self.DC_OFF_L3:
-            self._dc = self.DC_OFF_L3
+        for _, chs in schedule:
+            for ch in chs:
+                output(getattr(ch, pin_attr), self.gpio.HIGH)
 
-    def _turn_off(self):
-        start_dt = datetime.now()
-        while (self._dc > self.DC_OFF_L3):
-            self._dc_down()
-            self._cycle()
-        td = datetime.now() - start_dt
+        for offset, chs in schedule:
+            self._sleep_until(start_dt + offset)
+            for ch in chs:
+                output(getattr(ch, pin_attr), self.gpio.LOW)
 
-        self.on = False
-        print(f"Glass if OFF ({td})")
+        self.m_jitter.observe(self._sleep_until(start_dt + self.HALF_PERIOD))
+
+    def _cycle(self):
+        for ch in self.channels:
+            if not ch.waveform:
+                ch.step()
+
+        match self.VERBOSE:
+            case 1:
+                if any(ch._dc != ch._dc_prev for ch in self.channels):
+                    print(" ".join(f"{ch._dc:6.2f}" for ch in self.channels))
+            case 2:
+                print(" ".join(f"{ch._dc:6.2f}" for ch in self.channels))
+
+        schedule = self._get_schedule()
+
+        # Deadlines are absolute so that sleep overshoot does not accumulate;
+        # after a stall of more than a period the schedule is restarted.
+        dt = self.clock.perf_counter()
+        if (self._period_dt is None) or (dt - self._period_dt > self.PERIOD):
+            self._period_dt = dt
+
+        # 1st half
+        self._half_cycle(self._period_dt, schedule, 'A_PIN')
+
+        # 2nd half
+        self._half_cycle(self._period_dt + self.HALF_PERIOD, schedule, 'B_PIN')
+
+        self._period_dt += self.PERIOD
 
 
 if __name__ == "__main__":
@@ -210,7 +489,10 @@ if __name__ == "__main__":
         print("No path for configuration provided")
         sys.exit(1)
 
+    sys.stdout.reconfigure(line_buffering=True)
+
     glass_driver = GlassDriver(cfg_path)
+    print(GlassDriver.READY_TEXT)
 
     try:
         glass_driver.start()
@@ -1,51 +1,186 @@
-from datetime import datetime
+from array import array
+import fcntl
+import json
 import math
 from pathlib import Path
+import threading
 
-from radar_ld2450 import LD2450
+from clock import SYSTEM_CLOCK
+from clutter_map import ClutterMap
+from radar_hub import HubSerial
+from radar_ld2450 import LD2450, Targets
 import utils
 
 
 class GlassRadar(LD2450):
-    def __init__(self, cfg):
+    CFG_KEYS = (
+        "uartdev",
+        "bluetooth",
+        "multi_tracking",
+        "max_frame_failures",
+        "distance_delta",
+        "distance_min",
+        "distance_max",
+        "distance_thr",
+        "angle_delta",
+        "angle_abs_max",
+        "angle_abs_thr",
+        "toggle_delay",
+    )
+
+    # Delays between reconnection attempts of a failed radar, doubling from
+    # the first to the last.
+    RECOVER_DELAY_MIN = 0.1
+    RECOVER_DELAY_MAX = 5.0
+
+    # Arrival prediction: slowest approach (mm/s) taken as one, largest jump
+    # (mm) between frames still taken as the same target, and the weight of
+    # a new frame in the target velocity.
+    PREDICT_SPEED_MIN = 100
+    PREDICT_TRACK_JUMP = 500
+    PREDICT_SMOOTHING = 0.3
+
+    # Devices in use by radars of this process, so that '/dev/ttyUSBx'
+    # probes running in parallel never try the same port.
+    _devices_lock = threading.Lock()
+    _devices_taken = set()
+
+    # Negotiated baudrates by device, kept across restarts.
+    BAUD_STATE_PATH = Path.cwd() / "state" / "radar_baudrates.json"
+    _baud_state_lock = threading.Lock()
+
+    # Clutter maps by device, saved every CLUTTER_SAVE_INTERVAL and on close.
+    # The hub and the controller may save at once, so the file is also
+    # locked across processes.
+    CLUTTER_STATE_PATH = Path.cwd() / "state" / "radar_clutter.json"
+    CLUTTER_SAVE_INTERVAL = 300.0
+    _clutter_state_lock = threading.Lock()
+
+    @classmethod
+    def reserve_device(cls, uartdev):
+        with cls._devices_lock:
+            cls._devices_taken.add(uartdev)
+
+    @classmethod
+    def _load_baudrates(cls):
+        try:
+            return utils.load_json(cls.BAUD_STATE_PATH)
+        except:
+            return {}
+
+    @classmethod
+    def _save_baudrate(cls, uartdev, baudrate):
+        with cls._baud_state_lock:
+            baudrates = cls._load_baudrates()
+            baudrates[uartdev] = baudrate
+
+            cls.BAUD_STATE_PATH.parent.mkdir(exist_ok=True)
+            tmp_path = cls.BAUD_STATE_PATH.with_suffix(".tmp")
+            with tmp_path.open("w") as f:
+                json.dump(baudrates, f, indent=4)
+            tmp_path.replace(cls.BAUD_STATE_PATH)
+
+    @classmethod
+    def _load_clutter_maps(cls):
+        try:
+            return utils.load_json(cls.CLUTTER_STATE_PATH)
+        except:
+            return {}
+
+    @classmethod
+    def _save_clutter_map(cls, uartdev, state):
+        cls.CLUTTER_STATE_PATH.parent.mkdir(exist_ok=True)
+        lock_path = cls.CLUTTER_STATE_PATH.with_suffix(".lock")
+        with cls._clutter_state_lock, lock_path.open("w") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+
+            maps = cls._load_clutter_maps()
+            maps[uartdev] = state
+
+            tmp_path = cls.CLUTTER_STATE_PATH.with_suffix(".tmp")
+            with tmp_path.open("w") as f:
+                json.dump(maps, f)
+            tmp_path.replace(cls.CLUTTER_STATE_PATH)
+
+    def __init__(self, cfg, hub=None, clock=None):
+        # With `hub`, a (socket path, radar name) pair, frames come from the
+        # radar hub, which owns the UART and the radar settings.
+        self.hub = hub
+        self.clock = SYSTEM_CLOCK if clock is None else clock
+        self.closed = False
+
         self.UARTDEV = cfg['uartdev']
-        self.MAX_FRAME_FAILURES = cfg['max_frame_failures']
+        self._uartdev_cfg = self.UARTDEV
+        self._device_taken = False
         self.BLUETOOTH = cfg['bluetooth']
         self.MULTI_TRACKING = cfg['multi_tracking']
-        self.DISTANCE_DELTA = cfg['distance_delta']
-        self.DISTANCE_MIN = cfg['distance_min']
-        self.DISTANCE_MAX = cfg['distance_max']
-        self.DISTANCE_THR = cfg['distance_thr']
-        self.ANGLE_DELTA = cfg['angle_delta']
-        self.ANGLE_ABS_MAX = cfg['angle_abs_max']
-        self.ANGLE_ABS_THR = cfg['angle_abs_thr']
-        self.TOGGLE_DELAY = cfg['toggle_delay']
+        # None keeps the saved or default rate, "auto" takes the highest
+        # working one, a number asks for that rate.
+        self.BAUDRATE = cfg.get('baudrate')
+        self._configure_thresholds(cfg)
 
-
-        if self.UARTDEV == "/dev/ttyUSBx":
+        if self.hub is not None:
+            self.UARTDEV = f"hub:{self.hub[1]}"
+            super().__init__(self.UARTDEV)
+        elif self.UARTDEV == "/dev/ttyUSBx":
+            # A device is claimed under the lock and probed outside it, so
+            # that radars probing in parallel take turns only for the claim.
             dev_path = Path("/dev")
             dev_list = sorted(list(dev_path.glob('ttyUSB*')))
             for p in dev_list:
+                with self._devices_lock:
+                    if str(p) in self._devices_taken:
+                        continue
+                    self._devices_taken.add(str(p))
+
                 self.UARTDEV = str(p)
                 print(f"Trying '{p}'...")
                 try:
-                    super().__init__(self.UARTDEV)
+                    super().__init__(self.UARTDEV, baudrate=self._saved_baudrate())
+                    self._negotiate_baudrate()
                     self.setup()
                     break
                 except:
-                    pass
+                    with self._devices_lock:
+                        self._devices_taken.discard(str(p))
             else:
                 raise Exception("Failed to init radar.")
+
+            self._device_taken = True
         else:
-            super().__init__(self.UARTDEV)
+            super().__init__(self.UARTDEV, baudrate=self._saved_baudrate())
+            self._negotiate_baudrate()
 
-        self.dt = datetime.now()
+        # Monotonic time of the frame last fed to update().
+        self.ts = self.clock.monotonic()
 
+        # Stuck while the nearest target repeats the frame before exactly,
+        # until the clutter map has learned it.
         self.stuck = False
-        self.stuck_count = 0
-
-        self.t_raw_prev = None
-        self.t_raw = None
+        self.stuck_transitions_total = 0
+
+        # Targets in clutter cells are ignored; the map is learned from the
+        # targets of consecutive frames and kept across restarts. A hub
+        # consumer does not learn; it takes the map the hub saves.
+        self.clutter_map = ClutterMap()
+        self.clutter_suppressed_total = 0
+        # Target positions of the frame before, copied into arrays of their
+        # own as the Targets record is refilled by every frame.
+        self._prev_n = 0
+        self._prev_x = array('h', bytes(2 * Targets.N))
+        self._prev_y = array('h', bytes(2 * Targets.N))
+        self._load_clutter()
+        self.clutter_save_ts = self.ts
+
+        # Record the frames are decoded into, and the nearest target of the
+        # last two frames.
+        self.targets = Targets()
+
+        self.x_raw_prev = None
+        self.y_raw_prev = None
+        self.x_raw = None
+        self.y_raw = None
+        self.speed_raw = None
 
         self.distance_raw = None
         self.distance_reliable = self.DISTANCE_MAX
@@ -57,10 +192,217 @@ class GlassRadar(LD2450):
         self.human_present = False
         self.human_present_reliable = False
 
-        self.toggle_dt = self.dt
+        self.toggle_ts = self.ts
+
+        # Seconds until the nearest target enters the presence zone, None
+        # unless it is heading for it.
+        self.eta = None
+        self.track_xy = None
+        self.track_ts = None
+        self.vx = 0.0
+        self.vy = 0.0
+
+        # Frame times behind the last change of the reliable presence: the
+        # first frame whose raw target agreed with the change and the frame
+        # that made it.
+        self.raw_present = False
+        self.raw_change_ts = self.ts
+        self.present_raw_ts = None
+        self.present_ts = None
+
+        # A failed radar is offline, with its port closed, until reconnected.
+        self.online = True
+        self.offline_ts = None
+        self.recover_ts = None
+        self.recover_delay = self.RECOVER_DELAY_MIN
+        self.recoveries_total = 0
 
         print(f"Glass radar initialized ({self.UARTDEV})")
 
+    def _load_clutter(self, verbose=True):
+        # Replays without a device start from an empty map. The map is
+        # built aside and swapped in, as the frame path may be using the
+        # old one.
+        key = self._uartdev_cfg if self.hub is not None else self.UARTDEV
+        if key is None:
+            return
+
+        state = self._load_clutter_maps().get(key)
+        if state is None:
+            return
+
+        ts = self.clock.monotonic()
+        now = self.clock.time()
+        cmap = ClutterMap()
+        cmap.load(state, ts, now - state.get('saved', now))
+        self.clutter_map = cmap
+        if verbose:
+            print(f"Glass radar ({self.UARTDEV}): clutter map loaded "
+                  f"({cmap.n_clutter} clutter cells)")
+
+    def save_clutter(self):
+        # Hub consumers leave the map to the hub.
+        if (self.UARTDEV is None) or (self.hub is not None):
+            return
+
+        ts = self.clock.monotonic()
+        state = self.clutter_map.dump(ts)
+        state['saved'] = self.clock.time()
+        try:
+            self._save_clutter_map(self.UARTDEV, state)
+        except OSError as e:
+            print(f"{self.clock.now()}: glass radar ({self.UARTDEV}) failed to save "
+                  f"its clutter map ({e})")
+
+    def maintain_clutter(self):
+        # Called off the frame path, by the thread that owns the process
+        # loop: saves the learned map every CLUTTER_SAVE_INTERVAL, or has a
+        # hub consumer take the map the hub saved.
+        ts = self.clock.monotonic()
+        if ts - self.clutter_save_ts < self.CLUTTER_SAVE_INTERVAL:
+            return
+        self.clutter_save_ts = ts
+
+        if self.hub is None:
+            self.save_clutter()
+        else:
+            self._load_clutter(verbose=False)
+
+    def _saved_baudrate(self):
+        return self._load_baudrates().get(self.UARTDEV, self.DEFAULT_BAUDRATE)
+
+    def _negotiate_baudrate(self):
+        if self.BAUDRATE is None:
+            return
+
+        if self.BAUDRATE == "auto":
+            if self.UARTDEV in self._load_baudrates():
+                return
+            baudrates = self.BAUDRATES
+        else:
+            if self.baudrate == self.BAUDRATE:
+                return
+            baudrates = [self.BAUDRATE]
+
+        t0 = self.clock.now()
+        baudrate = self.negotiate_baudrate(baudrates)
+        self._save_baudrate(self.UARTDEV, baudrate)
+        print(f"Glass radar ({self.UARTDEV}) at {baudrate} baud "
+              f"({(self.clock.now() - t0).total_seconds():.2f} s)")
+
+    def _get_serial(self):
+        if self.hub is not None:
+            return HubSerial(*self.hub)
+        return super()._get_serial()
+
+    def close(self):
+        # Saves the clutter map, once.
+        if self.closed:
+            return
+        self.closed = True
+
+        super().close()
+        self.save_clutter()
+
+        if self._device_taken:
+            with self._devices_lock:
+                self._devices_taken.discard(self.UARTDEV)
+            self._device_taken = False
+
+    def go_offline(self, reason):
+        self._close_port()
+
+        self.online = False
+        self.offline_ts = self.clock.monotonic()
+        self.recover_ts = self.offline_ts
+        self.recover_delay = self.RECOVER_DELAY_MIN
+
+        print(f"{self.clock.now()}: glass radar ({self.UARTDEV}) is offline ({reason})")
+
+    def try_recover(self):
+        # Reconnects once the backoff delay has passed. Returns True when the
+        # radar is back online.
+        ts = self.clock.monotonic()
+        if ts < self.recover_ts:
+            return False
+
+        try:
+            self.reconnect()
+            # A hub consumer cannot set the radar up; the hub does.
+            if self.SETUP_ON_RECOVER and self.hub is None:
+                self.setup()
+        except Exception as e:
+            self._close_port()
+            self.recover_ts = ts + self.recover_delay
+            print(f"{self.clock.now()}: glass radar ({self.UARTDEV}) reconnection failed, "
+                  f"next try in {self.recover_delay:.1f} s ({e})")
+            self.recover_delay = min(2 * self.recover_delay, self.RECOVER_DELAY_MAX)
+            return False
+
+        self.online = True
+        self.recoveries_total += 1
+        print(f"{self.clock.now()}: glass radar ({self.UARTDEV}) is back online "
+              f"after {self.clock.monotonic() - self.offline_ts:.2f} s")
+        return True
+
+    def _configure_thresholds(self, cfg):
+        self.SETUP_ON_RECOVER = cfg.get('setup_on_recover', False)
+        self.MAX_FRAME_FAILURES = cfg['max_frame_failures']
+        self.DISTANCE_DELTA = cfg['distance_delta']
+        self.DISTANCE_MIN = cfg['distance_min']
+        self.DISTANCE_MAX = cfg['distance_max']
+        self.DISTANCE_THR = cfg['distance_thr']
+        self.ANGLE_DELTA = cfg['angle_delta']
+        self.ANGLE_ABS_MAX = cfg['angle_abs_max']
+        self.ANGLE_ABS_THR = cfg['angle_abs_thr']
+        self.TOGGLE_DELAY = cfg['toggle_delay']
+        self.CLUTTER_MAP = cfg.get('clutter_map', True)
+
+    def configure(self, cfg, settings=True):
+        # Applies a changed config section live, without reopening the port.
+        # With `settings` False the radar settings, which take commands, are
+        # left for configure_settings().
+        self._configure_thresholds(cfg)
+
+        if settings:
+            self.configure_settings(cfg)
+
+        self.distance_reliable = utils.clamp(
+            self.distance_reliable, self.DISTANCE_MIN, self.DISTANCE_MAX)
+        self.angle_abs_reliable = utils.clamp(
+            self.angle_abs_reliable, 0, self.ANGLE_ABS_MAX)
+
+        print(f"Glass radar configured ({self.UARTDEV})")
+
+    def configure_settings(self, cfg):
+        # Radar settings of a hub radar are applied by the hub.
+        if self.hub is None:
+            self._configure_radar(cfg)
+
+    def _configure_radar(self, cfg):
+        if cfg['uartdev'] != self._uartdev_cfg:
+            print(f"Glass radar ({self.UARTDEV}): UART device change "
+                  f"is applied on next start")
+
+        if cfg.get('baudrate') != self.BAUDRATE:
+            print(f"Glass radar ({self.UARTDEV}): baudrate change "
+                  f"is applied on next start")
+
+        if cfg['multi_tracking'] != self.MULTI_TRACKING:
+            self.MULTI_TRACKING = cfg['multi_tracking']
+            if self.MULTI_TRACKING:
+                self.set_multi_tracking()
+            else:
+                self.set_single_tracking()
+
+        if cfg['bluetooth'] != self.BLUETOOTH:
+            # Takes effect on next radar restart, which is not forced here.
+            self.BLUETOOTH = cfg['bluetooth']
+            if self.BLUETOOTH:
+                self.set_bluetooth_on()
+            else:
+                self.set_bluetooth_off()
+
     def setup(self):
         if self.BLUETOOTH:
             self.set_bluetooth_on(restart=True)
@@ -74,58 +416,57 @@ class GlassRadar(LD2450):
 
         self.set_zone_filtering(mode=0)
 
-    def process(self):
-        self.dt = datetime.now()
+    def decode(self, frame):
+        return self.decode_frame(frame, self.targets)
 
-        data = self.get_data()
+    def process(self):
+        frame = self.get_frame()
+        if frame is None:
+            return self.update(None)
+        return self.update(self.decode(frame))
+
+    def update(self, data, ts=None):
+        # `data` is the Targets record of one frame, None for a bad frame;
+        # `ts` is the monotonic time the frame was read at.
+        if ts is None:
+            ts = self.clock.monotonic()
+        self.ts = ts
 
         data_ok = True
         if data is None:
             data_ok = False
 
-        data_present = False
-        if data_ok and len(data) > 0:
-            data_present = True
+        i = -1
+        if data_ok:
+            i = self._select(data)
+        data_present = i >= 0
 
         # New data.
-        self.t_raw_prev = self.t_raw
+        self.x_raw_prev = self.x_raw
+        self.y_raw_prev = self.y_raw
         if data_present:
-            data_extended = list(
-                map(lambda t: (t, self.distance(t), self.angle(t)), data))
-
-            self.t_raw, self.distance_raw, angle_raw = \
-                min(data_extended, key=lambda t: t[1])
+            self.x_raw = data.x[i]
+            self.y_raw = data.y[i]
+            self.speed_raw = data.speed[i]
 
-            self.angle_abs_raw = math.fabs(angle_raw)
+            self.distance_raw = math.sqrt(data.d2[i])
+            self.angle_abs_raw = math.fabs(self.angle((self.x_raw, self.y_raw)))
         else:
-            self.t_raw = None
+            self.x_raw = None
+            self.y_raw = None
+            self.speed_raw = None
             self.distance_raw = None
             self.angle_abs_raw = None
 
-        # Stuck or not.
-        if self.stuck:
-            if data_present:
-                if self.t_raw != self.t_raw_prev:
-                    self.stuck_count += 1
-                else:
-                    self.stuck_count = 0
-            else:
-                self.stuck_count += 1
-
-            if self.stuck_count > 3:
-                self.stuck = False
-                self.stuck_count = 0
-        else:
-            if data_present and (self.t_raw == self.t_raw_prev):
-                self.stuck_count += 1
-            else:
-                self.stuck_count = 0
+        stuck = data_present and (self.x_raw == self.x_raw_prev) and \
+            (self.y_raw == self.y_raw_prev)
+        if stuck != self.stuck:
+            self.stuck = stuck
+            self.stuck_transitions_total += 1
 
-            if self.stuck_count > 20:
-                self.stuck = True
-                self.stuck_count = 0
+        self._predict(data_present)
 
-        if data_present and (not self.stuck):
+        if data_present:
             distance_diff = utils.clamp(
                 self.distance_raw - self.distance_reliable,
                 -self.DISTANCE_DELTA,
@@ -133,7 +474,7 @@ class GlassRadar(LD2450):
         else:
             distance_diff = self.DISTANCE_DELTA
 
-        if data_present and (not self.stuck):
+        if data_present:
             angle_diff = utils.clamp(
                 self.angle_abs_raw - self.angle_abs_reliable,
                 -self.ANGLE_DELTA,
@@ -151,6 +492,13 @@ class GlassRadar(LD2450):
             0,
             self.ANGLE_ABS_MAX)
 
+        raw_present = data_present and \
+            (self.distance_raw < self.DISTANCE_THR) and \
+            (self.angle_abs_raw < self.ANGLE_ABS_THR)
+        if raw_present != self.raw_present:
+            self.raw_present = raw_present
+            self.raw_change_ts = self.ts
+
         self.human_present_prev = self.human_present
         if (self.distance_reliable < self.DISTANCE_THR) and \
            (self.angle_abs_reliable < self.ANGLE_ABS_THR):
@@ -159,13 +507,93 @@ class GlassRadar(LD2450):
             self.human_present = False
 
         if self.human_present != self.human_present_prev:
-            self.toggle_dt = self.dt
+            self.toggle_ts = self.ts
 
-        if (self.dt - self.toggle_dt).total_seconds() > self.TOGGLE_DELAY:
+        if (self.ts - self.toggle_ts) > self.TOGGLE_DELAY and \
+           self.human_present_reliable != self.human_present:
             self.human_present_reliable = self.human_present
+            self.present_ts = self.ts
+            self.present_raw_ts = min(self.raw_change_ts, self.ts)
 
         return data_ok
 
+    def _select(self, data):
+        # Index of the nearest target outside clutter, -1 if there is none.
+        # Targets at the very position of one of the frame before are hits
+        # for the clutter map, unless the hub learns it.
+        if not self.CLUTTER_MAP:
+            return data.nearest()
+
+        cmap = self.clutter_map
+        ts = self.ts
+        prev_n = self._prev_n if self.hub is None else 0
+        prev_x = self._prev_x
+        prev_y = self._prev_y
+
+        i_min = -1
+        for i in range(data.n):
+            x = data.x[i]
+            y = data.y[i]
+            cell = cmap.cell(x, y)
+            for j in range(prev_n):
+                if prev_x[j] == x and prev_y[j] == y:
+                    cmap.hit(cell, ts)
+                    break
+
+            if cmap.is_clutter(cell, ts):
+                self.clutter_suppressed_total += 1
+            elif (i_min < 0) or (data.d2[i] < data.d2[i_min]):
+                i_min = i
+
+        for i in range(data.n):
+            prev_x[i] = data.x[i]
+            prev_y[i] = data.y[i]
+        self._prev_n = data.n
+
+        return i_min
+
+    def _predict(self, data_present):
+        self.eta = None
+
+        if not data_present:
+            self.track_ts = None
+            return
+
+        x = self.x_raw
+        y = self.y_raw
+        speed = self.speed_raw
+
+        # Velocity from the positions of the tracked target; frames of one
+        # read share a time and add nothing to it.
+        if (self.track_ts is None) or \
+           math.dist((x, y), self.track_xy) > self.PREDICT_TRACK_JUMP:
+            self.vx = 0.0
+            self.vy = 0.0
+            self.track_xy = (x, y)
+            self.track_ts = self.ts
+        elif self.ts > self.track_ts:
+            dt = self.ts - self.track_ts
+            a = self.PREDICT_SMOOTHING
+            self.vx += a * ((x - self.track_xy[0]) / dt - self.vx)
+            self.vy += a * ((y - self.track_xy[1]) / dt - self.vy)
+            self.track_xy = (x, y)
+            self.track_ts = self.ts
+
+        # Speed is radial, in cm/s, negative while the target approaches.
+        approach = -speed * 10
+        if approach < self.PREDICT_SPEED_MIN:
+            return
+
+        eta = max(0.0, (self.distance_raw - self.DISTANCE_THR) / approach)
+
+        # Heading: the target has to arrive within the angle threshold.
+        px = x + self.vx * eta
+        py = y + self.vy * eta
+        if (py <= 0) or (math.fabs(self.angle((px, py))) >= self.ANGLE_ABS_THR):
+            return
+
+        self.eta = eta
+
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,618 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import time
+
+from clock import SYSTEM_CLOCK
+from glass_driver import GlassDriver
+from glass_radar import GlassRadar
+import metrics
+from profiler import StageProfiler
+from radar_health import RadarHealth
+from radar_hub import hub_path
+from recording import FrameRecorder
+
+
+class GlassUnit():
+    # Radar frames come at ~10 Hz; a radar silent for this long counts as a
+    # frame failure, as a read timeout did before.
+    FRAME_TIMEOUT = 1.0
+
+    # A radar without a valid frame for this long is not decided on: the
+    # glass goes to the safe state, or to degraded mode, long before the
+    # radar is taken offline for its frame failures.
+    STALE_TIMEOUT = 0.5
+
+    # Time a predicted arrival may go unconfirmed before the early ramp is
+    # taken back.
+    PREDICT_GRACE = 0.5
+
+    # Longest a prediction can keep the glass on unconfirmed, however long
+    # the target keeps coming.
+    PREDICT_MAX = 3.0
+
+    POLICY_ALL            = "all"
+    POLICY_ANY            = "any"
+
+    # With a radar degraded, decide on the healthy ones only: a pair falls
+    # back to a single radar.
+    DEGRADED_SINGLE       = "single"
+
+    RADAR_STAT_COLS = [
+        "in_waiting",
+        "stuck",
+        "distance_raw",
+        "distance_reliable",
+        "angle_abs_raw",
+        "angle_abs_reliable",
+        "human_present_reliable",
+        "health",
+    ]
+
+    def __init__(self, name, cfg_unit, cfg, send_cmd, clock=None):
+        self.name = name
+
+        # Wall clock time for logs and stats, monotonic time for intervals,
+        # both from `clock`, the system's unless replaying.
+        self.clock = SYSTEM_CLOCK if clock is None else clock
+        self.dt = None
+        self.ts = self.clock.monotonic()
+
+        self.radar_names = cfg_unit['radars']
+        self.CHANNEL = cfg_unit.get('channel')
+        self.POLICY = cfg_unit.get('policy', self.POLICY_ALL)
+        if self.POLICY not in (self.POLICY_ALL, self.POLICY_ANY):
+            raise ValueError(f"Unit '{name}': policy must be '{self.POLICY_ALL}' or '{self.POLICY_ANY}'.")
+
+        # Glass command while a radar is offline; None holds the state.
+        self.SAFE_STATE = cfg_unit.get('safe_state', GlassDriver.CMD_OFF)
+        if self.SAFE_STATE not in (GlassDriver.CMD_ON, GlassDriver.CMD_OFF, None):
+            raise ValueError(f"Unit '{name}': safe_state must be '{GlassDriver.CMD_ON}', '{GlassDriver.CMD_OFF}' or null.")
+
+        # Seconds ahead of a predicted arrival to switch the glass on, about
+        # the ramp time; None waits for presence.
+        self.PREDICT_LEAD = cfg_unit.get('predict_lead')
+
+        # Decision while radars are degraded; None holds the glass in the
+        # safe state unless all radars are online.
+        self.DEGRADED_MODE = cfg_unit.get('degraded_mode')
+        if self.DEGRADED_MODE not in (self.DEGRADED_SINGLE, None):
+            raise ValueError(f"Unit '{name}': degraded_mode must be '{self.DEGRADED_SINGLE}' or null.")
+
+        self._send_cmd = send_cmd
+
+        # Status print on every decision.
+        self.PRINT_STATUS = True
+
+        self.radars = self._init_radars(cfg)
+        self.health = [RadarHealth(f"[{name}] radar {i+1}", self.ts, self.clock) for i in range(len(self.radars))]
+
+        # Radars the decision is taken on.
+        self.active = list(self.radars)
+
+        self._init_metrics()
+
+        self.configure(cfg['glass_driver'])
+        self.prof = None
+        self._cfg_profile = None
+        self.configure_controller(cfg.get('controller', {}))
+
+        self._pending_cfg = queue.SimpleQueue()
+
+        self.frame_ts = [self.ts] * len(self.radars)
+        # Time of the last valid frame of each radar.
+        self.data_ts = [self.ts] * len(self.radars)
+        self.decision_ts = None
+
+        self.stat_f = None
+        self.rec = None
+
+        self.glass_on = False
+        self.no_cmd_until_ts = self.ts
+
+        # The glass is on ahead of a predicted arrival, not yet confirmed.
+        self.predicted = False
+        self.predict_until_ts = None
+        self.predict_ts = None
+        # After a miss, no new prediction until the target stops coming.
+        self.predict_missed = False
+
+    def _init_radar(self, radar_name, cfg, hub=None):
+        t0 = self.clock.monotonic()
+        radar = GlassRadar(cfg, hub=hub and (hub, radar_name), clock=self.clock)
+        print(f"[{self.name}] radar '{radar_name}' ready ({self.clock.monotonic() - t0:.2f} s)")
+        return radar
+
+    def _init_radars(self, cfg):
+        # Radars are configured in parallel, as a setup with restarts takes
+        # seconds per radar.
+        hub = hub_path(cfg)
+        with ThreadPoolExecutor(max_workers=len(self.radar_names)) as pool:
+            futures = [pool.submit(self._init_radar, r, cfg[r], hub) for r in self.radar_names]
+
+        radars = []
+        error = None
+        for future in futures:
+            try:
+                radars.append(future.result())
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            for radar in radars:
+                radar.close()
+            raise error
+
+        return radars
+
+    def _init_metrics(self):
+        reg = metrics.REGISTRY
+
+        self.m_frames = []
+        self.m_decode = []
+        for i, radar in enumerate(self.radars):
+            labels = {'unit': self.name, 'radar': str(i+1)}
+
+            self.m_frames.append(reg.counter(
+                "glass_radar_frames_total", "Valid radar data frames.", **labels))
+            self.m_decode.append(reg.histogram(
+                "glass_radar_decode_seconds", "Frame parsing and smoothing time.", **labels))
+
+            reg.gauge_func(
+                "glass_radar_in_waiting_bytes", "Bytes waiting on the serial port before the last read.",
+                lambda radar=radar: radar.last_in_waiting, **labels)
+            reg.counter_func(
+                "glass_radar_skipped_bytes_total", "Bytes dropped while looking for frames.",
+                lambda radar=radar: radar.skipped_bytes_total, **labels)
+            reg.counter_func(
+                "glass_radar_invalid_frames_total", "Frames with an invalid header or end.",
+                lambda radar=radar: radar.invalid_frames_total, **labels)
+            reg.counter_func(
+                "glass_radar_stuck_transitions_total", "Changes of the radar stuck state.",
+                lambda radar=radar: radar.stuck_transitions_total, **labels)
+            reg.gauge_func(
+                "glass_radar_clutter_cells", "Cells of the clutter map taken for clutter.",
+                lambda radar=radar: radar.clutter_map.n_clutter, **labels)
+            reg.counter_func(
+                "glass_radar_clutter_suppressed_total", "Targets ignored as clutter.",
+                lambda radar=radar: radar.clutter_suppressed_total, **labels)
+            reg.counter_func(
+                "glass_radar_recoveries_total", "Reconnections of a failed radar.",
+                lambda radar=radar: radar.recoveries_total, **labels)
+            reg.gauge_func(
+                "glass_radar_online", "Whether the radar is connected.",
+                lambda radar=radar: int(radar.online), **labels)
+            reg.gauge_func(
+                "glass_radar_health", "Rolling radar health score, 0 to 1.",
+                lambda i=i: self.health[i].score, **labels)
+            reg.gauge_func(
+                "glass_radar_healthy", "Whether the radar counts as healthy.",
+                lambda i=i: int(self.health[i].healthy), **labels)
+
+        reg.gauge_func(
+            "glass_unit_active_radars", "Radars the decision is taken on.",
+            lambda: len(self.active), unit=self.name)
+
+        self.m_latency = {
+            stage: reg.histogram(
+                "glass_toggle_latency_seconds", "Toggle latency stages, from the radar frame to full duty.",
+                stage=stage, unit=self.name)
+            for stage in ("smoothing", "decision")}
+
+        self.m_toggles = {
+            cmd: reg.counter(
+                "glass_toggles_total", "Glass commands sent.", unit=self.name, cmd=cmd)
+            for cmd in (GlassDriver.CMD_ON, GlassDriver.CMD_OFF)}
+
+        self.m_predictions = {
+            outcome: reg.counter(
+                "glass_predictions_total", "Early ramps on predicted arrival, by outcome.",
+                unit=self.name, outcome=outcome)
+            for outcome in ("hit", "miss")}
+
+    @property
+    def stat_cols(self):
+        cols = ["timestamp", "glass_on", "cmd_allowed", "present"]
+        for i in range(len(self.radars)):
+            cols.extend(f"r{i+1}_{c}" for c in self.RADAR_STAT_COLS)
+        return cols
+
+    def open_stats(self, stat_dir, stat_name):
+        stat_path = stat_dir / f"{stat_name}_{self.name}.csv"
+        self.stat_f = stat_path.open("a")
+
+        cols = ",".join(self.stat_cols)
+        self.stat_f.write(f"{cols}\n")
+
+        # Raw frames for playback, next to the stats.
+        if self.RECORD:
+            rec_path = stat_dir / f"{stat_name}_{self.name}{FrameRecorder.SUFFIX}"
+            self.rec = FrameRecorder(rec_path)
+
+    def maintain(self):
+        # Housekeeping from the controller loop, off the frame path.
+        for radar in self.radars:
+            radar.maintain_clutter()
+
+    def cleanup(self):
+        try:
+            self.stat_f.close()
+        except:
+            pass
+
+        if self.rec is not None:
+            self.rec.close()
+
+        for radar in self.radars:
+            radar.close()
+
+    def configure(self, cfg):
+        self.STATE_DELAY = cfg['state_delay']
+
+    def configure_controller(self, cfg):
+        self.MIN_DECISION_INTERVAL = cfg.get('min_decision_interval', 0.0)
+
+        # Takes effect when stats are opened, i.e. on next start.
+        self.RECORD = cfg.get('record', False)
+
+        # Stage profiling is off unless the 'profile' option is given. The
+        # profiler, and the windows it collected, are kept unless its own
+        # options change.
+        cfg_profile = cfg.get('profile')
+        if cfg_profile == self._cfg_profile:
+            return
+        self._cfg_profile = cfg_profile
+
+        if cfg_profile:
+            self.prof = StageProfiler(
+                self.name,
+                sample_every=cfg_profile.get('sample_every', 100),
+                window=cfg_profile.get('window', 1000))
+        else:
+            self.prof = None
+
+    def post_radar_config(self, i, cfg):
+        # Called from the config watcher; radar configuration may talk to
+        # the radar, so it is applied by the thread running this unit.
+        self._pending_cfg.put((i, cfg))
+
+    def _apply_pending_config(self):
+        while True:
+            try:
+                i, cfg = self._pending_cfg.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                self.radars[i].configure(cfg)
+            except Exception as e:
+                print(f"{self.clock.now()}: unit '{self.name}': radar {i+1} "
+                      f"config not applied ({e})")
+
+    def fds(self):
+        # Descriptors to wait on, with the radar index and its reconnection
+        # count, which tells a reopened port from the old one.
+        return tuple(
+            (radar.fileno(), i, radar.recoveries_total)
+            for i, radar in enumerate(self.radars) if radar.online)
+
+    def select_timeout(self):
+        # How long the unit may wait for radar bytes: an offline radar is
+        # due for its next reconnection attempt, a delivering one may turn
+        # stale.
+        ts = self.clock.monotonic()
+        timeout = self.FRAME_TIMEOUT
+        for i, radar in enumerate(self.radars):
+            if not radar.online:
+                wait = radar.recover_ts - ts
+            elif self._delivering(i):
+                wait = self.data_ts[i] + self.STALE_TIMEOUT - ts
+            else:
+                continue
+            timeout = min(timeout, max(0.0, wait))
+        return timeout
+
+    def _delivering(self, i):
+        radar = self.radars[i]
+        return radar.online and (not radar.n_frame_failures) and \
+            self.ts - self.data_ts[i] <= self.STALE_TIMEOUT
+
+    def _go_safe(self):
+        # A pending prediction is void once radars fail.
+        self.predicted = False
+
+        if self.SAFE_STATE is None:
+            return
+
+        on = self.SAFE_STATE == GlassDriver.CMD_ON
+        if self.glass_on != on:
+            self._send_cmd(self.SAFE_STATE, self.CHANNEL)
+            self.m_toggles[self.SAFE_STATE].inc()
+            self.glass_on = on
+
+    def _read_radar(self, i, p=None, frames=None):
+        # Feeds every frame received since the last call, or `frames` when
+        # replaying, through the radar smoothing. Returns True if at least
+        # one frame was valid.
+        radar = self.radars[i]
+
+        if frames is None:
+            try:
+                frames = radar.read_frames()
+            except OSError as e:
+                radar.go_offline(e)
+                return False
+            read_ts = radar.read_ts
+        else:
+            read_ts = self.clock.monotonic()
+        if p:
+            p.mark("read")
+
+        # Frames are recorded with the time they were read at, as replay
+        # feeds them.
+        read_wall = self.clock.time() - (self.clock.monotonic() - read_ts)
+
+        n_stuck = 0
+        for frame in frames:
+            if self.rec is not None:
+                self.rec.write(i, frame, read_ts, read_wall)
+
+            t0 = time.perf_counter_ns()
+            data = radar.decode(frame)
+            if p:
+                p.mark("decode")
+            radar.update(data, read_ts)
+            n_stuck += radar.stuck
+            if p:
+                p.mark("smooth")
+            self.m_decode[i].observe((time.perf_counter_ns() - t0) / 1e9)
+
+        self.health[i].update(self.ts, radar, len(frames), n_stuck)
+
+        if frames:
+            # Replayed frames skip read_frames(), which resets this.
+            radar.n_frame_failures = 0
+            self.m_frames[i].inc(len(frames))
+            self.frame_ts[i] = self.ts
+            self.data_ts[i] = self.ts
+            return True
+
+        if self.ts - self.frame_ts[i] > self.FRAME_TIMEOUT:
+            radar.n_frame_failures += 1
+            self.frame_ts[i] = self.ts
+            print(f"{self.dt}: [{self.name}] no data from radar {i+1}")
+
+        return False
+
+    def process(self, ready, frames=None):
+        # `ready` holds the indices of radars with bytes waiting. Raises on
+        # unexpected errors; the caller takes the unit out of service.
+        # Replays pass the frames of each radar by index in `frames`
+        # instead of having them read.
+        self.dt = self.clock.now()
+        self.ts = self.clock.monotonic()
+
+        p = self.prof and self.prof.sample()
+
+        self._process(ready, p, frames)
+
+        if p:
+            p.finish()
+
+    def _process(self, ready, p, frames=None):
+        self._apply_pending_config()
+
+        # A failing radar is reconnected in place with backoff; meanwhile
+        # the glass is held in the safe state, or in degraded mode decided
+        # on the healthy radars.
+        updated = False
+        for i, radar in enumerate(self.radars):
+            if not radar.online:
+                if radar.try_recover():
+                    self.frame_ts[i] = self.ts
+                    self.data_ts[i] = self.ts
+                continue
+
+            radar_frames = None if frames is None else frames.get(i, [])
+            if i in ready:
+                updated |= self._read_radar(i, p, radar_frames)
+            elif self.ts - self.frame_ts[i] > self.FRAME_TIMEOUT:
+                self._read_radar(i, p, radar_frames)
+
+            if radar.online and radar.n_frame_failures >= radar.MAX_FRAME_FAILURES:
+                radar.go_offline(f"radar {i+1} failures")
+
+        for radar, health in zip(self.radars, self.health):
+            health.check(self.ts, radar.online)
+        self._update_active()
+
+        if not self.active:
+            self._go_safe()
+            return
+
+        if not updated:
+            return
+
+        if (self.decision_ts is not None) and \
+           self.ts - self.decision_ts < self.MIN_DECISION_INTERVAL:
+            return
+        self.decision_ts = self.ts
+
+        self.decide(p)
+
+    def _update_active(self):
+        # All radars while they are delivering valid frames; in degraded
+        # mode the healthy ones, or all if none is healthy but all deliver.
+        delivering = [self._delivering(i) for i in range(len(self.radars))]
+        if all(delivering):
+            active = list(self.radars)
+        else:
+            active = []
+
+        if self.DEGRADED_MODE == self.DEGRADED_SINGLE:
+            healthy = [radar for radar, health, ok in zip(self.radars, self.health, delivering)
+                       if ok and health.healthy]
+            if healthy:
+                active = healthy
+
+        if active == self.active:
+            return
+
+        # A pending prediction was made on other radars.
+        self.predicted = False
+
+        self.active = active
+        if not active:
+            text = "none, glass in safe state"
+        else:
+            text = ", ".join(str(self.radars.index(radar) + 1) for radar in active)
+            if len(active) < len(self.radars):
+                text += " (degraded)"
+        print(f"{self.dt}: [{self.name}] deciding on radars: {text}")
+
+    def _trace(self, present):
+        # Records how long the radar side took to a toggle to `present` and
+        # returns the time of the first frame behind it. With policy 'all'
+        # switching on, the last radar to agree is the one that counts; with
+        # 'all' switching off, the first (and the reverse for 'any').
+        radars = [r for r in self.active
+                  if r.human_present_reliable == present and r.present_ts is not None]
+        if not radars:
+            return None
+
+        if (self.POLICY == self.POLICY_ALL) == present:
+            radar = max(radars, key=lambda r: r.present_ts)
+        else:
+            radar = min(radars, key=lambda r: r.present_ts)
+
+        self.m_latency['smoothing'].observe(radar.present_ts - radar.present_raw_ts)
+        self.m_latency['decision'].observe(self.clock.monotonic() - radar.present_ts)
+        return radar.present_raw_ts
+
+    def _predict_arrival(self):
+        # Whether the radars, combined by policy, expect presence within
+        # the lead time: a radar counts once presence is reliable or its
+        # target is due in the zone in time. A raw in-zone frame does not
+        # count, or one frame would skip the smoothing.
+        if self.PREDICT_LEAD is None:
+            return False
+
+        arriving = [
+            radar.human_present_reliable or
+            (radar.eta is not None and radar.eta <= self.PREDICT_LEAD)
+            for radar in self.active]
+        if self.POLICY == self.POLICY_ALL:
+            return all(arriving)
+        return any(arriving)
+
+    def _status_text(self, cmd_allowed, present):
+        text =   f"[{self.name}] Glass: {' ON' if self.glass_on else 'OFF'}"
+        text +=  f"\nCMD allowed: {cmd_allowed}"
+        text +=  f"\nPresent: {present}"
+
+        for i, radar in enumerate(self.radars):
+            if radar.distance_raw is None:
+                d_raw_text = "-----"
+            else:
+                d_raw_text = f"{radar.distance_raw:5.0f}"
+
+            if radar.angle_abs_raw is None:
+                a_raw_text = "-----"
+            else:
+                a_raw_text = f"{radar.angle_abs_raw:5.0f}"
+
+            text += (f"\n[{i+1}] {radar.in_waiting:4} | "
+                     f"{'stuck' if radar.stuck else '-----'} | "
+                     f"{d_raw_text} / {radar.distance_reliable:5.0f} | "
+                     f"{a_raw_text} / {radar.angle_abs_reliable:5.0f} | "
+                     f"{radar.human_present_reliable} | "
+                     f"{self.health[i].score:4.2f}{'' if radar in self.active else ' (unused)'}")
+
+        text += "\n"
+        return text
+
+    def decide(self, p=None):
+        cmd_allowed = self.ts > self.no_cmd_until_ts
+
+        presence = [radar.human_present_reliable for radar in self.active]
+        if self.POLICY == self.POLICY_ALL:
+            present = all(presence)
+        else:
+            present = any(presence)
+
+        arriving = self._predict_arrival()
+        if not arriving:
+            self.predict_missed = False
+
+        if self.predicted:
+            if present:
+                self.predicted = False
+                self.m_predictions['hit'].inc()
+            elif arriving:
+                self.predict_until_ts = min(
+                    self.ts + self.PREDICT_GRACE, self.predict_ts + self.PREDICT_MAX)
+
+        cmd = None
+        predicted = False
+        if cmd_allowed:
+            if (not self.glass_on) and present:
+                cmd = GlassDriver.CMD_ON
+            elif (not self.glass_on) and arriving and not self.predict_missed:
+                cmd = GlassDriver.CMD_ON
+                predicted = True
+            elif self.glass_on and (not present):
+                if not self.predicted:
+                    cmd = GlassDriver.CMD_OFF
+                elif self.ts > self.predict_until_ts:
+                    cmd = GlassDriver.CMD_OFF
+                    self.predicted = False
+                    self.predict_missed = True
+                    self.m_predictions['miss'].inc()
+                    print(f"{self.dt}: [{self.name}] predicted arrival did not happen")
+
+        if cmd is not None:
+            # An early ramp has no presence frame behind it to trace from.
+            origin_ts = None if predicted else self._trace(present)
+            self._send_cmd(cmd, self.CHANNEL, origin_ts)
+            self.m_toggles[cmd].inc()
+
+            if predicted:
+                self.predicted = True
+                self.predict_ts = self.ts
+                self.predict_until_ts = self.ts + self.PREDICT_GRACE
+                print(f"{self.dt}: [{self.name}] arrival predicted, glass on early")
+
+            if cmd == GlassDriver.CMD_ON:
+                self.glass_on = True
+            elif cmd == GlassDriver.CMD_OFF:
+                self.glass_on = False
+
+            self.no_cmd_until_ts = self.ts + self.STATE_DELAY
+
+        if p:
+            p.mark("decide")
+
+        # Replays go without, the text costing more than the decision.
+        if self.PRINT_STATUS:
+            text = self._status_text(cmd_allowed, present)
+            if p:
+                p.mark("format")
+
+            print(text)
+            if p:
+                p.mark("print")
+
+        if self.stat_f is not None:
+            stat = f"{self.dt},{self.glass_on},{cmd_allowed},{present}"
+            for radar, health in zip(self.radars, self.health):
+                stat += (f",{radar.in_waiting},"
+                         f"{radar.stuck},"
+                         f"{radar.distance_raw},"
+                         f"{radar.distance_reliable},"
+                         f"{radar.angle_abs_raw},"
+                         f"{radar.angle_abs_reliable},"
+                         f"{radar.human_present_reliable},"
+                         f"{health.score:.3f}")
+
+            self.stat_f.write(f"{stat}\n")
+        if p:
+            p.mark("stats")
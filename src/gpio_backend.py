@@ -0,0 +1,231 @@
+from collections import deque
+import time
+
+
+class GPIOBackend():
+    LOW                   = 0
+    HIGH                  = 1
+
+    # Least time both pins of a waveform are low between an A and a B
+    # pulse, as the two pulse trains are not started at the same instant.
+    DEAD_TIME             = 200e-6
+
+    def setup_output(self, pin, value):
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        raise NotImplementedError
+
+    def start_waveform(self, a_pin, b_pin, period, pulse):
+        # Drives `a_pin` high for `pulse` seconds at the start of every
+        # period and `b_pin` the same at its middle, without CPU involvement.
+        # Returns False if the backend cannot do this, in which case the
+        # caller keeps bit-banging.
+        return False
+
+    def waveform_pulse(self, period, pulse):
+        # `pulse` shortened to keep the dead time.
+        return max(0., min(pulse, period / 2 - self.DEAD_TIME))
+
+    def stop_waveform(self, a_pin, b_pin):
+        self.output(a_pin, self.LOW)
+        self.output(b_pin, self.LOW)
+
+    def cleanup(self):
+        pass
+
+
+class RPiGPIOBackend(GPIOBackend):
+    def __init__(self):
+        # Imported here so that the module can be used off a Pi.
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        self._gpio = GPIO
+
+    def setup_output(self, pin, value):
+        self._gpio.setup(pin, self._gpio.OUT)
+        self._gpio.output(pin, value)
+
+    def output(self, pin, value):
+        self._gpio.output(pin, value)
+
+    def cleanup(self):
+        self._gpio.cleanup()
+
+
+class LgpioBackend(GPIOBackend):
+    # Character device access through lgpio (/dev/gpiochipN), which works
+    # on kernels where the sysfs and /dev/gpiomem interfaces are gone.
+
+    def __init__(self, chip=0):
+        import lgpio
+        self._lgpio = lgpio
+        self._handle = lgpio.gpiochip_open(chip)
+        self._pins = []
+
+    def setup_output(self, pin, value):
+        self._lgpio.gpio_claim_output(self._handle, pin, value)
+        self._pins.append(pin)
+
+    def output(self, pin, value):
+        self._lgpio.gpio_write(self._handle, pin, value)
+
+    def start_waveform(self, a_pin, b_pin, period, pulse):
+        # lgpio times the pulses in its own thread; the offset of the B
+        # pulse train keeps the two halves in antiphase. The B offset counts
+        # from its own call, so B runs late by the time between the calls,
+        # which has to stay within the dead time.
+        on_us = int(self.waveform_pulse(period, pulse) * 1e6)
+        off_us = int(period * 1e6) - on_us
+        half_us = int(period * 1e6 / 2)
+
+        try:
+            t0 = time.perf_counter()
+            self._lgpio.tx_pulse(self._handle, a_pin, on_us, off_us, 0, 0)
+            self._lgpio.tx_pulse(self._handle, b_pin, on_us, off_us, half_us, 0)
+            skew = time.perf_counter() - t0
+        except:
+            self.stop_waveform(a_pin, b_pin)
+            return False
+
+        if skew > self.DEAD_TIME:
+            print(f"Waveform on pins {a_pin}/{b_pin} started {skew * 1e6:.0f} us apart, "
+                  f"bit-banging instead")
+            self.stop_waveform(a_pin, b_pin)
+            return False
+
+        return True
+
+    def stop_waveform(self, a_pin, b_pin):
+        for pin in (a_pin, b_pin):
+            try:
+                self._lgpio.tx_pulse(self._handle, pin, 0, 0)
+            except:
+                pass
+
+        super().stop_waveform(a_pin, b_pin)
+
+    def cleanup(self):
+        for pin in self._pins:
+            try:
+                self._lgpio.gpio_write(self._handle, pin, self.LOW)
+                self._lgpio.gpio_free(self._handle, pin)
+            except:
+                pass
+        self._pins = []
+
+        self._lgpio.gpiochip_close(self._handle)
+
+
+class SimGPIOBackend(GPIOBackend):
+    # Records pin transitions as (perf_counter_ns, pin, value), so that
+    # waveforms can be measured on any machine. Only the last MAX_RECORDS
+    # transitions and waveforms are kept, as a simulated driver may run
+    # for days.
+
+    MAX_RECORDS = 1 << 18
+
+    def __init__(self, waveform=False):
+        self.levels = {}
+        self.transitions = deque(maxlen=self.MAX_RECORDS)
+
+        # With `waveform` the simulator accepts hardware waveforms and logs
+        # them as (start_ns, stop_ns, a_pin, b_pin, period, pulse).
+        self.waveform = waveform
+        self.waveforms = deque(maxlen=self.MAX_RECORDS)
+        self._waveforms_active = {}
+
+    def setup_output(self, pin, value):
+        self.levels[pin] = value
+        self.transitions.append((time.perf_counter_ns(), pin, value))
+
+    def output(self, pin, value):
+        if self.levels.get(pin) == value:
+            return
+
+        self.levels[pin] = value
+        self.transitions.append((time.perf_counter_ns(), pin, value))
+
+    def start_waveform(self, a_pin, b_pin, period, pulse):
+        if not self.waveform:
+            return False
+
+        pulse = self.waveform_pulse(period, pulse)
+        self._waveforms_active[(a_pin, b_pin)] = (time.perf_counter_ns(), period, pulse)
+        return True
+
+    def stop_waveform(self, a_pin, b_pin):
+        try:
+            start_ns, period, pulse = self._waveforms_active.pop((a_pin, b_pin))
+        except KeyError:
+            pass
+        else:
+            self.waveforms.append(
+                (start_ns, time.perf_counter_ns(), a_pin, b_pin, period, pulse))
+
+        super().stop_waveform(a_pin, b_pin)
+
+    def clear(self):
+        self.transitions.clear()
+        self.waveforms.clear()
+
+    def edges(self, pin, value, since_ns=0):
+        return [t for (t, p, v) in self.transitions
+                if p == pin and v == value and t >= since_ns]
+
+    def pulses(self, pin, since_ns=0):
+        # Returns (rise_ns, width_ns) for every complete high pulse.
+        res = []
+        rise = None
+        for t, p, v in self.transitions:
+            if p != pin or t < since_ns:
+                continue
+
+            if v == self.HIGH:
+                rise = t
+            elif rise is not None:
+                res.append((rise, t - rise))
+                rise = None
+
+        return res
+
+    def overlaps(self, a_pin, b_pin, since_ns=0):
+        # Returns (start_ns, width_ns) for every time both pins were high,
+        # from the transitions and from the waveforms, where the A pulse of
+        # each period starts at the same time.
+        res = []
+        high = {a_pin: False, b_pin: False}
+        start = None
+        for t, p, v in self.transitions:
+            if p not in high or t < since_ns:
+                continue
+
+            high[p] = v == self.HIGH
+            if all(high.values()):
+                start = t
+            elif start is not None:
+                res.append((start, t - start))
+                start = None
+
+        for start_ns, _, a, b, period, pulse in self.waveforms:
+            if (a, b) == (a_pin, b_pin) and start_ns >= since_ns and pulse > period / 2:
+                res.append((start_ns, int((pulse - period / 2) * 1e9)))
+
+        return res
+
+
+BACKENDS = {
+    "rpi": RPiGPIOBackend,
+    "lgpio": LgpioBackend,
+    "sim": SimGPIOBackend,
+}
+
+
+def get_backend(name):
+    try:
+        backend_cls = BACKENDS[name]
+    except KeyError:
+        names = ", ".join(BACKENDS)
+        raise ValueError(f"GPIO backend must be one of the following: {names}.") from None
+
+    return backend_cls()
@@ -0,0 +1,281 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import matplotlib.patches as patches
+
+from glass_unit import GlassUnit
+from playback import FRAME_DTYPE, decode_targets, load_frames, load_stats
+from radar_ld2450 import LD2450
+from recording import FrameRecorder
+from stats_retention import uncompressed
+import utils
+
+
+class Heatmap():
+    # Where targets are seen around a radar: an occupancy histogram (target
+    # reports per cell) and a dwell time histogram (seconds per cell) on a
+    # grid in front of the radar, one of each per hour of the day. Inputs
+    # are scanned in chunks of mapped records, so memory stays bounded by
+    # the grid whatever the length of the data.
+
+    # Cell size and field, mm: the radar's range and field of view, in
+    # whole cells.
+    CELL = 100
+    X_MAX = math.ceil(LD2450.RANGE * math.sin(LD2450.ANGLE_ABS_MAX) / CELL) * CELL
+    Y_MAX = LD2450.RANGE
+
+    # Records per chunk.
+    CHUNK = 1 << 20
+
+    # Gaps between records longer than this, the radar being offline or the
+    # controller stopped, count only this much dwell.
+    MAX_GAP = 0.5
+
+    def __init__(self, radar, folded=False):
+        # A folded map has |x| only: the stats keep the absolute angle.
+        self.radar = radar
+        self.folded = folded
+        self.name = f"{radar} reliable" if folded else radar
+
+        self.nx = 2 * self.X_MAX // self.CELL
+        self.ny = self.Y_MAX // self.CELL
+        self.occupancy = np.zeros((24, self.ny, self.nx))
+        self.dwell = np.zeros((24, self.ny, self.nx))
+
+        self.last_t = None
+
+    def add(self, t, wall, x, y):
+        # Records at monotonic times `t` and wall times `wall`, one row per
+        # record, with the positions of its targets as (n, k) arrays, NaN
+        # for no target. A record dwells from the record before.
+        if not len(t):
+            return
+
+        prev = np.empty_like(t)
+        prev[0] = t[0] if self.last_t is None else self.last_t
+        prev[1:] = t[:-1]
+        dt = np.clip(t - prev, 0.0, self.MAX_GAP)
+        self.last_t = t[-1]
+
+        # Local hour of the day, with the UTC offset of the chunk.
+        offset = time.localtime(wall[0]).tm_gmtoff
+        hour = ((wall + offset) // 3600 % 24).astype(np.intp)
+
+        with np.errstate(invalid='ignore'):
+            ix = np.floor((x + self.X_MAX) / self.CELL)
+            iy = np.floor(y / self.CELL)
+            ok = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+
+        cell = (hour[:, None] * self.ny + iy) * self.nx + ix
+        n_rec, k = x.shape
+        cell = cell[ok].astype(np.intp)
+        size = 24 * self.ny * self.nx
+        self.occupancy += np.bincount(cell, minlength=size).reshape(self.occupancy.shape)
+        self.dwell += np.bincount(
+            cell, weights=np.broadcast_to(dt[:, None], (n_rec, k))[ok],
+            minlength=size).reshape(self.dwell.shape)
+
+    def merge(self, other):
+        self.occupancy += other.occupancy
+        self.dwell += other.dwell
+
+    def percentiles(self, q):
+        # Dwell weighted percentiles of distance and absolute angle, to set
+        # the thresholds against.
+        dwell = self.dwell.sum(axis=0).ravel()
+        if not dwell.sum():
+            return None
+
+        xs = (np.arange(self.nx) + 0.5) * self.CELL - self.X_MAX
+        ys = (np.arange(self.ny) + 0.5) * self.CELL
+        x, y = np.meshgrid(xs, ys)
+        distance = np.hypot(x, y).ravel()
+        angle = np.degrees(np.arctan2(np.abs(x), y)).ravel()
+
+        def weighted(v):
+            order = np.argsort(v)
+            cum = np.cumsum(dwell[order]) / dwell.sum()
+            return [float(v[order][np.searchsorted(cum, p / 100)]) for p in q]
+
+        return weighted(distance), weighted(angle)
+
+
+def frame_chunks(path, chunk):
+    # Plain recordings are mapped; compressed ones are streamed a chunk at
+    # a time rather than read whole.
+    base, opener = uncompressed(path)
+    if base == Path(path):
+        frames = load_frames(path)
+        for lo in range(0, len(frames), chunk):
+            yield frames[lo:lo+chunk]
+        return
+
+    with opener(path, "rb") as f:
+        while True:
+            data = f.read(chunk * FRAME_DTYPE.itemsize)
+            n = len(data) // FRAME_DTYPE.itemsize
+            if not n:
+                return
+            yield np.frombuffer(data[:n * FRAME_DTYPE.itemsize], dtype=FRAME_DTYPE)
+
+
+def radar_names(cfg, path):
+    # Session files are named '<session>_<unit>.<ext>', their radars
+    # numbered as in the unit.
+    base, _ = uncompressed(path)
+    unit_name = base.stem.split("_", 1)[-1]
+    units = {u['name']: u for u in cfg.get('units', [{
+        'name': "glass",
+        'radars': ["radar_1", "radar_2"],
+        'policy': GlassUnit.POLICY_ALL}])}
+    cfg_unit = units.get(unit_name) or next(iter(units.values()))
+    return cfg_unit['radars']
+
+
+def scan_frames(cfg, path):
+    # Targets as the radars reported them.
+    names = radar_names(cfg, path)
+    maps = {}
+    for chunk in frame_chunks(path, Heatmap.CHUNK):
+        x, y = decode_targets(chunk['frame'])
+        for i in np.unique(chunk['radar']):
+            name = names[i] if i < len(names) else f"radar_{i+1}"
+            hm = maps.setdefault(name, Heatmap(name))
+            sel = chunk['radar'] == i
+            hm.add(chunk['t'][sel], chunk['wall'][sel], x[sel], y[sel])
+    return maps
+
+
+def scan_stats(cfg, path):
+    # The smoothed position of the nearest target, as the presence
+    # thresholds see it; rows with nobody about are left out.
+    base, _ = uncompressed(path)
+    stats = load_stats(base.with_suffix(".csv"))
+    names = radar_names(cfg, path)
+    maps = {}
+    for i, name in enumerate(names):
+        col = f"r{i+1}"
+        if f"{col}_distance_reliable" not in (stats.dtype.names or ()):
+            continue
+
+        hm = Heatmap(name, folded=True)
+        maps[hm.name] = hm
+        distance_max = cfg[name]['distance_max']
+        for lo in range(0, len(stats), Heatmap.CHUNK):
+            chunk = stats[lo:lo+Heatmap.CHUNK]
+            d = chunk[f"{col}_distance_reliable"].astype(float)
+            a = np.radians(chunk[f"{col}_angle_abs_reliable"].astype(float))
+            d[~(d < distance_max)] = np.nan
+
+            # Stats have wall times only.
+            t = chunk['t']
+            hm.add(t, t, (d * np.sin(a))[:, None], (d * np.cos(a))[:, None])
+    return maps
+
+
+def scan(cfg, path):
+    base, _ = uncompressed(path)
+    if base.suffix == FrameRecorder.SUFFIX:
+        return scan_frames(cfg, path)
+    if base.suffix in (".csv", ".npy"):
+        return scan_stats(cfg, path)
+    raise Exception(f"Unknown recording type '{base.suffix}'.")
+
+
+def render(hm, cfg_radar, png_path):
+    # The maps of all hours and the dwell time by hour of the day, on a log
+    # scale, with the presence thresholds drawn over.
+    fig = plt.figure(figsize=(18, 16))
+    grid = fig.add_gridspec(6, 6)
+    extent = (-hm.X_MAX, hm.X_MAX, 0, hm.Y_MAX)
+
+    def draw(ax, data, title, fontsize=10):
+        ax.imshow(np.log1p(data), origin='lower', extent=extent, cmap='inferno')
+        ax.set_title(title, fontsize=fontsize)
+        if cfg_radar is not None:
+            thr = cfg_radar['angle_abs_thr']
+            ax.add_patch(patches.Wedge(
+                (0, 0), cfg_radar['distance_thr'], 90 - thr, 90 + thr,
+                fill=False, edgecolor=(0, 0.8, 1), linewidth=1))
+        if hm.folded:
+            ax.set_xlim(0, hm.X_MAX)
+
+    ax = fig.add_subplot(grid[:2, :3])
+    draw(ax, hm.occupancy.sum(axis=0), f"{hm.name}: target reports, {hm.occupancy.sum():.0f}", 12)
+    ax.set_xlabel("|x|, mm" if hm.folded else "x, mm")
+    ax.set_ylabel("y, mm")
+
+    ax = fig.add_subplot(grid[:2, 3:])
+    draw(ax, hm.dwell.sum(axis=0), f"{hm.name}: dwell, {hm.dwell.sum() / 3600:.1f} h", 12)
+
+    for hour in range(24):
+        ax = fig.add_subplot(grid[2 + hour // 6, hour % 6])
+        draw(ax, hm.dwell[hour], f"{hour:02}:00 dwell, {hm.dwell[hour].sum() / 60:.0f} min", 8)
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+    fig.tight_layout()
+    fig.savefig(png_path, dpi=80)
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    # 'heatmap.py conf.cfg out_dir <recording or stats>...' scans frame
+    # recordings and stats CSVs, one per core at a time, and writes a PNG
+    # per radar (and per radar for the smoothed positions of the stats).
+    # Directories are scanned for session files.
+    try:
+        cfg_path = sys.argv[1]
+        out_dir = Path(sys.argv[2])
+        args = sys.argv[3:]
+        assert args
+    except:
+        print("Usage: heatmap.py <config> <output dir> <recording or stats>...")
+        sys.exit(1)
+
+    cfg = utils.load_json(cfg_path)
+
+    paths = []
+    for arg in args:
+        arg = Path(arg)
+        if not arg.is_dir():
+            paths.append(arg)
+            continue
+        for p in sorted(arg.iterdir()):
+            base, _ = uncompressed(p)
+            if base.suffix in (FrameRecorder.SUFFIX, ".csv"):
+                paths.append(p)
+
+    t0 = time.perf_counter()
+    maps = {}
+    with ProcessPoolExecutor() as pool:
+        for path, result in zip(paths, pool.map(scan, [cfg] * len(paths), paths)):
+            print(f"'{path}': {', '.join(result) or 'nothing'}")
+            for name, hm in result.items():
+                if name in maps:
+                    maps[name].merge(hm)
+                else:
+                    maps[name] = hm
+    print(f"{len(paths)} files in {time.perf_counter() - t0:.1f} s")
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, hm in maps.items():
+        cfg_radar = cfg.get(hm.radar)
+        png_path = out_dir / f"heatmap_{name.replace(' ', '_')}.png"
+        render(hm, cfg_radar, png_path)
+        print(f"{name}: '{png_path}'")
+
+        pct = hm.percentiles((50, 90, 99))
+        if pct is not None:
+            distance, angle = pct
+            print(f"  dwell distance {', '.join(f'{v:.0f}' for v in distance)} mm, "
+                  f"angle {', '.join(f'{v:.0f}' for v in angle)} deg (50/90/99%)")
+        if cfg_radar is not None:
+            print(f"  thresholds {cfg_radar['distance_thr']} mm, {cfg_radar['angle_abs_thr']} deg")
@@ -0,0 +1,215 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import os
+import socketserver
+import threading
+
+
+# Metric updates are plain attribute and list element writes without locks.
+# Every series has a single writer thread (a unit worker, the drive loop),
+# and a scrape may at worst see a histogram whose count is one observation
+# ahead of its buckets, which Prometheus tolerates.
+
+
+def _labels_text(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _value_text(v):
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v))
+
+
+class Counter():
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name):
+        yield f"{name}{_labels_text(self.labels)} {_value_text(self.value)}"
+
+
+class Gauge():
+    __slots__ = ("labels", "value")
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def set(self, v):
+        self.value = v
+
+    def samples(self, name):
+        yield f"{name}{_labels_text(self.labels)} {_value_text(self.value)}"
+
+
+class FuncMetric():
+    # Value read from `fn()` at scrape time, for counters kept as plain
+    # attributes by the code that updates them.
+    __slots__ = ("labels", "fn")
+
+    def __init__(self, labels, fn):
+        self.labels = labels
+        self.fn = fn
+
+    def samples(self, name):
+        yield f"{name}{_labels_text(self.labels)} {_value_text(self.fn())}"
+
+
+class Histogram():
+    __slots__ = ("labels", "buckets", "counts", "sum", "count")
+
+    def __init__(self, labels, buckets):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def samples(self, name):
+        total = 0
+        for le, n in zip(self.buckets + (math.inf,), self.counts):
+            total += n
+            le_text = _value_text(le)
+            yield f"{name}_bucket{_labels_text(self.labels, ('le', le_text))} {total}"
+        yield f"{name}_sum{_labels_text(self.labels)} {_value_text(self.sum)}"
+        yield f"{name}_count{_labels_text(self.labels)} {self.count}"
+
+
+class MetricsRegistry():
+    # Latency buckets in seconds, from 100 us to 5 s.
+    TIME_BUCKETS = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0,
+    )
+
+    def __init__(self):
+        # name -> (type, help, {labels: metric})
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels, factory):
+        labels = tuple(sorted(labels.items()))
+
+        # Registration takes a lock, updates never do.
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, {}))
+            if family[0] != kind:
+                raise ValueError(f"Metric '{name}' is already registered as {family[0]}.")
+
+            series = family[2]
+            if labels not in series:
+                series[labels] = factory(labels)
+            return series[labels]
+
+    def counter(self, name, help, **labels):
+        return self._get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help, **labels):
+        return self._get("gauge", name, help, labels, Gauge)
+
+    def counter_func(self, name, help, fn, **labels):
+        # Registering again rebinds the series to the new source object.
+        metric = self._get("counter", name, help, labels, lambda l: FuncMetric(l, fn))
+        metric.fn = fn
+        return metric
+
+    def gauge_func(self, name, help, fn, **labels):
+        metric = self._get("gauge", name, help, labels, lambda l: FuncMetric(l, fn))
+        metric.fn = fn
+        return metric
+
+    def histogram(self, name, help, buckets=None, **labels):
+        if buckets is None:
+            buckets = self.TIME_BUCKETS
+        return self._get("histogram", name, help, labels, lambda l: Histogram(l, buckets))
+
+    def render(self):
+        with self._lock:
+            families = [(n, k, h, list(s.values())) for n, (k, h, s) in self._families.items()]
+
+        lines = []
+        for name, kind, help, series in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in series:
+                try:
+                    lines.extend(metric.samples(name))
+                except Exception:
+                    # A func metric whose source has gone away.
+                    pass
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        return request, ("local", 0)
+
+
+def serve(address, registry=REGISTRY):
+    # `address` is a TCP port on localhost or the path of a Unix socket.
+    # The server runs in a daemon thread; returns it, or None if disabled.
+    if address is None:
+        return None
+
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+
+    if isinstance(address, int):
+        server = ThreadingHTTPServer(("127.0.0.1", address), handler)
+        server.daemon_threads = True
+    else:
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+        server = _UnixHTTPServer(address, handler)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    print(f"Metrics served on {address}")
+    return server
@@ -0,0 +1,412 @@
+import csv
+from datetime import datetime
+from pathlib import Path
+import sys
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.patches as patches
+from matplotlib.animation import FuncAnimation
+from matplotlib.widgets import Slider
+
+from recording import FrameRecorder
+from stats_retention import find_stats_file, uncompressed
+
+
+FRAME_DTYPE = np.dtype([
+    ('t', '<f8'),
+    ('wall', '<f8'),
+    ('radar', 'u1'),
+    ('frame', 'u1', 30),
+])
+assert FRAME_DTYPE.itemsize == FrameRecorder.RECORD.size
+
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets downsampling: keeps the first and last
+    # points and from every bucket in between the point forming the largest
+    # triangle with the previous pick and the mean of the next bucket, so
+    # peaks and steps survive. NaNs in `y` are dropped first.
+    ok = ~np.isnan(y)
+    x = x[ok]
+    y = y[ok]
+
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+
+    out = np.empty(n_out, dtype=int)
+    out[0] = 0
+    out[-1] = n - 1
+
+    a = 0
+    for k in range(n_out - 2):
+        lo, hi = edges[k], edges[k+1]
+
+        if k + 2 < len(edges):
+            nlo, nhi = edges[k+1], edges[k+2]
+        else:
+            nlo, nhi = n - 1, n
+        cx = x[nlo:nhi].mean()
+        cy = y[nlo:nhi].mean()
+
+        bx = x[lo:hi]
+        by = y[lo:hi]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+
+        a = lo + int(np.argmax(area))
+        out[k+1] = a
+
+    return x[out], y[out]
+
+
+def decode_targets(frames):
+    # Vectorized LD2450.parse_frame() for an (n, 30) array of frames:
+    # x and y of the three targets as (n, 3) float arrays, NaN where a slot
+    # is empty.
+    payload = frames[:, 4:28].astype(np.int32).reshape(-1, 3, 8)
+
+    def int16(lo, hi):
+        v = payload[:, :, lo] | (payload[:, :, hi] << 8)
+        return np.where(v >= 2**15, v - 2**15, -v).astype(float)
+
+    x = int16(0, 1)
+    y = int16(2, 3)
+
+    empty = (x == 0) | (y == 0)
+    x[empty] = np.nan
+    y[empty] = np.nan
+    return x, y
+
+
+def load_frames(path):
+    # Compressed recordings of finished sessions are read into memory.
+    base, opener = uncompressed(path)
+    if base != Path(path):
+        with opener(path, "rb") as f:
+            return np.frombuffer(f.read(), dtype=FRAME_DTYPE)
+    return np.memmap(path, dtype=FRAME_DTYPE, mode='r')
+
+
+def load_stats(csv_path):
+    # Stats CSVs are converted once into a .npy cache next to them, which is
+    # memory-mapped from then on. Repeated headers (the file is appended to
+    # on every start) and broken lines are skipped. The CSV may have been
+    # compressed by stats retention.
+    csv_path = find_stats_file(csv_path)
+    base, opener = uncompressed(csv_path)
+    npy_path = base.with_suffix(".npy")
+
+    # An empty cache may be left from a file the columns were not known of.
+    if npy_path.exists() and npy_path.stat().st_mtime >= csv_path.stat().st_mtime:
+        stats = np.load(npy_path, mmap_mode='r')
+        if len(stats):
+            return stats
+
+    with opener(csv_path, "rt") as f:
+        header = f.readline().strip().split(",")
+        n_rows = sum(1 for _ in f)
+
+    # Stats from before units have 'both_present' for 'present'.
+    header = ["present" if c == "both_present" else c for c in header]
+
+    prefixes = {c.split("_")[0] for c in header}
+    radars = sorted(
+        (p for p in prefixes if p.startswith("r") and p[1:].isdigit()),
+        key=lambda r: int(r[1:]))
+    required = ["timestamp", "glass_on", "present"]
+    for r in radars:
+        required += [f"{r}_distance_reliable", f"{r}_angle_abs_reliable",
+                     f"{r}_human_present_reliable"]
+    missing = [c for c in required if c not in header]
+    if missing:
+        raise Exception(f"Stats '{csv_path}' miss columns {', '.join(missing)}.")
+    fields = [('t', '<f8'), ('glass_on', 'u1'), ('present', 'u1')]
+    for r in radars:
+        fields += [
+            (f'{r}_distance_reliable', '<f4'),
+            (f'{r}_angle_abs_reliable', '<f4'),
+            (f'{r}_human_present_reliable', 'u1')]
+    dtype = np.dtype(fields)
+
+    def value(v):
+        if v == "True":
+            return 1
+        if v == "False":
+            return 0
+        if v in ("None", ""):
+            return np.nan
+        return float(v)
+
+    tmp_path = npy_path.with_suffix(".npy.tmp")
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(n_rows,))
+    n = 0
+    with opener(csv_path, "rt") as f:
+        for row in csv.DictReader(f, fieldnames=header):
+            try:
+                rec = [datetime.fromisoformat(row['timestamp']).timestamp(),
+                       value(row['glass_on']), value(row['present'])]
+                for r in radars:
+                    rec += [value(row[f'{r}_distance_reliable']),
+                            value(row[f'{r}_angle_abs_reliable']),
+                            value(row[f'{r}_human_present_reliable'])]
+            except:
+                continue
+
+            out[n] = tuple(rec)
+            n += 1
+
+    out.flush()
+    del out
+
+    # Keep only the rows actually converted.
+    np.save(npy_path, np.load(tmp_path, mmap_mode='r')[:n])
+    tmp_path.unlink()
+
+    return np.load(npy_path, mmap_mode='r')
+
+
+class Playback():
+    FPS                   = 20
+    TRAIL_TIME            = 2.0
+    SEEK_STEP             = 10.0
+
+    # Points of each overview timeline series.
+    OVERVIEW_POINTS       = 2000
+
+    # Records per chunk when scanning a memory-mapped recording.
+    CHUNK                 = 1 << 18
+
+    SPEEDS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+
+    COLORS = [(1,0,0), (0,0.6,0)]
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        base, _ = uncompressed(self.path)
+        if base.suffix == FrameRecorder.SUFFIX:
+            self.frames = load_frames(self.path)
+            self.stats = None
+            self._index_frames()
+        elif base.suffix in (".csv", ".npy"):
+            self.frames = None
+            self.stats = load_stats(base.with_suffix(".csv"))
+            self._index_stats()
+        else:
+            raise Exception(f"Unknown recording type '{base.suffix}'.")
+
+        if not len(self.t):
+            raise Exception(f"Recording '{self.path}' is empty.")
+
+        self.t0 = self.t[0]
+        self.duration = self.t[-1] - self.t0
+
+        self.pos = 0.0
+        self.speed_i = self.SPEEDS.index(1)
+        self.paused = False
+
+        self.x = 3000
+        self.y = 3000
+        self.ps = 1000
+        self.fs = 14
+
+    def _index_frames(self):
+        # One pass over the mapped file builds the time index and the
+        # nearest target distance per radar for the overview; the frames
+        # themselves stay on disk.
+        n = len(self.frames)
+        self.t = np.empty(n)
+        self.radar = np.empty(n, dtype=np.uint8)
+        nearest = np.empty(n, dtype=np.float32)
+
+        for lo in range(0, n, self.CHUNK):
+            chunk = self.frames[lo:lo+self.CHUNK]
+            self.t[lo:lo+len(chunk)] = chunk['t']
+            self.radar[lo:lo+len(chunk)] = chunk['radar']
+
+            x, y = decode_targets(chunk['frame'])
+            with np.errstate(all='ignore'):
+                d = np.sqrt(x**2 + y**2)
+            d[np.isnan(d)] = np.inf
+            d = d.min(axis=1)
+            d[np.isinf(d)] = np.nan
+            nearest[lo:lo+len(chunk)] = d
+
+        self.n_radars = int(self.radar.max()) + 1 if n else 0
+        self.overview = []
+        for i in range(self.n_radars):
+            sel = self.radar == i
+            self.overview.append(
+                (f"radar {i+1} nearest, mm",
+                 *lttb(self.t[sel] - self.t[0], nearest[sel].astype(float), self.OVERVIEW_POINTS)))
+
+    def _index_stats(self):
+        self.t = np.ascontiguousarray(self.stats['t'])
+        names = [n for n in self.stats.dtype.names if n.endswith("_distance_reliable")]
+        self.n_radars = len(names)
+
+        self.overview = []
+        for name in names:
+            r = name.split("_")[0]
+            self.overview.append(
+                (f"{r} distance, mm",
+                 *lttb(self.t - self.t[0], self.stats[name].astype(float), self.OVERVIEW_POINTS)))
+
+        glass = self.stats['glass_on'].astype(float) * 1000
+        self.overview.append(
+            ("glass on", *lttb(self.t - self.t[0], glass, self.OVERVIEW_POINTS)))
+
+    def _window(self, t_from, t_to):
+        i = np.searchsorted(self.t, self.t0 + t_from, side='left')
+        j = np.searchsorted(self.t, self.t0 + t_to, side='right')
+        return i, j
+
+    def _render_frames(self):
+        i, j = self._window(self.pos - self.TRAIL_TIME, self.pos)
+        chunk = self.frames[i:j]
+        x, y = decode_targets(chunk['frame'])
+        age = self.pos - (chunk['t'] - self.t0)
+
+        for k in range(self.n_radars):
+            r, g, b = self.COLORS[k % len(self.COLORS)]
+            sel = chunk['radar'] == k
+
+            xs, ys = x[sel], y[sel]
+            alpha = np.repeat(0.5 * (1 - age[sel] / self.TRAIL_TIME), 3)
+            ok = ~np.isnan(xs.ravel())
+            offsets = np.column_stack([xs.ravel()[ok], ys.ravel()[ok]])
+            colors = [(r, g, b, max(0.0, a)) for a in alpha[ok]]
+            self.trail_sc[k].set_offsets(offsets if len(offsets) else [[None, None]])
+            self.trail_sc[k].set_facecolors(colors or [(r, g, b, 0)])
+
+            if sel.any():
+                last = np.flatnonzero(sel)[-1]
+                ok = ~np.isnan(x[last])
+                cur = np.column_stack([x[last][ok], y[last][ok]])
+                n_targets = len(cur)
+            else:
+                cur = []
+                n_targets = 0
+            self.target_sc[k].set_offsets(cur if len(cur) else [[None, None]])
+            self.texts[k].set_text(f"Radar {k+1}: {n_targets} targets")
+
+    def _render_stats(self):
+        i, _ = self._window(self.pos, self.pos)
+        row = self.stats[max(0, i - 1)]
+
+        for k in range(self.n_radars):
+            r = f"r{k+1}"
+            d = row[f'{r}_distance_reliable']
+            a = row[f'{r}_angle_abs_reliable']
+            self.texts[k].set_text(f"Radar {k+1}: {d:6.0f} mm, {a:4.0f} °")
+
+            present = row[f'{r}_human_present_reliable']
+            self.rects[k].set_facecolor((1,0,0,0.2) if present else (1,0,0,0))
+
+        self.glass.set_facecolor((0,0,0) if row['glass_on'] else (1,1,1))
+
+    def render(self, _):
+        if not self.paused:
+            self.pos = min(self.duration, self.pos + self.SPEEDS[self.speed_i] / self.FPS)
+            if self.pos >= self.duration:
+                self.paused = True
+
+        if self.frames is not None:
+            self._render_frames()
+        else:
+            self._render_stats()
+
+        self.cursor.set_xdata([self.pos, self.pos])
+
+        # The slider callback is for scrubbing only.
+        self._scrubbing = False
+        self.slider.set_val(self.pos)
+        self._scrubbing = True
+
+        state = "paused" if self.paused else f"x{self.SPEEDS[self.speed_i]:g}"
+        self.status.set_text(f"{self.pos:9.1f} / {self.duration:.1f} s  {state}")
+
+    def on_slider(self, val):
+        if self._scrubbing:
+            self.pos = val
+
+    def on_key(self, event):
+        if event.key == ' ':
+            self.paused = not self.paused
+        elif event.key in ('+', 'up'):
+            self.speed_i = min(len(self.SPEEDS) - 1, self.speed_i + 1)
+        elif event.key in ('-', 'down'):
+            self.speed_i = max(0, self.speed_i - 1)
+        elif event.key == 'right':
+            self.pos = min(self.duration, self.pos + self.SEEK_STEP * self.SPEEDS[self.speed_i])
+        elif event.key == 'left':
+            self.pos = max(0.0, self.pos - self.SEEK_STEP * self.SPEEDS[self.speed_i])
+
+    def start(self):
+        fig = plt.figure(figsize=(15,10))
+        ax = fig.add_axes([0.06, 0.35, 0.9, 0.6])
+        ax_tl = fig.add_axes([0.06, 0.1, 0.9, 0.18])
+        ax_sl = fig.add_axes([0.06, 0.03, 0.9, 0.03])
+
+        ax.grid(True)
+        ax.set_xlim(-self.x, self.x)
+        ax.set_ylim(-self.y, self.y)
+        ax.set_xlabel('x, mm')
+        ax.set_ylabel('y, mm')
+        ax.set_title(self.path.name)
+
+        self.rects = [
+            patches.Rectangle((-self.x, self.y), self.x*2, self.y, linewidth=0, facecolor=(1,0,0,0)),
+            patches.Rectangle((-self.x, 0), self.x*2, self.y, linewidth=0, facecolor=(1,0,0,0)),
+        ]
+        for rect in self.rects:
+            ax.add_patch(rect)
+
+        glass_w = 500
+        glass_h = 200
+        self.glass = patches.Rectangle(
+            (-glass_w, glass_h), glass_w*2, glass_h*2, linewidth=3, facecolor=(1,1,1))
+        ax.add_patch(self.glass)
+
+        colors = [self.COLORS[k % len(self.COLORS)] for k in range(self.n_radars)]
+        self.trail_sc = [ax.scatter([], [], s=self.ps/4, linewidths=0) for _ in colors]
+        self.target_sc = [ax.scatter([], [], c=[c], s=self.ps) for c in colors]
+        self.texts = [
+            ax.text(-self.x+100, self.y-250*(k+1), '', fontsize=self.fs)
+            for k in range(self.n_radars)]
+        self.status = ax.text(self.x-2500, -self.y+250, '', fontsize=self.fs)
+
+        for label, xs, ys in self.overview:
+            ax_tl.plot(xs, ys, linewidth=1, label=label)
+        ax_tl.set_xlim(0, self.duration)
+        ax_tl.set_xlabel('t, s')
+        ax_tl.legend(loc='upper right', fontsize=8)
+        self.cursor = ax_tl.axvline(0, color='k')
+
+        self._scrubbing = True
+        self.slider = Slider(ax_sl, '', 0, self.duration, valinit=0)
+        self.slider.on_changed(self.on_slider)
+
+        fig.canvas.mpl_connect('key_press_event', self.on_key)
+
+        self.ani = FuncAnimation(
+            fig=fig, func=self.render, interval=1000 / self.FPS,
+            cache_frame_data=False)
+
+        plt.show()
+
+
+if __name__ == "__main__":
+    try:
+        path = sys.argv[1]
+    except:
+        print("No path for recording provided")
+        sys.exit(1)
+
+    print("Keys: space - pause, up/down - speed, left/right - seek")
+
+    playback = Playback(path)
+    playback.start()
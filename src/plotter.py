@@ -1,26 +1,64 @@
 from datetime import datetime, timedelta
 from pathlib import Path
+import selectors
 import sys
+import threading
+import time
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from matplotlib.animation import FuncAnimation
 
+from config_watcher import ConfigWatcher
 from glass_radar import GlassRadar
-import utils
+from radar_hub import hub_path
+from recording import FrameRecorder
+from ring_buffer import RingBuffer
 
 
 class Plotter():
-    def __init__(self, cfg_path):
+    FPS                   = 20
+    FRAME_TIMEOUT         = 1.0
+    RECOVER_POLL          = 0.1
+
+    # Seconds of target history drawn as fading trails; the ring holds more
+    # than that for both radars at ~10 Hz each.
+    TRAIL_TIME            = 2.0
+    RING_SIZE             = 256
+
+    COLORS = [(1,0,0), (0,0.6,0)]
+
+    def __init__(self, cfg_path, rec_path=None):
         self.dt = None
 
         self.cfg_path = Path(cfg_path)
-        self.cfg_mtime = self.cfg_path.stat().st_mtime
-        self.cfg = utils.load_json(self.cfg_path)
 
-        self.radar_1 = GlassRadar(self.cfg['radar_1'])
-        self.radar_2 = GlassRadar(self.cfg['radar_2'])
+        self.cfg_watcher = ConfigWatcher(self.cfg_path)
+        self.cfg = self.cfg_watcher.cfg
+
+        # Runs next to the controller when both read through the radar hub.
+        hub = hub_path(self.cfg)
+        self.radar_1 = GlassRadar(self.cfg['radar_1'], hub=hub and (hub, 'radar_1'))
+        self.radar_2 = GlassRadar(self.cfg['radar_2'], hub=hub and (hub, 'radar_2'))
+        self.radars = [self.radar_1, self.radar_2]
+
+        self.cfg_watcher.subscribe(
+            'radar_1', self.radar_1.configure, GlassRadar.CFG_KEYS)
+        self.cfg_watcher.subscribe(
+            'radar_2', self.radar_2.configure, GlassRadar.CFG_KEYS)
 
+        # Records (time, radar index, targets, distance_reliable,
+        # angle_abs_reliable, human_present) written by the acquisition
+        # thread and read by the renderer.
+        self.ring = RingBuffer(self.RING_SIZE)
+
+        # Raw frames for playback.py, if asked for.
+        self.rec = None
+        if rec_path is not None:
+            self.rec = FrameRecorder(rec_path)
+        self.frame_ts = [time.monotonic()] * len(self.radars)
+
+        self.both_present = False
         self.state = 0
         self.no_cmd_until_dt = datetime.now()
 
@@ -29,152 +67,166 @@ class Plotter():
         self.ps = 1000
         self.fs = 20
 
-    def check_config(self):
-        cfg_mtime = self.cfg_path.stat().st_mtime
-        if cfg_mtime != self.cfg_mtime:
-            text = f"{self.dt}: exiting due to config file change"
-            print(text)
-            sys.exit(1)
-
-    def process(self, frame):
-        self.dt = datetime.now()
-        self.check_config()
-
-        f1 = self.radar_1.process()
-        if not f1:
-            if self.radar_1.n_frame_failures >= self.RADAR_MAX_FRAME_FAILURES:
-                text = f"{self.dt}: exiting due to radar 1 failures"
-                print(text)
-                sys.exit(1)
-            return
-
-        f2 = self.radar_2.process()
-        if not f2:
-            if self.radar_2.n_frame_failures >= self.RADAR_MAX_FRAME_FAILURES:
-                text = f"{self.dt}: exiting due to radar 2 failures"
-                print(text)
-                sys.exit(1)
-            return
-
-        both_present = self.radar_1.human_present and self.radar_2.human_present
-
-        #####
-
-        if self.radar_1.t_raw is None:
-            offsets1 = [[None, None]]
-        else:
-            offsets1 = [list(self.radar_1.t_raw)]
-        self.sc1.set_offsets(offsets1)
-
-        if self.radar_1.distance_reliable:
-            d1t = f'Distance: {self.radar_1.distance_reliable:6.0f} mm'
-        else:
-            d1t =  'Distance: -- mm'
-        self.d1.set_text(d1t)
-
-        if self.radar_1.angle_abs_reliable:
-            a1t = f'Angle: {self.radar_1.angle_abs_reliable:4.0f} °'
-        else:
-            a1t =  'Angle: -- °'
-        self.a1.set_text(a1t)
-
-        if self.radar_2.t_raw is None:
-            offsets2 = [[None, None]]
-        else:
-            offsets2 = [list(self.radar_2.t_raw)]
-        self.sc2.set_offsets(offsets2)
-
-        if self.radar_1.human_present:
-            c1 = (1,0,0,0.2)
-        else:
-            c1 = (1,0,0,0)
-        self.rect1.set_facecolor(c1)
-
-        if self.radar_2.distance_reliable:
-            d2t = f'Distance: {self.radar_2.distance_reliable:6.0f} mm'
-        else:
-            d2t =  'Distance: -- mm'
-        self.d2.set_text(d2t)
-
-        if self.radar_2.angle_abs_reliable:
-            a2t = f'Angle: {self.radar_2.angle_abs_reliable:4.0f} °'
-        else:
-            a2t =  'Angle: -- °'
-        self.a2.set_text(a2t)
-
-        if self.radar_2.human_present:
-            c2 = (1,0,0,0.2)
-        else:
-            c2 = (1,0,0,0)
-        self.rect2.set_facecolor(c2)
-
-        if both_present:
+    def acquire(self):
+        # Runs in a background thread, so a stalled radar never blocks the
+        # GUI; the renderer only sees what is in the ring.
+        selector = selectors.DefaultSelector()
+        for i, radar in enumerate(self.radars):
+            selector.register(radar.fileno(), selectors.EVENT_READ, i)
+
+        while True:
+            timeout = self.FRAME_TIMEOUT
+            if not all(radar.online for radar in self.radars):
+                timeout = self.RECOVER_POLL
+            events = selector.select(timeout=timeout)
+
+            self.dt = datetime.now()
+            self.cfg_watcher.check()
+
+            # Failed radars are reconnected in place.
+            for i, radar in enumerate(self.radars):
+                if not radar.online and radar.try_recover():
+                    selector.register(radar.fileno(), selectors.EVENT_READ, i)
+
+            for key, _ in events:
+                i = key.data
+                radar = self.radars[i]
+
+                try:
+                    frames = radar.read_frames()
+                except OSError as e:
+                    selector.unregister(key.fd)
+                    radar.go_offline(e)
+                    continue
+                read_wall = time.time() - (time.monotonic() - radar.read_ts)
+
+                for frame in frames:
+                    if self.rec is not None:
+                        self.rec.write(i, frame, radar.read_ts, read_wall)
+
+                    targets = radar.decode(frame)
+                    if not radar.update(targets):
+                        continue
+
+                    t = time.monotonic()
+                    self.frame_ts[i] = t
+                    self.ring.append((
+                        t,
+                        i,
+                        tuple(targets),
+                        radar.distance_reliable,
+                        radar.angle_abs_reliable,
+                        radar.human_present))
+
+                if radar.n_frame_failures >= radar.MAX_FRAME_FAILURES:
+                    selector.unregister(key.fd)
+                    radar.go_offline(f"radar {i+1} failures")
+
+            both_present = self.radar_1.human_present and self.radar_2.human_present
+            self.both_present = both_present
+
+            cmd = None
+            if (self.state != 1) and both_present:
+                cmd = 1
+            elif (self.state != 0) and (not both_present):
+                cmd = 0
+
+            if (cmd is not None) and (self.dt > self.no_cmd_until_dt):
+                self.state = cmd
+                self.no_cmd_until_dt = self.dt + timedelta(seconds=3)
+
+            if events:
+                self.stats = [
+                    self.dt,
+
+                    self.radar_1.in_waiting,
+                    self.radar_1.distance_raw,
+                    self.radar_1.distance_reliable,
+                    self.radar_1.angle_abs_raw,
+                    self.radar_1.angle_abs_reliable,
+
+                    self.radar_2.in_waiting,
+                    self.radar_2.distance_raw,
+                    self.radar_2.distance_reliable,
+                    self.radar_2.angle_abs_raw,
+                    self.radar_2.angle_abs_reliable,
+
+                    self.state,
+                    both_present,
+                ]
+                print(self.stats)
+
+    def render(self, _):
+        t_now = time.monotonic()
+        records = self.ring.latest()
+
+        trails = [[], []]
+        current = [None, None]
+        for rec in records:
+            t, i, targets, _, _, _ = rec
+            age = t_now - t
+            if age > self.TRAIL_TIME:
+                continue
+
+            alpha = 0.5 * (1 - age / self.TRAIL_TIME)
+            for (x, y) in targets:
+                trails[i].append((x, y, alpha))
+            current[i] = rec
+
+        for i in range(len(self.radars)):
+            r, g, b = self.COLORS[i]
+
+            offsets = [(x, y) for (x, y, _) in trails[i]]
+            colors = [(r, g, b, a) for (_, _, a) in trails[i]]
+            self.trail_sc[i].set_offsets(offsets or [[None, None]])
+            self.trail_sc[i].set_facecolors(colors or [(r, g, b, 0)])
+
+            rec = current[i]
+            stalled = (t_now - self.frame_ts[i]) > self.FRAME_TIMEOUT
+
+            if rec is None or stalled or not rec[2]:
+                self.target_sc[i].set_offsets([[None, None]])
+            else:
+                self.target_sc[i].set_offsets(list(rec[2]))
+
+            if rec is None or stalled:
+                self.d_texts[i].set_text('Distance: -- mm' + (' (stalled)' if stalled else ''))
+                self.a_texts[i].set_text('Angle: -- °')
+                present = False
+            else:
+                _, _, _, distance, angle, present = rec
+                self.d_texts[i].set_text(f'Distance: {distance:6.0f} mm')
+                self.a_texts[i].set_text(f'Angle: {angle:4.0f} °')
+
+            self.rects[i].set_facecolor((1,0,0,0.2) if present else (1,0,0,0))
+
+        if self.both_present:
             glass_c = (0,0,0)
         else:
             glass_c = (1,1,1)
         self.glass.set_facecolor(glass_c)
 
-        #####
-
-        cmd = None
-        if (self.state != 1) and both_present:
-            cmd = 1
-        elif (self.state != 0) and (not both_present):
-            cmd = 0
-
-        if (cmd is not None) and (self.dt > self.no_cmd_until_dt):
-            if cmd == 1:
-                self.state = 1
-            elif cmd == 0:
-                self.state = 0
-
-            self.no_cmd_until_dt = self.dt + timedelta(seconds=3)
-
-        self.stats = [
-            self.dt,
-
-            self.radar_1.in_waiting,
-            self.radar_1.distance_raw,
-            self.radar_1.distance_reliable,
-            self.radar_1.angle_abs_raw,
-            self.radar_1.angle_abs_reliable,
-
-            self.radar_2.in_waiting,
-            self.radar_2.distance_raw,
-            self.radar_2.distance_reliable,
-            self.radar_2.angle_abs_raw,
-            self.radar_2.angle_abs_reliable,
-
-            self.state,
-            both_present,
-        ]
-        print(self.stats)
-
-        return (self.sc1, self.sc2,
-                self.d1, self.d2,
-                self.a1, self.a2)
+        return (*self.rects, self.glass,
+                *self.trail_sc, *self.target_sc,
+                *self.d_texts, *self.a_texts)
 
     def start(self):
+        thread = threading.Thread(target=self.acquire, daemon=True)
+        thread.start()
+
         fig, ax = plt.subplots(figsize=(15,8))
         ax.grid(True)
         ax.set_xlim(-self.x, self.x)
         ax.set_ylim(-self.y, self.y)
         ax.set_xlabel('x, mm')
         ax.set_ylabel('y, mm')
-        
-        self.sc1 = ax.scatter([], [], c='red', s=self.ps)
-        self.d1 = ax.text(self.x-1500, self.y-250, '', fontsize=self.fs)
-        self.a1 = ax.text(self.x-1500, self.y-500, '', fontsize=self.fs)
-        self.rect1 = patches.Rectangle(
-            (-self.x, self.y), self.x*2, self.y, linewidth=0)
-        ax.add_patch(self.rect1)
-        
-        self.sc2 = ax.scatter([], [], c='green', s=self.ps)
-        self.d2 = ax.text(self.x-1500, -self.y+500, '', fontsize=self.fs)
-        self.a2 = ax.text(self.x-1500, -self.y+250, '', fontsize=self.fs)
-        self.rect2 = patches.Rectangle(
-            (-self.x, 0), self.x*2, self.y, linewidth=0)
-        ax.add_patch(self.rect2)
+
+        self.rects = [
+            patches.Rectangle((-self.x, self.y), self.x*2, self.y, linewidth=0),
+            patches.Rectangle((-self.x, 0), self.x*2, self.y, linewidth=0),
+        ]
+        for rect in self.rects:
+            ax.add_patch(rect)
 
         glass_w = 500
         glass_h = 200
@@ -182,7 +234,23 @@ class Plotter():
             (-glass_w, glass_h), glass_w*2, glass_h*2, linewidth=3)
         ax.add_patch(self.glass)
 
-        ani = FuncAnimation(fig=fig, func=self.process, cache_frame_data=False, blit=True)
+        self.trail_sc = [ax.scatter([], [], s=self.ps/4, linewidths=0) for _ in self.radars]
+        self.target_sc = [ax.scatter([], [], c=[c], s=self.ps) for c in self.COLORS]
+
+        self.d_texts = [
+            ax.text(self.x-1500, self.y-250, '', fontsize=self.fs),
+            ax.text(self.x-1500, -self.y+500, '', fontsize=self.fs),
+        ]
+        self.a_texts = [
+            ax.text(self.x-1500, self.y-500, '', fontsize=self.fs),
+            ax.text(self.x-1500, -self.y+250, '', fontsize=self.fs),
+        ]
+
+        # Rendering runs at a fixed rate; with blitting only the artists
+        # returned by render() are redrawn over the cached background.
+        self.ani = FuncAnimation(
+            fig=fig, func=self.render, interval=1000 / self.FPS,
+            cache_frame_data=False, blit=True)
 
         mng = plt.get_current_fig_manager()
         mng.full_screen_toggle()
@@ -197,5 +265,7 @@ if __name__ == "__main__":
         print("No path for configuration provided")
         sys.exit(1)
 
-    plotter = Plotter(cfg_path)
+    rec_path = sys.argv[2] if len(sys.argv) > 2 else None
+
+    plotter = Plotter(cfg_path, rec_path)
     plotter.start()
@@ -0,0 +1,93 @@
+from collections import deque
+import time
+
+import utils
+
+
+class StageTimer():
+    # Times consecutive stages of one sampled iteration. Durations of a stage
+    # marked several times (once per frame, say) are summed.
+
+    def __init__(self, profiler):
+        self._profiler = profiler
+        self._stages = {}
+        self._start_ns = 0
+        self._t_ns = 0
+
+    def start(self):
+        self._stages.clear()
+        self._start_ns = self._t_ns = time.perf_counter_ns()
+        return self
+
+    def mark(self, stage):
+        t_ns = time.perf_counter_ns()
+        self._stages[stage] = self._stages.get(stage, 0) + t_ns - self._t_ns
+        self._t_ns = t_ns
+
+    def finish(self):
+        self._stages["total"] = sum(self._stages.values())
+
+        rings = self._profiler.rings
+        for stage, ns in self._stages.items():
+            try:
+                rings[stage].append(ns)
+            except KeyError:
+                rings[stage] = deque([ns], maxlen=self._profiler.window)
+
+
+class StageProfiler():
+    # Samples one iteration out of `sample_every` and keeps the last
+    # `window` durations of every stage for rolling percentiles. Callers hold
+    # None instead of a profiler when profiling is off, so the hot path pays
+    # a single truth test:
+    #
+    #     p = self.prof and self.prof.sample()
+    #     ...
+    #     if p:
+    #         p.mark("read")
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, name, sample_every=100, window=1000):
+        self.name = name
+        self.sample_every = max(1, sample_every)
+        self.window = window
+
+        self.rings = {}
+        self.n_iterations = 0
+
+        self._n = 0
+        self._timer = StageTimer(self)
+
+    def sample(self):
+        self.n_iterations += 1
+
+        self._n += 1
+        if self._n < self.sample_every:
+            return None
+        self._n = 0
+
+        return self._timer.start()
+
+    def summary(self):
+        # {stage: (n, p50, p90, p99, max)} with times in microseconds.
+        res = {}
+        for stage, ring in list(self.rings.items()):
+            values = list(ring)
+            if not values:
+                continue
+
+            ps = [utils.percentile(values, p) / 1e3 for p in self.PERCENTILES]
+            res[stage] = (len(values), *ps, max(values) / 1e3)
+
+        return res
+
+    def dump(self):
+        text = (f"Profile '{self.name}' ({self.n_iterations} iterations, "
+                f"1 in {self.sample_every} sampled), us:")
+        text += f"\n{'stage':>10} | {'n':>6} | {'p50':>8} | {'p90':>8} | {'p99':>8} | {'max':>8}"
+
+        for stage, (n, p50, p90, p99, pmax) in self.summary().items():
+            text += f"\n{stage:>10} | {n:6} | {p50:8.1f} | {p90:8.1f} | {p99:8.1f} | {pmax:8.1f}"
+
+        print(text)
@@ -0,0 +1,204 @@
+import os
+import pty
+import random
+import struct
+import sys
+import threading
+import time
+import tty
+
+from radar_ld2450 import LD2450
+
+
+def encode_int16(v):
+    # Sign in the top bit, set for positive values, as the radar sends it.
+    if v >= 0:
+        return v + 2**15
+    return -v
+
+
+def encode_frame(targets):
+    # Data frame for up to three (x, y, speed) targets in mm and cm/s.
+    payload = b""
+    for i in range(3):
+        if i < len(targets):
+            x, y, speed = targets[i]
+            payload += struct.pack(
+                "<4H", encode_int16(int(x)), encode_int16(int(y)), encode_int16(int(speed)), 360)
+        else:
+            payload += bytes(8)
+    return LD2450.DATA_HEADER + payload + LD2450.DATA_EOF
+
+
+def walker(t, period=20.0, far=4000, near=500, x=50):
+    # One person walking up to the glass, standing, and leaving again,
+    # every `period` seconds.
+    walk = 0.3 * period
+    stand = 0.2 * period
+    v = (far - near) / walk
+
+    phase = t % period
+    if phase < walk:
+        y = far - v * phase
+        speed = -v / 10
+    elif phase < walk + stand:
+        y = near
+        speed = 0
+    elif phase < 2 * walk + stand:
+        y = near + v * (phase - walk - stand)
+        speed = v / 10
+    else:
+        return []
+
+    # Radar noise.
+    return [(x + random.randint(-5, 5), y + random.randint(-5, 5), speed)]
+
+
+class RadarEmulator():
+    # LD2450 on a pseudo terminal: streams data frames for a scenario,
+    # `scenario(t)` returning the targets at emulated time t, and answers
+    # commands. With `speed` above 1 emulated time runs that much faster
+    # and frames come that much more often.
+
+    RATE = 10.0
+
+    # Firmware version, MAC address and tracking mode answered to queries.
+    FIRMWARE = bytes([0x00, 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06])
+    MAC = bytes([0x01, 0x02, 0x03, 0x04, 0x05, 0x06])
+
+    def __init__(self, scenario=walker, speed=1.0, ack_delay=0.01):
+        self.scenario = scenario
+        self.speed = speed
+        self.ack_delay = ack_delay
+
+        self._master, slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+
+        # The slave end stays open, so that the radar side survives the
+        # reader closing and reopening its port.
+        self._slave = slave
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pause_until = 0.0
+        self._config = False
+
+        self.t0 = time.monotonic()
+        self.frames_total = 0
+        self.cmds_total = 0
+
+        for target in (self._stream, self._answer):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+
+    def now(self):
+        return (time.monotonic() - self.t0) * self.speed
+
+    def _write(self, data):
+        with self._lock:
+            try:
+                os.write(self._master, data)
+            except OSError:
+                pass
+
+    def _stream(self):
+        period = 1 / (self.RATE * self.speed)
+        next_ts = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() >= self._pause_until:
+                self._write(encode_frame(self.scenario(self.now())))
+                self.frames_total += 1
+
+            next_ts += period
+            delay = next_ts - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_ts = time.monotonic()
+
+    def glitch(self, n=8, pause=None):
+        # Sends `n` frames with a broken end and goes silent for `pause`
+        # seconds, as a radar does on a loose connector.
+        if pause is None:
+            pause = 0.5
+        self._pause_until = time.monotonic() + pause
+
+        bad = encode_frame([])[:-2] + b"\x00\x00"
+        self._write(bad * n)
+
+    def _answer(self):
+        buf = b""
+        while not self._stop.is_set():
+            try:
+                buf += os.read(self._master, 256)
+            except OSError:
+                return
+
+            while True:
+                i = buf.find(LD2450.CMD_HEADER)
+                if i < 0 or len(buf) < i + 6:
+                    break
+                n = int.from_bytes(buf[i+4:i+6], byteorder='little')
+                j = i + 10 + n
+                if len(buf) < j:
+                    break
+
+                cmd = buf[i:j]
+                buf = buf[j:]
+                self._reply(int.from_bytes(cmd[6:8], byteorder='little'))
+
+    def _reply(self, word):
+        time.sleep(self.ack_delay)
+        self.cmds_total += 1
+
+        status = 0
+        value = b""
+        if word == 0x00FF:
+            self._config = True
+            value = bytes([0x01, 0x00, 0x40, 0x00])
+        elif word == 0x00FE:
+            self._config = False
+        elif word == 0x00A3:
+            # Restart: out of configuration mode and silent for a moment.
+            self._config = False
+            self._pause_until = time.monotonic() + 0.5
+        elif not self._config:
+            status = 1
+        elif word == 0x00A0:
+            value = self.FIRMWARE
+        elif word == 0x00A5:
+            value = self.MAC
+        elif word == 0x0091:
+            value = bytes([0x02, 0x00])
+
+        body = (word | LD2450.CMD_ACK_BIT).to_bytes(2, byteorder='little') + \
+            status.to_bytes(2, byteorder='little') + value
+        self._write(LD2450.CMD_HEADER + len(body).to_bytes(2, byteorder='little') +
+                    body + LD2450.CMD_EOF)
+
+    def close(self):
+        self._stop.set()
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    # Emulated radars for trying tools without hardware; their devices are
+    # printed for the config.
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    emulators = [RadarEmulator(speed=speed) for _ in range(n)]
+    for i, emu in enumerate(emulators):
+        print(f"Radar {i+1}: {emu.path}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nExiting...\n")
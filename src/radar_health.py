@@ -0,0 +1,136 @@
+import math
+
+from clock import SYSTEM_CLOCK
+
+
+class DecayedRate():
+    # Events per second over roughly the last `tau` seconds: the count
+    # decays exponentially, so each update costs the same however long the
+    # history.
+
+    def __init__(self, tau, ts, rate=0.0):
+        self.tau = tau
+        self.ts = ts
+        self.count = rate * tau
+
+    def add(self, n, ts):
+        if ts > self.ts:
+            self.count *= math.exp(-(ts - self.ts) / self.tau)
+            self.ts = ts
+        self.count += n
+
+    @property
+    def rate(self):
+        return self.count / self.tau
+
+
+class RadarHealth():
+    # Rolling health of one radar from its frame rate, invalid frames,
+    # stuck frames and serial backlog, scored 0 (useless) to 1 (fine). The
+    # radar turns unhealthy once its score stays below DEGRADE_SCORE for
+    # DEGRADE_TIME and healthy again after RECOVER_TIME above
+    # RECOVER_SCORE; an offline radar is unhealthy right away.
+
+    # Time constant of the rates, s, and the weight of a new frame in the
+    # stuck ratio and of a new read in the backlog.
+    TAU                   = 5.0
+    FRAME_ALPHA           = 0.02
+    BACKLOG_ALPHA         = 0.1
+
+    # Frames come at ~10 Hz; fewer than RATE_OK lower the score. More than
+    # BACKLOG_OK bytes waiting at a read mean the reader falls behind.
+    RATE_OK               = 8.0
+    BACKLOG_OK            = 90
+
+    DEGRADE_SCORE         = 0.5
+    DEGRADE_TIME          = 2.0
+    RECOVER_SCORE         = 0.8
+    RECOVER_TIME          = 10.0
+
+    def __init__(self, name, ts, clock=None):
+        self.name = name
+        self.clock = SYSTEM_CLOCK if clock is None else clock
+
+        self.frames = DecayedRate(self.TAU, ts, rate=self.RATE_OK)
+        self.invalid = DecayedRate(self.TAU, ts)
+        self.stuck_ratio = 0.0
+        self.backlog = 0.0
+
+        self._invalid_total = None
+
+        self.score = 1.0
+        self.healthy = True
+        self.transitions_total = 0
+
+        # Since when the score has been on the other side of the threshold.
+        self._cross_ts = None
+
+    def update(self, ts, radar, n_frames, n_stuck):
+        # After a read of `n_frames` frames, `n_stuck` of them with the
+        # radar stuck.
+        self.frames.add(n_frames, ts)
+
+        invalid_total = radar.invalid_frames_total
+        if self._invalid_total is not None:
+            self.invalid.add(invalid_total - self._invalid_total, ts)
+        self._invalid_total = invalid_total
+
+        for k in range(n_frames):
+            stuck = 1.0 if k < n_stuck else 0.0
+            self.stuck_ratio += self.FRAME_ALPHA * (stuck - self.stuck_ratio)
+
+        self.backlog += self.BACKLOG_ALPHA * (radar.last_in_waiting - self.backlog)
+
+    def _score(self, ts):
+        # Rates decay up to now, so a silent radar loses its score.
+        self.frames.add(0, ts)
+        self.invalid.add(0, ts)
+
+        frame_rate = self.frames.rate
+        invalid_rate = self.invalid.rate
+
+        score = min(1.0, frame_rate / self.RATE_OK)
+        if invalid_rate > 0:
+            score *= frame_rate / (frame_rate + invalid_rate)
+        score *= 1.0 - self.stuck_ratio
+        score *= min(1.0, self.BACKLOG_OK / max(self.backlog, self.BACKLOG_OK))
+        return score
+
+    def check(self, ts, online):
+        # Updates the score and the health state; True on a state change.
+        if not online:
+            self.score = 0.0
+            self._cross_ts = None
+            return self._set(False, "offline")
+
+        self.score = self._score(ts)
+
+        if self.healthy:
+            crossed = self.score < self.DEGRADE_SCORE
+            hold = self.DEGRADE_TIME
+        else:
+            crossed = self.score > self.RECOVER_SCORE
+            hold = self.RECOVER_TIME
+
+        if not crossed:
+            self._cross_ts = None
+            return False
+
+        if self._cross_ts is None:
+            self._cross_ts = ts
+        if ts - self._cross_ts < hold:
+            return False
+
+        self._cross_ts = None
+        return self._set(not self.healthy, f"score {self.score:.2f}")
+
+    def _set(self, healthy, reason):
+        if healthy == self.healthy:
+            return False
+
+        self.healthy = healthy
+        self.transitions_total += 1
+        print(f"{self.clock.now()}: {self.name} is {'healthy' if healthy else 'degraded'} ({reason}; "
+              f"{self.frames.rate:.1f} frames/s, {self.invalid.rate:.1f} invalid/s, "
+              f"stuck {self.stuck_ratio:.2f}, backlog {self.backlog:.0f} B)")
+        return True
@@ -0,0 +1,447 @@
+from collections import deque
+from datetime import datetime
+import fcntl
+import json
+import os
+from pathlib import Path
+import queue
+import selectors
+import socket
+import sys
+import termios
+import threading
+import time
+import traceback
+
+from config_watcher import ConfigWatcher
+import metrics
+
+sys.stdout.reconfigure(line_buffering=True)
+
+
+MODE_FRAMES = "frames"
+MODE_STATE = "state"
+
+
+class HubSerial():
+    # Stands in for serial.Serial when a radar is read through the hub: the
+    # hub relays whole data frames, so the byte stream is the same as on the
+    # UART and frame assembly works unchanged. Radar commands are the hub's
+    # job; nothing is ever answered here.
+
+    def __init__(self, path, radar_name):
+        self.path = path
+        self.radar_name = radar_name
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError as e:
+            self._sock.close()
+            raise Exception(f"Failed to connect to radar hub '{path}' ({e}).") from None
+
+        self._sock.sendall(f"{radar_name} {MODE_FRAMES}\n".encode())
+
+    @property
+    def in_waiting(self):
+        buf = bytearray(4)
+        fcntl.ioctl(self._sock.fileno(), termios.FIONREAD, buf)
+        n = int.from_bytes(buf, sys.byteorder)
+
+        # A readable socket with nothing to read has been closed by the hub.
+        if n == 0:
+            try:
+                if self._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b"":
+                    raise ConnectionError(f"Radar hub closed '{self.radar_name}'.")
+            except BlockingIOError:
+                pass
+
+        return n
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def read(self, size=1):
+        return self._sock.recv(size)
+
+    def read_until(self, expected=b"\n", size=None):
+        return b""
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        n = self.in_waiting
+        if n:
+            self._sock.recv(n)
+
+    def close(self):
+        self._sock.close()
+
+
+def hub_path(cfg):
+    # Socket of the radar hub if consumers should read radars through it.
+    return cfg.get('radar_hub', {}).get('socket')
+
+
+def iter_states(path, radar_name):
+    # Smoothed state of a radar as published by the hub, one dict per frame.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(f"{radar_name} {MODE_STATE}\n".encode())
+
+    with sock, sock.makefile("r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class Subscriber():
+    # Messages wait in a bounded queue for the sender thread; a slow
+    # subscriber loses its oldest messages and never holds up the hub. The
+    # subscription line is read on the same thread, so a silent client
+    # never stalls the hub loop either.
+
+    def __init__(self, hub, conn, maxlen):
+        self.hub = hub
+        self.conn = conn
+        self.radar_name = None
+        self.mode = None
+
+        self._queue = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.dropped_total = 0
+
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def publish(self, msg):
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped_total += 1
+            self._queue.append(msg)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _handshake(self):
+        # The subscription line follows the connect right away.
+        try:
+            self.conn.settimeout(self.hub.HANDSHAKE_TIMEOUT)
+            with self.conn.makefile("rb") as f:
+                line = f.readline().decode().split()
+            radar_name, mode = line
+            if radar_name not in self.hub.radars or mode not in (MODE_FRAMES, MODE_STATE):
+                raise ValueError(line)
+            self.conn.settimeout(None)
+        except Exception as e:
+            print(f"{datetime.now()}: bad hub subscription ({e})")
+            return False
+
+        self.radar_name = radar_name
+        self.mode = mode
+        return True
+
+    def _run(self):
+        if not self._handshake():
+            self.conn.close()
+            return
+        self.hub.subscribe(self)
+        self._send()
+
+    def _send(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._queue and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+
+                    data = b"".join(self._queue)
+                    self._queue.clear()
+
+                self.conn.sendall(data)
+        except OSError:
+            pass
+        finally:
+            self.conn.close()
+            self.hub.unsubscribe(self)
+
+
+class RadarHub():
+    # Owns the radar UARTs, so that the controller, the plotter and other
+    # tools can run side by side: each radar is read and smoothed once, and
+    # subscribers get its frames or state over a Unix socket.
+
+    FRAME_TIMEOUT         = 1.0
+    HANDSHAKE_TIMEOUT     = 0.2
+    RECOVER_POLL          = 0.1
+
+    def __init__(self, cfg_path):
+        # Imported here, so that hub clients do not pull in the radar code.
+        from glass_radar import GlassRadar
+
+        self.dt = None
+        self.ts = time.monotonic()
+
+        self.cfg_path = Path(cfg_path)
+
+        self.cfg_watcher = ConfigWatcher(self.cfg_path)
+        self.cfg = self.cfg_watcher.cfg
+
+        cfg_hub = self.cfg['radar_hub']
+        self.SOCKET = cfg_hub['socket']
+        if self.SOCKET is None:
+            raise Exception("No socket for radar hub configured.")
+        self.QUEUE = cfg_hub.get('queue', 64)
+        self.radar_names = cfg_hub.get('radars', ["radar_1", "radar_2"])
+
+        self.radars = {}
+        for name in self.radar_names:
+            uartdev = self.cfg[name]['uartdev']
+            if uartdev != "/dev/ttyUSBx":
+                GlassRadar.reserve_device(uartdev)
+        for name in self.radar_names:
+            self.radars[name] = GlassRadar(self.cfg[name])
+            self.cfg_watcher.subscribe(
+                name, lambda cfg, name=name: self._configure_radar(name, cfg),
+                GlassRadar.CFG_KEYS)
+
+        # Radar settings take commands, seconds with retries; they run on a
+        # thread per radar while the radar is out of the loop.
+        self._pending_settings = {}
+        self._configuring = {}
+        self._configured = queue.SimpleQueue()
+
+        # Frame timeouts run on monotonic time, clear of wall clock steps.
+        self.frame_ts = {name: self.ts for name in self.radar_names}
+
+        self._subs_lock = threading.Lock()
+        self.subscribers = {name: [] for name in self.radar_names}
+        self.dropped_total = 0
+
+        reg = metrics.REGISTRY
+        for name in self.radar_names:
+            reg.gauge_func(
+                "glass_hub_subscribers", "Connected hub subscribers.",
+                lambda name=name: len(self.subscribers[name]), radar=name)
+        reg.counter_func(
+            "glass_hub_dropped_total", "Messages dropped for slow subscribers.",
+            lambda: self.dropped_total + sum(
+                s.dropped_total for subs in list(self.subscribers.values()) for s in list(subs)))
+
+        try:
+            os.unlink(self.SOCKET)
+        except FileNotFoundError:
+            pass
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.SOCKET)
+        self._listener.listen()
+        self._listener.setblocking(False)
+
+        print(f"Radar hub listening on '{self.SOCKET}'")
+
+    def cleanup(self):
+        self.cfg_watcher.close()
+
+        self._listener.close()
+        try:
+            os.unlink(self.SOCKET)
+        except:
+            pass
+
+        with self._subs_lock:
+            for subs in self.subscribers.values():
+                for sub in subs:
+                    sub.close()
+
+        for radar in self.radars.values():
+            radar.close()
+
+    def _accept(self):
+        try:
+            conn, _ = self._listener.accept()
+        except BlockingIOError:
+            return
+
+        conn.setblocking(True)
+        Subscriber(self, conn, self.QUEUE)
+
+    def subscribe(self, sub):
+        with self._subs_lock:
+            self.subscribers[sub.radar_name].append(sub)
+        print(f"{datetime.now()}: subscriber for '{sub.radar_name}' ({sub.mode})")
+
+    def unsubscribe(self, sub):
+        with self._subs_lock:
+            subs = self.subscribers[sub.radar_name]
+            if sub in subs:
+                subs.remove(sub)
+                self.dropped_total += sub.dropped_total
+                print(f"{datetime.now()}: subscriber for '{sub.radar_name}' left")
+
+    def _state(self, name, radar, targets):
+        msg = {
+            'ts': time.time() - (time.monotonic() - radar.read_ts),
+            'radar': name,
+            'targets': None if targets is None else list(targets),
+            'stuck': radar.stuck,
+            'distance_raw': radar.distance_raw,
+            'distance_reliable': radar.distance_reliable,
+            'angle_abs_raw': radar.angle_abs_raw,
+            'angle_abs_reliable': radar.angle_abs_reliable,
+            'human_present': radar.human_present,
+            'human_present_reliable': radar.human_present_reliable,
+            'eta': radar.eta,
+        }
+        return (json.dumps(msg) + "\n").encode()
+
+    def _read_radar(self, name):
+        radar = self.radars[name]
+
+        try:
+            frames = radar.read_frames()
+        except OSError as e:
+            self._go_offline(name, e)
+            return
+
+        for frame in frames:
+            data = radar.decode(frame)
+            radar.update(data, radar.read_ts)
+
+            subs = self.subscribers[name]
+            if not subs:
+                continue
+
+            state = None
+            for sub in list(subs):
+                if sub.mode == MODE_FRAMES:
+                    sub.publish(frame)
+                else:
+                    if state is None:
+                        state = self._state(name, radar, data)
+                    sub.publish(state)
+
+        if frames:
+            self.frame_ts[name] = self.ts
+        elif self.ts - self.frame_ts[name] > self.FRAME_TIMEOUT:
+            radar.n_frame_failures += 1
+            self.frame_ts[name] = self.ts
+            print(f"{self.dt}: no data from '{name}'")
+
+        if radar.n_frame_failures >= radar.MAX_FRAME_FAILURES:
+            self._go_offline(name, "failures")
+
+    def _configure_radar(self, name, cfg):
+        # Thresholds take effect at once.
+        self.radars[name].configure(cfg, settings=False)
+        self._pending_settings[name] = cfg
+
+    def _start_settings(self):
+        for name in list(self._pending_settings):
+            radar = self.radars[name]
+            if (name in self._configuring) or not radar.online:
+                continue
+
+            cfg = self._pending_settings.pop(name)
+            self._selector.unregister(radar.fileno())
+            thread = threading.Thread(
+                target=self._apply_settings, args=(name, cfg), daemon=True)
+            self._configuring[name] = thread
+            thread.start()
+
+    def _apply_settings(self, name, cfg):
+        error = None
+        try:
+            self.radars[name].configure_settings(cfg)
+        except Exception as e:
+            error = e
+        self._configured.put((name, error))
+
+    def _finish_settings(self):
+        while True:
+            try:
+                name, error = self._configured.get_nowait()
+            except queue.Empty:
+                return
+
+            del self._configuring[name]
+            radar = self.radars[name]
+            self.frame_ts[name] = self.ts
+            if error is None:
+                self._selector.register(radar.fileno(), selectors.EVENT_READ, name)
+            else:
+                print(f"{self.dt}: '{name}' settings not applied ({error})")
+                radar.go_offline(error)
+
+    def _go_offline(self, name, reason):
+        # Subscribers stay connected and get frames again once the radar is
+        # reconnected.
+        radar = self.radars[name]
+        self._selector.unregister(radar.fileno())
+        radar.go_offline(reason)
+
+    def start(self):
+        metrics.serve(self.cfg['radar_hub'].get('metrics'))
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ, None)
+        for name, radar in self.radars.items():
+            self._selector.register(radar.fileno(), selectors.EVENT_READ, name)
+
+        while True:
+            timeout = self.FRAME_TIMEOUT
+            if self._configuring or not all(radar.online for radar in self.radars.values()):
+                timeout = self.RECOVER_POLL
+            events = self._selector.select(timeout=timeout)
+
+            self.dt = datetime.now()
+            self.ts = time.monotonic()
+            self.cfg_watcher.check()
+            self._finish_settings()
+            self._start_settings()
+            for radar in self.radars.values():
+                radar.maintain_clutter()
+
+            for name, radar in self.radars.items():
+                if name in self._configuring:
+                    continue
+                if not radar.online and radar.try_recover():
+                    self.frame_ts[name] = self.ts
+                    self._selector.register(radar.fileno(), selectors.EVENT_READ, name)
+
+            ready = set()
+            for key, _ in events:
+                if key.data is None:
+                    self._accept()
+                else:
+                    ready.add(key.data)
+
+            for name in self.radar_names:
+                if (name in self._configuring) or not self.radars[name].online:
+                    continue
+                if name in ready or \
+                   self.ts - self.frame_ts[name] > self.FRAME_TIMEOUT:
+                    self._read_radar(name)
+
+
+if __name__ == "__main__":
+    try:
+        cfg_path = sys.argv[1]
+    except:
+        print("No path for configuration provided")
+        sys.exit(1)
+
+    hub = RadarHub(cfg_path)
+
+    try:
+        hub.start()
+    except:
+        traceback.print_exc()
+    finally:
+        hub.cleanup()
@@ -1,8 +1,52 @@
+from array import array
+from collections import deque
 import math
 from datetime import datetime, timedelta
+import selectors
 import serial
+import struct
 import time
 
+import utils
+
+
+class Targets():
+    # Targets of one data frame, filled in place by LD2450.decode_frame(),
+    # so that one record serves all frames of a radar. Slots 0..n-1 are
+    # valid; speed is in cm/s, negative while a target approaches, and d2
+    # is the squared distance in mm^2.
+
+    __slots__ = ("n", "x", "y", "speed", "resolution", "d2")
+
+    N = 3
+
+    def __init__(self):
+        self.n = 0
+        self.x = array('h', bytes(2 * self.N))
+        self.y = array('h', bytes(2 * self.N))
+        self.speed = array('h', bytes(2 * self.N))
+        self.resolution = array('H', bytes(2 * self.N))
+        self.d2 = array('q', bytes(8 * self.N))
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield (self.x[i], self.y[i])
+
+    def full(self):
+        return [(self.x[i], self.y[i], self.speed[i], self.resolution[i])
+                for i in range(self.n)]
+
+    def nearest(self):
+        # Index of the nearest target, -1 if there is none.
+        i_min = -1
+        for i in range(self.n):
+            if (i_min < 0) or (self.d2[i] < self.d2[i_min]):
+                i_min = i
+        return i_min
+
 
 class LD2450():
     CMD_HEADER = bytes([0xFD, 0xFC, 0xFB, 0xFA])
@@ -10,7 +54,28 @@ class LD2450():
 
     DATA_HEADER = bytes([0xAA, 0xFF, 0x03, 0x00])
     DATA_EOF = bytes([0x55, 0xCC])
+    DATA_FRAME_LEN = 30
+
+    # ACK frames answer a command word with the 0x0100 bit set. A length
+    # field above CMD_MAX_LEN is taken for data that looks like a header.
+    CMD_ACK_BIT = 0x0100
+    CMD_MAX_LEN = 64
+    CMD_TIMEOUT = 1.0
+    CMD_RTT_WINDOW = 256
+
+    CMD_START_CONFIGURATION = ([0x00, 0xFF], [0x00, 0x01], True)
+    CMD_END_CONFIGURATION = ([0x00, 0xFE], [], True)
 
+    # x, y, speed and resolution of the three targets, from the end of a
+    # frame on.
+    DATA_TARGETS = struct.Struct("<12H")
+    DATA_TARGETS_OFFSET = -26
+
+    BAUDRATES = [9600, 19200, 38400, 57600, 115200, 230400, 256000, 460800]
+    DEFAULT_BAUDRATE = 256000
+
+    # Detection range, mm, and half the field of view.
+    RANGE = 6000
     ANGLE_ABS_MAX = math.pi / 3
 
     @staticmethod
@@ -18,16 +83,12 @@ class LD2450():
         return " ".join([f"{i:02X}" for i in bs])
 
     @staticmethod
-    def _convert_data_int16(bs, signed):
-        v = int.from_bytes(bs, byteorder='little')
-
-        if signed:
-            if v < 2**15:
-                v = -v
-            else:
-                v = v - 2**15
-
-        return v
+    def _sign_magnitude(v):
+        # The radar sends signed values with the sign in the top bit, set
+        # for positive values.
+        if v < 2**15:
+            return -v
+        return v - 2**15
 
     @staticmethod
     def _is_res_ok(res):
@@ -44,32 +105,81 @@ class LD2450():
         deg = int(rad * 180 / math.pi)
         return deg
 
-    def __init__(self, uartdev, verbose=False):
+    def __init__(self, uartdev, verbose=False, baudrate=DEFAULT_BAUDRATE):
         self.verbose = verbose
+
+        # Host side rate; a rate set on the radar applies from its restart.
+        self.baudrate = baudrate
+        self._baudrate_next = None
         self.n_frame_failures = 0
 
+        # Running totals for monitoring.
+        self.skipped_bytes_total = 0
+        self.invalid_frames_total = 0
+        self.last_in_waiting = 0
+
         self.uartdev = uartdev
         self._ser = self._get_serial()
 
+        self._rx_buf = bytearray()
+        self.read_ts = None
+
+        # Command engine: ACKs by ACK word and data frames received while
+        # waiting for them, which read_frames() hands out later.
+        self._acks = {}
+        self._frames_pending = []
+
+        self.cmd_rtts = deque(maxlen=self.CMD_RTT_WINDOW)
+        self.cmd_timeouts_total = 0
+        self.cmd_nacks_total = 0
+
     def _get_serial(self):
+        # Without a device frames are fed to it directly, as in replays.
+        if self.uartdev is None:
+            return None
+
         try:
-            return serial.Serial(self.uartdev, 256000, timeout=1)
+            return serial.Serial(self.uartdev, self.baudrate, timeout=1)
         except:
             raise Exception(f"Failed to open UART device '{self.uartdev}'.") from None
 
-    def __del__(self):
+    def _close_port(self):
         try:
             self._ser.close()
         except:
             pass
 
+    def close(self):
+        self._close_port()
+
+    def reconnect(self):
+        # Reopens the port and drops any partial frame, so that frame
+        # assembly resyncs on the next header.
+        self._close_port()
+        self._ser = self._get_serial()
+        self._rx_buf.clear()
+        self._acks.clear()
+        self._frames_pending.clear()
+        self.n_frame_failures = 0
+
+    def __del__(self):
+        # The port only; anything else a close() does is left to an
+        # explicit one.
+        self._close_port()
+
     @property
     def in_waiting(self):
+        # Nothing waits on a closed port, e.g. of an offline radar shown
+        # next to a degraded decision.
+        if (self._ser is None) or not self._ser.is_open:
+            return 0
         return self._ser.in_waiting
 
-    def _send_cmd(self, cmd_word, cmd_value, reverse_value=True): 
-        cmd_word_str = self.bs2str(cmd_word)
+    def fileno(self):
+        return self._ser.fileno()
 
+    def _cmd_frame(self, cmd_word, cmd_value, reverse_value=True):
+        # Command frame and the command word as an int.
         cmd_data_len = len(cmd_word + cmd_value)
         cmd_data_len = cmd_data_len.to_bytes(2, byteorder='little')
 
@@ -80,77 +190,124 @@ class LD2450():
             cmd_value = cmd_value[::-1]
 
         cmd = self.CMD_HEADER + cmd_data_len + cmd_word + cmd_value + self.CMD_EOF
-        self._ser.write(cmd)
+        return int.from_bytes(cmd_word, byteorder='little'), cmd
+
+    def _pump(self, selector, timeout):
+        # Waits up to `timeout` for bytes and sorts what came in.
+        if self.in_waiting == 0:
+            selector.select(timeout)
+
+        n = self.in_waiting
+        if n:
+            self._rx_buf += self._ser.read(n)
+        self._frames_pending.extend(self._demux())
+
+    def _await_ack(self, word, t_sent, timeout):
+        # Response to command `word` sent at `t_sent` (perf_counter time),
+        # without the header and end: length, ACK word, status, value.
+        word_str = f"{word:04X}"
+        ack_word = word | self.CMD_ACK_BIT
+        t_end = t_sent + timeout
+
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.fileno(), selectors.EVENT_READ)
+            while True:
+                acks = self._acks.get(ack_word)
+                if acks:
+                    res = acks.popleft()
+                    break
 
-        res = self._ser.read_until(self.CMD_EOF)
+                remaining = t_end - time.perf_counter()
+                if remaining <= 0:
+                    self.cmd_timeouts_total += 1
+                    raise Exception(f"No response to cmd '{word_str}' in {timeout:.2f} s.")
+                self._pump(sel, remaining)
+
+        rtt = time.perf_counter() - t_sent
+        self.cmd_rtts.append((word, rtt))
 
         if self.verbose:
-            print(f"CMD: {self.bs2str(cmd)}\nRESPONSE: {self.bs2str(res)}\n\n")
-        
-        if self.CMD_HEADER in res:
-            res = res.split(self.CMD_HEADER)[-1][:-4]
-        else:
-            raise Exception(f"No header in response to cmd '{cmd_word_str}'.")
+            print(f"RESPONSE {word_str} ({rtt * 1e3:.1f} ms): {self.bs2str(res)}\n")
 
         if not self._is_res_ok(res):
-            raise Exception(f"No acknowledge in response to cmd '{cmd_word_str}'.")
+            self.cmd_nacks_total += 1
+            raise Exception(f"No acknowledge in response to cmd '{word_str}'.")
 
         return res
 
-    def _start_configuration(self):
-        cmd_word = [0x00, 0xFF]
-        cmd_value = [0x00, 0x01]
-        self._send_cmd(cmd_word, cmd_value)
-
-    def _end_configuration(self):
-        cmd_word = [0x00, 0xFE]
-        cmd_value = []
-        self._send_cmd(cmd_word, cmd_value)
-
-    def _execute_cmd(self, cmd_word, cmd_value, reverse_value=True):
-        cmd_word_str = self.bs2str(cmd_word)
-
-        n = 4
-        for l in range(n):
-            for i in range(n):
-                try:
-                    self._start_configuration()
-                    break
-                except Exception as e:
-                    print(f"Failed to start configuration\n{e}")
-            else:
-                raise Exception(f"Failed to start configuration while executing cmd '{cmd_word_str}'.")
+    def _send_cmds(self, cmds, pipeline=True, timeout=None):
+        # Sends (cmd_word, cmd_value, reverse_value) commands and returns
+        # their responses. The first command, entering configuration mode,
+        # is always acknowledged before anything else is written; after
+        # that, pipelined, the rest are written at once and the radar works
+        # through them while earlier ACKs are read, else each command waits
+        # for the previous ACK.
+        if timeout is None:
+            timeout = self.CMD_TIMEOUT
+
+        # Answers to commands that timed out before are stale now.
+        self._acks.clear()
+
+        frames = [self._cmd_frame(*cmd) for cmd in cmds]
+        for word, _ in frames:
+            self._acks[word | self.CMD_ACK_BIT] = deque()
+
+        sent = []
+        res = []
+        for k, (word, cmd) in enumerate(frames):
+            if k == len(sent):
+                batch = frames[k:] if (pipeline and k > 0) else frames[k:k+1]
+                for batch_word, batch_cmd in batch:
+                    if self.verbose:
+                        print(f"CMD: {self.bs2str(batch_cmd)}")
+                    sent.append((batch_word, time.perf_counter()))
+                    self._ser.write(batch_cmd)
+            res.append(self._await_ack(word, sent[k][1], timeout))
 
-            for i in range(n):
-                try:
-                    res = self._send_cmd(cmd_word, cmd_value, reverse_value)
-                    break
-                except Exception as e:
-                    print(f"Failed to execute cmd '{cmd_word_str}'\n{e}")
-            else:
-                print(f"Failed to execute cmd '{cmd_word_str}'.")
-                continue
+        return res
 
-            for i in range(n):
-                try:
-                    self._end_configuration()
-                    break
-                except Exception as e:
-                    print(f"Failed to end configuration\n{e}")
-            else:
-                print(f"Failed to end configuration while executing cmd '{cmd_word_str}'.")
-                continue
+    def _send_cmd(self, cmd_word, cmd_value, reverse_value=True, timeout=None):
+        return self._send_cmds([(cmd_word, cmd_value, reverse_value)], timeout=timeout)[0]
 
-            break
-        else:
-            raise Exception(f"Failed to execute cmd '{cmd_word_str}'.")
+    def _execute_cmd(self, cmd_word, cmd_value, reverse_value=True, n=4, end=True, timeout=None):
+        # Runs a command in configuration mode. With `end` False the mode is
+        # left by the command itself (restart, which may also change the
+        # rate). The first attempt is pipelined once configuration mode is
+        # acknowledged; retries go step by step, as the radar may be busy.
+        cmd_word_str = self.bs2str(cmd_word)
 
-        return res
+        cmds = [self.CMD_START_CONFIGURATION, (cmd_word, cmd_value, reverse_value)]
+        if end:
+            cmds.append(self.CMD_END_CONFIGURATION)
 
-    def get_firmware_version(self, raw=False):
+        for i in range(n):
+            try:
+                return self._send_cmds(cmds, pipeline=(i == 0), timeout=timeout)[1]
+            except Exception as e:
+                print(f"Failed to execute cmd '{cmd_word_str}' (attempt {i+1} of {n}): {e}")
+
+        raise Exception(f"Failed to execute cmd '{cmd_word_str}'.")
+
+    def cmd_stats(self):
+        # Round trip percentiles by command word over the recent commands.
+        rtts = {}
+        for word, rtt in self.cmd_rtts:
+            rtts.setdefault(word, []).append(rtt)
+
+        return {
+            word: {
+                'n': len(values),
+                'p50_ms': utils.percentile(values, 50) * 1e3,
+                'p90_ms': utils.percentile(values, 90) * 1e3,
+                'p99_ms': utils.percentile(values, 99) * 1e3,
+                'max_ms': max(values) * 1e3,
+            }
+            for word, values in sorted(rtts.items())}
+
+    def get_firmware_version(self, raw=False, n=4, timeout=None):
         cmd_word = [0x00, 0xA0]
         cmd_value = []
-        res = self._execute_cmd(cmd_word, cmd_value)
+        res = self._execute_cmd(cmd_word, cmd_value, n=n, timeout=timeout)
         
         if raw:
             return res
@@ -164,10 +321,15 @@ class LD2450():
     def restart(self):
         cmd_word = [0x00, 0xA3]
         cmd_value = []
-        self._execute_cmd(cmd_word, cmd_value)
+        self._execute_cmd(cmd_word, cmd_value, end=False)
+        self._close_port()
         time.sleep(3)
 
-        self._ser = self._get_serial()
+        if self._baudrate_next is not None:
+            self.baudrate = self._baudrate_next
+            self._baudrate_next = None
+
+        self.reconnect()
 
     def restore_factory_settings(self, restart=False):
         # Baudrate: 256000.
@@ -183,20 +345,180 @@ class LD2450():
             self.restart()
 
     def set_baudrate(self, baudrate, restart=False):
-        baudrates = [9600, 19200, 38400, 57600, 115200, 230400, 256000, 460800]
-        if baudrate not in baudrates:
-            baudrates_str = ", ".join(map(str, baudrates))
+        if baudrate not in self.BAUDRATES:
+            baudrates_str = ", ".join(map(str, self.BAUDRATES))
             raise ValueError(f"Baudrate must be one of the following: {baudrates_str}.")   
 
-        baudrate_index = baudrates.index(baudrate) + 1
+        baudrate_index = self.BAUDRATES.index(baudrate) + 1
 
         cmd_word = [0x00, 0xA1]
         cmd_value = [0x00, baudrate_index]
         self._execute_cmd(cmd_word, cmd_value)
 
+        # The host follows when the radar restarts.
+        self._baudrate_next = baudrate
+
         if restart:
             self.restart()
 
+    def identify(self):
+        # Firmware version if the radar answers at the host rate, else None.
+        try:
+            return self.get_firmware_version(n=1)
+        except Exception:
+            return None
+
+    def find_baudrate(self):
+        # Reopens the port at every rate until the radar answers; the host
+        # is left at the found rate.
+        for baudrate in [self.baudrate] + [b for b in self.BAUDRATES[::-1] if b != self.baudrate]:
+            self.baudrate = baudrate
+            try:
+                self.reconnect()
+            except Exception:
+                continue
+            if self.identify() is not None:
+                return baudrate
+
+        raise Exception(f"Radar on '{self.uartdev}' does not answer at any rate.")
+
+    def negotiate_baudrate(self, baudrates=None):
+        # Moves radar and host to the highest of `baudrates` at which the
+        # radar answers and sends valid frames, trying rates from the top.
+        # A rate that fails is undone by finding the radar again and
+        # restoring the last good rate. Returns the rate in use.
+        if baudrates is None:
+            baudrates = self.BAUDRATES
+
+        good = self.baudrate
+        if self.identify() is None:
+            good = self.find_baudrate()
+
+        for baudrate in sorted(baudrates, reverse=True):
+            if baudrate == good:
+                break
+
+            # The radar keeps its rate across power cycles: never move it to
+            # a rate the host port cannot even open.
+            if not self._host_supports(baudrate):
+                print(f"Host port '{self.uartdev}' does not support {baudrate} baud")
+                continue
+
+            print(f"Trying {baudrate} baud on '{self.uartdev}'...")
+            try:
+                self.set_baudrate(baudrate, restart=True)
+                if (self.identify() is not None) and self._check_frames():
+                    print(f"Radar on '{self.uartdev}' is at {baudrate} baud")
+                    return baudrate
+            except Exception as e:
+                print(f"Failed to set {baudrate} baud ({e})")
+
+            try:
+                self.find_baudrate()
+            except Exception:
+                raise Exception(f"Radar on '{self.uartdev}' is lost after trying {baudrate} baud, "
+                                f"its rate has to be restored by a factory reset.") from None
+            if self.baudrate != good:
+                self.set_baudrate(good, restart=True)
+
+        print(f"Radar on '{self.uartdev}' stays at {self.baudrate} baud")
+        return self.baudrate
+
+    def _host_supports(self, baudrate):
+        baudrate_prev = self.baudrate
+        self.baudrate = baudrate
+        try:
+            self.reconnect()
+            return True
+        except Exception:
+            return False
+        finally:
+            self.baudrate = baudrate_prev
+            self.reconnect()
+
+    def _check_frames(self, timeout=1.0, n=3):
+        # Valid data frames arrive at the host rate.
+        frames = []
+        t_end = time.monotonic() + timeout
+        while len(frames) < n and time.monotonic() < t_end:
+            frames.extend(self.read_frames())
+            time.sleep(0.02)
+        return len(frames) >= n
+
+    def bench_link(self, duration=5.0, n_cmds=20):
+        # Command round trips and frame delivery at the current rate.
+        rtts = []
+        for _ in range(n_cmds):
+            t0 = time.perf_counter()
+            if self.identify() is None:
+                continue
+            rtts.append(time.perf_counter() - t0)
+
+        self.clean()
+        self._rx_buf.clear()
+
+        invalid0 = self.invalid_frames_total
+        skipped0 = self.skipped_bytes_total
+
+        ts = []
+        t_end = time.monotonic() + duration
+        while time.monotonic() < t_end:
+            frames = self.read_frames()
+            if frames:
+                ts.extend([time.perf_counter()] * len(frames))
+            time.sleep(0.001)
+
+        intervals = [b - a for a, b in zip(ts, ts[1:])]
+        mean = sum(intervals) / len(intervals) if intervals else float("nan")
+        dev = sorted(abs(i - mean) for i in intervals)
+
+        # 10 bits per byte on the wire.
+        return {
+            'baudrate': self.baudrate,
+            'byte_ms': 10 / self.baudrate * 1e3,
+            'frame_ms': 10 * self.DATA_FRAME_LEN / self.baudrate * 1e3,
+            'cmd_ok': len(rtts),
+            'cmd_p50_ms': utils.percentile(rtts, 50) * 1e3,
+            'cmd_p99_ms': utils.percentile(rtts, 99) * 1e3,
+            'frames': len(ts),
+            'interval_ms': mean * 1e3,
+            'jitter_p99_ms': utils.percentile(dev, 99) * 1e3,
+            'invalid_frames': self.invalid_frames_total - invalid0,
+            'skipped_bytes': self.skipped_bytes_total - skipped0,
+        }
+
+    def bench_baudrates(self, baudrates=(115200, 230400, 256000, 460800), duration=5.0):
+        # Runs bench_link() at each rate and returns to the starting one.
+        start = self.baudrate
+        results = []
+
+        print(f"{'baud':>7} | {'byte ms':>7} | {'frame ms':>8} | {'cmd ok':>6} | "
+              f"{'cmd p50':>7} | {'cmd p99':>7} | {'frames':>6} | {'int ms':>7} | "
+              f"{'jit p99':>7} | {'invalid':>7} | {'skipped':>7}")
+
+        for baudrate in baudrates:
+            try:
+                if baudrate != self.baudrate:
+                    self.set_baudrate(baudrate, restart=True)
+                if self.identify() is None:
+                    raise Exception("no answer")
+            except Exception as e:
+                print(f"{baudrate:7} | failed ({e})")
+                self.find_baudrate()
+                continue
+
+            r = self.bench_link(duration=duration)
+            results.append(r)
+            print(f"{r['baudrate']:7} | {r['byte_ms']:7.3f} | {r['frame_ms']:8.3f} | "
+                  f"{r['cmd_ok']:6} | {r['cmd_p50_ms']:7.1f} | {r['cmd_p99_ms']:7.1f} | "
+                  f"{r['frames']:6} | {r['interval_ms']:7.1f} | {r['jitter_p99_ms']:7.2f} | "
+                  f"{r['invalid_frames']:7} | {r['skipped_bytes']:7}")
+
+        if self.baudrate != start:
+            self.set_baudrate(start, restart=True)
+
+        return results
+
     def get_mac_address(self, raw=False):
         cmd_word = [0x00, 0xA5]
         cmd_value = [0x00, 0x01]
@@ -330,25 +652,73 @@ class LD2450():
         print(f"Zone filtering: {zone_filtering}")
 
     def test(self, n=200):
-        l1 = []
-        l2 = []
-        l3 = []
-        
+        # Command path benchmark: `n` rounds of reading the firmware version,
+        # MAC address and tracking mode, each in configuration mode. Prints
+        # latency percentiles of whole commands and of single ACK round
+        # trips, and the values read, which should not vary.
+        cmds = {
+            "firmware_version": self.get_firmware_version,
+            "mac_address": self.get_mac_address,
+            "tracking_mode": self.get_tracking_mode,
+        }
+
+        values = {name: set() for name in cmds}
+        latencies = {name: [] for name in cmds}
+        failures = {name: 0 for name in cmds}
+
+        self.cmd_rtts = deque(maxlen=3 * len(cmds) * n)
+        timeouts0 = self.cmd_timeouts_total
+        nacks0 = self.cmd_nacks_total
+        frames0 = len(self._frames_pending)
+
         for i in range(n):
-            print(i)
-        
-            firmware_version = self.get_firmware_version()
-            mac_address = self.get_mac_address()
-            tracking_mode_index = self.get_tracking_mode()
-        
-            l1.append(firmware_version)
-            l2.append(mac_address)
-            l3.append(tracking_mode_index)
-        
+            if i % 20 == 0:
+                print(f"Round {i} of {n}")
+
+            for name, cmd in cmds.items():
+                t0 = time.perf_counter()
+                try:
+                    value = cmd()
+                except Exception as e:
+                    failures[name] += 1
+                    print(f"{name}: {e}")
+                    continue
+
+                latencies[name].append(time.perf_counter() - t0)
+                values[name].add(value)
+
+        print()
+        print(f"{'cmd':>16} | {'ok':>5} | {'failed':>6} | {'p50 ms':>7} | "
+              f"{'p90 ms':>7} | {'p99 ms':>7} | {'max ms':>7}")
+        for name in cmds:
+            l = latencies[name]
+            print(f"{name:>16} | {len(l):5} | {failures[name]:6} | "
+                  f"{utils.percentile(l, 50) * 1e3:7.1f} | {utils.percentile(l, 90) * 1e3:7.1f} | "
+                  f"{utils.percentile(l, 99) * 1e3:7.1f} | {(max(l) if l else float('nan')) * 1e3:7.1f}")
+
+        print()
+        print(f"{'ACK word':>16} | {'n':>5} | {'p50 ms':>7} | {'p90 ms':>7} | "
+              f"{'p99 ms':>7} | {'max ms':>7}")
+        stats = self.cmd_stats()
+        for word, st in stats.items():
+            print(f"{f'{word:04X}':>16} | {st['n']:5} | {st['p50_ms']:7.1f} | {st['p90_ms']:7.1f} | "
+                  f"{st['p99_ms']:7.1f} | {st['max_ms']:7.1f}")
+
         print()
-        print(f"Firmware version: {sorted(set(l1))}")
-        print(f"MAC address: {sorted(set(l2))}")
-        print(f"Tracking mode: {sorted(set(l3))}")
+        print(f"Timeouts: {self.cmd_timeouts_total - timeouts0}, "
+              f"NACKs: {self.cmd_nacks_total - nacks0}, "
+              f"data frames received meanwhile: {len(self._frames_pending) - frames0}")
+        print(f"Firmware version: {sorted(values['firmware_version'])}")
+        print(f"MAC address: {sorted(values['mac_address'])}")
+        print(f"Tracking mode: {sorted(values['tracking_mode'])}")
+
+        self.cmd_rtts = deque(self.cmd_rtts, maxlen=self.CMD_RTT_WINDOW)
+
+        return {
+            'latencies': latencies,
+            'failures': failures,
+            'acks': stats,
+        }
 
     def clean(self, ret=False):
         if ret:
@@ -363,40 +733,132 @@ class LD2450():
             _ = self._ser.read(n_skipped)
             res = self._ser.read_until(self.DATA_EOF)
             n_skipped += len(res)
+            self.skipped_bytes_total += n_skipped
             print(f"Skipping {n_skipped} bytes")
 
         res = self._ser.read_until(self.DATA_EOF)
 
         if res[-30:-26] != self.DATA_HEADER:
             self.n_frame_failures += 1
+            self.invalid_frames_total += 1
             print("Invalid data header")
             return
 
         self.n_frame_failures = 0
         return res
         
-    def parse_frame(self, frame, full=False):
-        payload = frame[-26:-4]
+    def read_frames(self):
+        # Non-blocking counterpart of get_frame(): takes whatever bytes are
+        # waiting and returns all complete data frames found so far, keeping
+        # a partial frame for the next call.
+        n = self.in_waiting
+        self.last_in_waiting = n
+        if n:
+            self._rx_buf += self._ser.read(n)
+
+        # Frames are stamped with the monotonic time they were read at.
+        self.read_ts = time.monotonic()
+
+        frames = self._demux()
+        if self._frames_pending:
+            frames = self._frames_pending + frames
+            self._frames_pending = []
+
+        return frames
+
+    def _demux(self):
+        # Takes data frames and command ACKs out of the receive buffer, so
+        # that commands can be answered while data keeps streaming. Returns
+        # the data frames; ACKs are filed by ACK word for _await_ack().
+        buf = self._rx_buf
+        frames = []
+        while True:
+            i = buf.find(self.DATA_HEADER)
+            k = buf.find(self.CMD_HEADER)
 
-        data = []
-        for i in range(3):
-            from_i = i * 8
-            to_i = from_i + 8
-            c = payload[from_i:to_i]
+            if (k >= 0) and ((i < 0) or (k < i)):
+                self.skipped_bytes_total += k
+                del buf[:k]
+
+                # Header, length, ACK word and status at least.
+                if len(buf) < 10:
+                    break
+
+                cmd_len = int.from_bytes(buf[4:6], byteorder='little')
+                j = 6 + cmd_len + len(self.CMD_EOF)
+                if cmd_len <= self.CMD_MAX_LEN and len(buf) < j:
+                    break
+
+                if cmd_len > self.CMD_MAX_LEN or buf[j-len(self.CMD_EOF):j] != self.CMD_EOF:
+                    self.skipped_bytes_total += 1
+                    print("Invalid ACK frame")
+                    del buf[:1]
+                    continue
 
-            x = self._convert_data_int16(c[0:2], signed=True)
-            y = self._convert_data_int16(c[2:4], signed=True)
+                res = bytes(buf[4:j-len(self.CMD_EOF)])
+                ack_word = int.from_bytes(res[2:4], byteorder='little')
+                self._acks.setdefault(ack_word, deque()).append(res)
+                del buf[:j]
+                continue
+
+            if i < 0:
+                # Keep a possible header prefix.
+                n_skipped = max(0, len(buf) - (len(self.DATA_HEADER) - 1))
+                self.skipped_bytes_total += n_skipped
+                del buf[:n_skipped]
+                break
+
+            self.skipped_bytes_total += i
+
+            if len(buf) - i < self.DATA_FRAME_LEN:
+                del buf[:i]
+                break
+
+            j = i + self.DATA_FRAME_LEN
+            if buf[j-len(self.DATA_EOF):j] != self.DATA_EOF:
+                self.n_frame_failures += 1
+                self.invalid_frames_total += 1
+                self.skipped_bytes_total += 1
+                print("Invalid data frame")
+                del buf[:i+1]
+                continue
+
+            frames.append(bytes(buf[i:j]))
+            del buf[:j]
+
+        if frames:
+            self.n_frame_failures = 0
+
+        return frames
+
+    def decode_frame(self, frame, targets):
+        # Fills `targets`, a Targets record, from a data frame and returns
+        # it; empty slots have x or y at zero.
+        v = self.DATA_TARGETS.unpack_from(frame, len(frame) + self.DATA_TARGETS_OFFSET)
+        sm = self._sign_magnitude
+
+        n = 0
+        for k in range(0, 12, 4):
+            x = sm(v[k])
+            y = sm(v[k+1])
             if (x != 0) and (y != 0):
-                if full:
-                    s = self._convert_data_int16(c[4:6], signed=True)
-                    d = self._convert_data_int16(c[4:6], signed=False)
-                    idata = (x,y,s,d)
-                else:
-                    idata = (x,y)
+                targets.x[n] = x
+                targets.y[n] = y
+                targets.speed[n] = sm(v[k+2])
+                targets.resolution[n] = v[k+3]
+                targets.d2[n] = x*x + y*y
+                n += 1
 
-                data.append(idata)
+        targets.n = n
+        return targets
 
-        return data
+    def parse_frame(self, frame, full=False):
+        # Targets as a list of (x, y) tuples, or (x, y, speed, resolution)
+        # with `full`.
+        targets = self.decode_frame(frame, Targets())
+        if full:
+            return targets.full()
+        return list(targets)
 
     def get_data(self, full=False):
         frame = self.get_frame()
@@ -477,11 +939,12 @@ if __name__ == "__main__":
     except:
         cmd = "info"
 
-    if cmd not in ["info", "data", "test"]:
+    if cmd not in ["info", "data", "test", "bench"]:
         print("\nCmd argument must be:\n"
                         "- empty or 'info': showing radar info\n"
                         "- 'data': collecting and printing data\n"
-                        "- 'test': conducting test\n")
+                        "- 'test': conducting test\n"
+                        "- 'bench': measuring the link at several baudrates\n")
         sys.exit(1)
 
     ##########
@@ -506,6 +969,8 @@ if __name__ == "__main__":
         r.show_info()
     elif cmd == 'test':
         r.test()
+    elif cmd == 'bench':
+        r.bench_baudrates()
     elif cmd == 'data':
         try:
             r.show_data()
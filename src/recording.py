@@ -0,0 +1,33 @@
+import struct
+
+
+class FrameRecorder():
+    # Appends raw radar data frames to a file of fixed-size records, so that
+    # a recording of any length can be memory-mapped and indexed by playback
+    # without parsing it first:
+    #
+    #     t       float64   monotonic time, s
+    #     wall    float64   wall clock time, s since the epoch
+    #     radar   uint8     radar index within the unit
+    #     frame   30 bytes  data frame as received
+    #
+    # All fields are little-endian and unpadded.
+
+    RECORD = struct.Struct("<ddB30s")
+    SUFFIX = ".frames"
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "ab")
+        self.n_records = 0
+
+    def write(self, radar, frame, t, wall):
+        # `t` and `wall` are the times the frame was read at.
+        self._f.write(self.RECORD.pack(t, wall, radar, frame))
+        self.n_records += 1
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
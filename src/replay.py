@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import io
+import os
+from pathlib import Path
+import sys
+import time
+
+from clock import VirtualClock
+from glass_driver import GlassDriver
+from glass_unit import GlassUnit
+from gpio_backend import SimGPIOBackend
+from recording import FrameRecorder
+from stats_retention import uncompressed
+import utils
+
+
+def read_records(path, chunk=4096):
+    # (t, wall, radar, frame) of a recording, compressed or not.
+    _, opener = uncompressed(path)
+    size = FrameRecorder.RECORD.size
+    with opener(path, "rb") as f:
+        while True:
+            data = f.read(chunk * size)
+            if len(data) < size:
+                return
+            yield from FrameRecorder.RECORD.iter_unpack(data[:len(data) - len(data) % size])
+
+
+class Replay():
+    # Runs a frame recording of a unit through the full decision path: the
+    # radar smoothing, the unit decision and the glass driver on the
+    # simulated GPIO backend, all on a virtual clock that jumps from frame
+    # to frame. A replay runs as fast as the CPU allows and the same every
+    # time; what happens goes to an event log, one line per event, which
+    # can be diffed between code versions.
+
+    # Shortest pass through a silent stretch.
+    MIN_STEP = 0.01
+
+    def __init__(self, cfg_path, unit_name, log_f, ts, wall, verbose=False):
+        self.log_f = log_f
+        self.t0 = ts
+
+        # No devices, hub, metrics or stats.
+        cfg = utils.load_json(cfg_path)
+        units = {u['name']: u for u in cfg.get('units', [{
+            'name': "glass",
+            'radars': ["radar_1", "radar_2"],
+            'policy': GlassUnit.POLICY_ALL}])}
+        cfg_unit = units.get(unit_name) or next(iter(units.values()))
+        for name in cfg_unit['radars']:
+            cfg[name] = dict(cfg[name], uartdev=None, baudrate=None)
+        cfg['radar_hub'] = dict(cfg.get('radar_hub', {}), socket=None)
+        cfg['controller'] = dict(cfg.get('controller', {}), profile=None, record=False)
+
+        self.clock = VirtualClock(ts, wall)
+        self.driver = GlassDriver(
+            cfg_path, backend=SimGPIOBackend(waveform=True), clock=self.clock)
+        self.unit = GlassUnit(cfg_unit['name'], cfg_unit, cfg, self._send_cmd, self.clock)
+        self.unit.PRINT_STATUS = verbose
+
+        self.n_frames = 0
+        self.n_events = 0
+        self._state = self._snapshot()
+
+    def log(self, ts, text):
+        self.log_f.write(f"{ts - self.t0:12.3f} {text}\n")
+        self.n_events += 1
+
+    def _send_cmd(self, cmd, channel=None, origin_ts=None):
+        self.log(self.clock.monotonic(), f"cmd {cmd} channel={channel}")
+        self.driver.send(cmd, channel, origin_ts)
+
+    def _snapshot(self):
+        state = {
+            'active': tuple(self.unit.radars.index(r) + 1 for r in self.unit.active),
+            'glass_on': self.unit.glass_on,
+            'predicted': self.unit.predicted,
+        }
+        for i, (radar, health) in enumerate(zip(self.unit.radars, self.unit.health)):
+            state[f"radar {i+1} online"] = radar.online
+            state[f"radar {i+1} present"] = radar.human_present_reliable
+            state[f"radar {i+1} healthy"] = health.healthy
+        for ch in self.driver.channels:
+            state[f"glass {ch.index} on"] = ch.on
+        return state
+
+    def _log_changes(self):
+        state = self._snapshot()
+        for key, value in state.items():
+            if value == self._state[key]:
+                continue
+
+            # Ramps end between frames, at a time of their own.
+            ts = self.clock.monotonic()
+            if key.startswith("glass ") and key.endswith(" on"):
+                ts = self.driver.channels[int(key.split()[1])].ramp_done_ts
+            self.log(ts, f"{key} {value}")
+        self._state = state
+
+    def _step(self, ts, ready, frames):
+        self.driver.run_until(ts)
+        self.clock.set(ts)
+        self.unit.process(ready, frames)
+        self._log_changes()
+
+    def feed(self, t, radar, frame):
+        # A silent stretch is gone through as the controller would, with a
+        # pass whenever the unit asks to be woken.
+        while True:
+            ts = self.clock.monotonic() + max(self.unit.select_timeout(), self.MIN_STEP)
+            if ts >= t:
+                break
+            self._step(ts, set(), {})
+
+        self._step(t, {radar}, {radar: [frame]})
+        self.n_frames += 1
+
+    def finish(self):
+        # Lets the last ramp run out.
+        self.driver.run_until(self.clock.monotonic() + 10.0)
+        self._log_changes()
+        self.unit.cleanup()
+        self.driver.cleanup()
+
+
+def replay(cfg_path, path, log_f, verbose=False):
+    # Session recordings are named '<session>_<unit>.frames'.
+    base, _ = uncompressed(path)
+    unit_name = base.stem.split("_", 1)[-1]
+
+    records = read_records(path)
+    first = next(records, None)
+    if first is None:
+        return None
+
+    log_f.write(f"# {Path(path).name}\n")
+
+    out = sys.stdout if verbose else open(os.devnull, "w")
+    with redirect_stdout(out):
+        r = Replay(cfg_path, unit_name, log_f, first[0], first[1], verbose)
+        r.feed(first[0], first[2], first[3])
+        for t, _, radar, frame in records:
+            r.feed(t, radar, frame)
+        r.finish()
+
+    return r
+
+
+def replay_text(cfg_path, path, verbose=False):
+    # Event log of one recording and a summary line, from a worker process.
+    log_f = io.StringIO()
+    t0 = time.perf_counter()
+    r = replay(cfg_path, path, log_f, verbose)
+    if r is None:
+        return "", f"'{path}' has no frames"
+
+    dt = time.perf_counter() - t0
+    span = r.clock.monotonic() - r.t0
+    return log_f.getvalue(), (
+        f"'{path}': {r.n_frames} frames, {span / 3600:.1f} hours in {dt:.1f} s "
+        f"({span / dt:.0f}x real time), {r.n_events} events")
+
+
+if __name__ == "__main__":
+    # 'replay.py conf.cfg events.log <recording>...' replays recordings,
+    # one per core at a time, each from a fresh start as a controller
+    # session was; the log has them in the order given. With '-v' the
+    # controller output is shown.
+    args = [a for a in sys.argv[1:] if a != "-v"]
+    verbose = len(args) < len(sys.argv) - 1
+    try:
+        cfg_path = args[0]
+        log_path = args[1]
+        paths = args[2:]
+        assert paths
+    except:
+        print("Usage: replay.py [-v] <config> <event log> <recording>...")
+        sys.exit(1)
+
+    t0 = time.perf_counter()
+    with open(log_path, "w") as log_f, ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        n = len(paths)
+        for text, summary in pool.map(replay_text, [cfg_path] * n, paths, [verbose] * n):
+            log_f.write(text)
+            print(summary)
+
+    print(f"{n} recordings in {time.perf_counter() - t0:.1f} s")
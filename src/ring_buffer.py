@@ -0,0 +1,33 @@
+class RingBuffer():
+    # Fixed-size buffer for one writer thread and any number of readers.
+    # Slots are preallocated and overwritten in place; `count` only grows, so
+    # readers can tell which items are new since their last look.
+
+    def __init__(self, size):
+        self.size = size
+        self._slots = [None] * size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, item):
+        self._slots[self.count % self.size] = item
+        # Published after the slot is written.
+        self.count += 1
+
+    def latest(self, n=None):
+        # Last `n` items (all held ones by default), oldest first.
+        count = self.count
+        if n is None or n > self.size:
+            n = self.size
+        n = min(n, count)
+
+        return [self._slots[i % self.size] for i in range(count - n, count)]
+
+    def since(self, count):
+        # Items written after the writer's `count` was observed, oldest
+        # first, with the new count. Items overwritten meanwhile are lost.
+        count_now = self.count
+        n = min(count_now - count, self.size)
+        return self.latest(n), count_now
@@ -0,0 +1,437 @@
+from contextlib import redirect_stdout
+import csv
+from datetime import datetime
+import math
+import os
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+
+from glass_unit import GlassUnit
+from radar_ld2450 import LD2450, Targets
+from recording import FrameRecorder
+from replay import Replay
+import utils
+
+
+FRAME_DTYPE = np.dtype([
+    ('t', '<f8'),
+    ('wall', '<f8'),
+    ('radar', 'u1'),
+    ('frame', 'u1', 30),
+])
+assert FRAME_DTYPE.itemsize == FrameRecorder.RECORD.size
+
+LABELS_SUFFIX = ".labels.csv"
+
+
+class Person():
+    # Path of one person as waypoints: times in s, positions in mm, the
+    # glass along the x axis and the corridor in front of it at y > 0. The
+    # person exists from the first waypoint to the last.
+
+    def __init__(self, kind, t, x, y):
+        self.kind = kind
+        self.t = [t]
+        self.x = [x]
+        self.y = [y]
+
+    @property
+    def t_start(self):
+        return self.t[0]
+
+    @property
+    def t_end(self):
+        return self.t[-1]
+
+    def walk(self, x, y, speed):
+        d = math.hypot(x - self.x[-1], y - self.y[-1])
+        self.t.append(self.t[-1] + max(d / speed, 0.01))
+        self.x.append(x)
+        self.y.append(y)
+
+    def stay(self, dt):
+        self.t.append(self.t[-1] + dt)
+        self.x.append(self.x[-1])
+        self.y.append(self.y[-1])
+
+    def span(self, t):
+        # Indices of the sorted times `t` the person exists at, as a range.
+        return np.searchsorted(t, self.t[0]), np.searchsorted(t, self.t[-1], side='right')
+
+    def position(self, t):
+        # x, y and their velocities at times `t` within the path.
+        wt = np.asarray(self.t)
+        wx = np.asarray(self.x, dtype=float)
+        wy = np.asarray(self.y, dtype=float)
+
+        x = np.interp(t, wt, wx)
+        y = np.interp(t, wt, wy)
+
+        k = np.clip(np.searchsorted(wt, t, side='right') - 1, 0, len(wt) - 2)
+        dt = wt[k+1] - wt[k]
+        vx = (wx[k+1] - wx[k]) / dt
+        vy = (wy[k+1] - wy[k]) / dt
+        return x, y, vx, vy
+
+
+class Scenario():
+    # Pedestrian traffic around the glass and the LD2450 data frames its
+    # radars would send, with the ground truth of whether anybody is in the
+    # presence zone. People walk through the glass, stop in front of it,
+    # cross the corridor or loiter; ghosts are static reflectors, reported
+    # at exactly the same position frame after frame, that are there for
+    # a while every now and then.
+    #
+    # Frames are generated an hour at a time with numpy, thousands of times
+    # faster than real time.
+
+    RATE = 10.0
+
+    # Field of view of the radar: range in mm and half angle in degrees.
+    RANGE = LD2450.RANGE
+    FOV = 60
+
+    RESOLUTION = 360
+
+    CHUNK = 3600.0
+
+    # Walking speeds in mm/s and the far end of the corridor in mm.
+    SPEED_MIN = 1000
+    SPEED_MAX = 1600
+    FAR = 6000
+
+    def __init__(self, cfg, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+        cfg_scenario = cfg.get('scenario', {})
+
+        units = cfg.get('units', [{
+            'name': "glass",
+            'radars': ["radar_1", "radar_2"],
+            'policy': GlassUnit.POLICY_ALL}])
+        unit_name = cfg_scenario.get('unit', units[0]['name'])
+        self.unit = next(u for u in units if u['name'] == unit_name)
+        self.radar_names = self.unit['radars']
+
+        # Mount of each radar of the unit: position in mm and yaw in
+        # degrees, positive turning the radar towards +x.
+        default_mounts = [{'x': 0, 'y': 0, 'yaw': 0}] * len(self.radar_names)
+        self.mounts = cfg_scenario.get('radars', default_mounts)[:len(self.radar_names)]
+        if len(self.mounts) != len(self.radar_names):
+            raise ValueError(f"Scenario needs a mount for each of {', '.join(self.radar_names)}.")
+
+        # Presence zone in front of the glass, mm.
+        self.ZONE_WIDTH = cfg_scenario.get('zone_width', 1200)
+        self.ZONE_DEPTH = cfg_scenario.get('zone_depth', 1000)
+
+        self.PEOPLE_PER_HOUR = cfg_scenario.get('people_per_hour', 120)
+        self.MIX = cfg_scenario.get(
+            'mix', {'walker': 0.4, 'stopper': 0.2, 'crosser': 0.3, 'loiterer': 0.1})
+
+        # Each ghost is there for 'on' seconds out of every 'on' + 'off'.
+        self.GHOSTS = cfg_scenario.get('ghosts', [])
+
+        # Position noise in mm and the share of frames missing a target.
+        self.NOISE = cfg_scenario.get('noise', 20)
+        self.MISS = cfg_scenario.get('miss', 0.02)
+
+    def _speed(self):
+        return self.rng.uniform(self.SPEED_MIN, self.SPEED_MAX)
+
+    def _person(self, kind, t):
+        rng = self.rng
+        speed = self._speed()
+
+        if kind == "walker":
+            # Up to the glass, a moment at it and through.
+            p = Person(kind, t, rng.uniform(-3000, 3000), self.FAR)
+            x = rng.uniform(-300, 300)
+            p.walk(x, 300, speed)
+            p.stay(rng.uniform(0.0, 1.5))
+            p.walk(x, 0, speed)
+        elif kind == "stopper":
+            # Stops in front of the glass and goes back.
+            p = Person(kind, t, rng.uniform(-3000, 3000), self.FAR)
+            p.walk(rng.uniform(-500, 500), rng.uniform(300, 900), speed)
+            p.stay(rng.uniform(3.0, 30.0))
+            p.walk(rng.uniform(-3000, 3000), self.FAR, speed)
+        elif kind == "crosser":
+            # Along the corridor, from one side out of view to the other.
+            side = rng.choice([-1, 1])
+            p = Person(kind, t, -side * self.FAR, rng.uniform(600, 4000))
+            p.walk(side * self.FAR, rng.uniform(600, 4000), speed)
+        elif kind == "loiterer":
+            # Wanders about the corridor, pausing here and there.
+            p = Person(kind, t, rng.uniform(-3000, 3000), self.FAR)
+            for _ in range(rng.integers(3, 9)):
+                p.walk(rng.uniform(-2500, 2500), rng.uniform(1200, 4500), 0.5 * speed)
+                p.stay(rng.uniform(2.0, 20.0))
+            p.walk(rng.uniform(-3000, 3000), self.FAR, speed)
+        else:
+            raise ValueError(f"Unknown scenario person '{kind}'.")
+
+        return p
+
+    def people(self, duration):
+        # Arrivals as a Poisson process.
+        kinds = list(self.MIX)
+        p = np.array([self.MIX[k] for k in kinds], dtype=float)
+        p /= p.sum()
+
+        people = []
+        t = 0.0
+        while True:
+            t += self.rng.exponential(3600 / self.PEOPLE_PER_HOUR)
+            if t >= duration:
+                return people
+            people.append(self._person(kinds[self.rng.choice(len(kinds), p=p)], t))
+
+    def _ghosts(self, t):
+        # Static reflectors: the frame indices each is there at.
+        ghosts = []
+        for g in self.GHOSTS:
+            on = g.get('on', 600)
+            there = (t + g.get('phase', 0)) % (on + g.get('off', 0)) < on
+            ghosts.append((np.flatnonzero(there), float(g['x']), float(g['y'])))
+        return ghosts
+
+    @staticmethod
+    def _encode(v):
+        # Sign in the top bit, set for positive values.
+        v = np.clip(v, -2**15 + 1, 2**15 - 1).astype(np.int32)
+        return np.where(v >= 0, v + 2**15, -v).astype('<u2')
+
+    def _detect(self, mount, k, x, y, vx, vy, noisy):
+        # Targets a radar reports for positions at frame indices `k`: the
+        # frame indices, x, y and speed of those in view.
+        yaw = math.radians(mount['yaw'])
+        cos, sin = math.cos(yaw), math.sin(yaw)
+
+        # Into radar coordinates, y along the boresight.
+        dx = x - mount['x']
+        dy = y - mount['y']
+        xr = dx * cos - dy * sin
+        yr = dx * sin + dy * cos
+        r = np.hypot(xr, yr)
+
+        # Radial speed in cm/s, negative while approaching.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            speed = np.nan_to_num((dx * vx + dy * vy) / r / 10)
+
+        # Ghosts do not move at all.
+        if noisy:
+            xr = xr + self.rng.normal(0, self.NOISE, len(k))
+            yr = yr + self.rng.normal(0, self.NOISE, len(k))
+
+        visible = (yr > 0) & (np.abs(xr) <= yr * math.tan(math.radians(self.FOV))) & \
+            (r <= self.RANGE)
+        if noisy:
+            visible &= self.rng.random(len(k)) >= self.MISS
+
+        return k[visible], np.rint(xr[visible]), np.rint(yr[visible]), np.rint(speed[visible])
+
+    def _frames(self, i, t, people):
+        # Data frames of radar `i` at times `t`.
+        mount = self.mounts[i]
+        n = len(t)
+
+        detections = []
+        for p in people:
+            k = np.arange(*p.span(t))
+            detections.append(self._detect(mount, k, *p.position(t[k]), noisy=True))
+        for k, x, y in self._ghosts(t):
+            zeros = np.zeros(len(k))
+            detections.append(self._detect(mount, k, zeros + x, zeros + y, zeros, zeros, noisy=False))
+
+        words = np.zeros((n, 4 * Targets.N), dtype='<u2')
+        if detections:
+            k, x, y, speed = (np.concatenate(a) for a in zip(*detections))
+
+            # The nearest three targets of each frame, by their rank.
+            order = np.lexsort((x * x + y * y, k))
+            k, x, y, speed = k[order], x[order], y[order], speed[order]
+            rank = np.arange(len(k)) - np.searchsorted(k, k)
+            keep = rank < Targets.N
+            k, rank = k[keep], 4 * rank[keep]
+
+            words[k, rank] = self._encode(x[keep])
+            words[k, rank + 1] = self._encode(y[keep])
+            words[k, rank + 2] = self._encode(speed[keep])
+            words[k, rank + 3] = self.RESOLUTION
+
+        frames = np.empty((n, LD2450.DATA_FRAME_LEN), dtype='u1')
+        frames[:, :4] = np.frombuffer(LD2450.DATA_HEADER, dtype='u1')
+        frames[:, 4:-2] = words.view('u1').reshape(n, -1)
+        frames[:, -2:] = np.frombuffer(LD2450.DATA_EOF, dtype='u1')
+        return frames
+
+    def _in_zone(self, t, people):
+        present = np.zeros(len(t), dtype=bool)
+        for p in people:
+            k0, k1 = p.span(t)
+            x, y, _, _ = p.position(t[k0:k1])
+            present[k0:k1] |= (np.abs(x) <= self.ZONE_WIDTH / 2) & (y >= 0) & (y <= self.ZONE_DEPTH)
+        return present
+
+    def generate(self, duration, wall0=None):
+        # Yields the records of each chunk, in time order, and the ground
+        # truth at the frame times of the first radar.
+        if wall0 is None:
+            wall0 = time.time()
+
+        people = self.people(duration)
+
+        t0 = 0.0
+        while t0 < duration:
+            t1 = min(t0 + self.CHUNK, duration)
+            chunk_people = [p for p in people if p.t_end >= t0 and p.t_start < t1]
+
+            records = []
+            for i in range(len(self.mounts)):
+                # Radars are not in step.
+                t = np.arange(t0 + i * 0.037, t1, 1 / self.RATE)
+                rec = np.zeros(len(t), dtype=FRAME_DTYPE)
+                rec['t'] = t
+                rec['wall'] = wall0 + t
+                rec['radar'] = i
+                rec['frame'] = self._frames(i, t, chunk_people)
+                records.append(rec)
+
+            records = np.concatenate(records)
+            records = records[np.argsort(records['t'], kind='stable')]
+
+            t = np.arange(t0, t1, 1 / self.RATE)
+            yield records, t, self._in_zone(t, chunk_people)
+            t0 = t1
+
+
+def write(scenario, out, duration):
+    # '<out>.frames', a recording playback opens as any other, and
+    # '<out>.labels.csv' with the times the ground truth changes.
+    frames_path = Path(f"{out}{FrameRecorder.SUFFIX}")
+    labels_path = Path(f"{out}{LABELS_SUFFIX}")
+
+    n_frames = 0
+    present_prev = None
+    with frames_path.open("wb") as f_frames, labels_path.open("w", newline="") as f_labels:
+        writer = csv.writer(f_labels)
+        writer.writerow(["t", "present"])
+
+        for records, t, present in scenario.generate(duration):
+            records.tofile(f_frames)
+            n_frames += len(records)
+
+            # The first row is always written.
+            prev = (not present[0]) if present_prev is None else present_prev
+            changes = np.flatnonzero(present != np.concatenate([[prev], present[:-1]]))
+            for k in changes:
+                writer.writerow([f"{t[k]:.3f}", int(present[k])])
+            present_prev = present[-1]
+
+    return frames_path, labels_path, n_frames
+
+
+def load_labels(path):
+    # Change times and the ground truth from them on.
+    t = []
+    present = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            t.append(float(row['t']))
+            present.append(bool(int(row['present'])))
+    return np.array(t), np.array(present)
+
+
+def evaluate(cfg_path, unit, frames_path, labels_path):
+    # Replays the frames through the full decision path, as replay.py does,
+    # and compares the glass with the ground truth, frame by frame and
+    # arrival by arrival.
+    records = np.memmap(frames_path, dtype=FRAME_DTYPE, mode='r')
+    label_t, label_present = load_labels(labels_path)
+    truth = label_present[np.searchsorted(label_t, records['t'], side='right') - 1]
+
+    decision = np.zeros(len(records), dtype=bool)
+    t0 = time.perf_counter()
+    with open(os.devnull, "w") as out, redirect_stdout(out):
+        r = None
+        for k, (t, wall, i, frame) in enumerate(zip(
+                records['t'], records['wall'], records['radar'], records['frame'])):
+            if r is None:
+                r = Replay(cfg_path, unit['name'], out, t, wall)
+            r.feed(float(t), int(i), frame.tobytes())
+            decision[k] = r.unit.glass_on
+        if r is not None:
+            r.finish()
+    dt = time.perf_counter() - t0
+
+    def onsets(a):
+        return np.flatnonzero(a & ~np.concatenate([[False], a[:-1]]))
+
+    def intervals(a):
+        starts = onsets(a)
+        ends = np.flatnonzero(a & ~np.concatenate([a[1:], [False]]))
+        return list(zip(starts, ends))
+
+    t = records['t']
+
+    # An arrival is caught if the glass goes on while it lasts, a false
+    # trigger is an on period nobody was there for.
+    latencies = []
+    missed = 0
+    for s, e in intervals(truth):
+        on = np.flatnonzero(decision[s:e+1])
+        if len(on) == 0:
+            missed += 1
+        else:
+            latencies.append(t[s + on[0]] - t[s])
+    false_ons = sum(not truth[s:e+1].any() for s, e in intervals(decision))
+
+    n = len(records)
+    hours = (t[-1] - t[0]) / 3600 if n else 0.0
+    print(f"{n} frames, {hours:.1f} hours in {dt:.1f} s ({hours * 3600 / dt:.0f}x real time)")
+    print(f"Accuracy:      {np.mean(decision == truth):.4f}")
+    print(f"False on:      {np.mean(decision & ~truth):.4f} of the time")
+    print(f"Missed:        {np.mean(~decision & truth):.4f} of the time")
+    print(f"Arrivals:      {len(latencies)} caught, {missed} missed")
+    print(f"False triggers: {false_ons}")
+    if r is not None:
+        print(f"Stuck:         {', '.join(str(radar.stuck_transitions_total) for radar in r.unit.radars)} transitions")
+    if latencies:
+        print(f"Latency:       median {np.median(latencies):.2f} s, "
+              f"p90 {np.percentile(latencies, 90):.2f} s")
+
+
+if __name__ == "__main__":
+    # 'scenario.py conf.cfg generate <out> <hours> [seed]' writes
+    # '<out>.frames' and '<out>.labels.csv'; 'scenario.py conf.cfg evaluate
+    # <out>' replays them through the decision path.
+    try:
+        cfg_path = sys.argv[1]
+        action = sys.argv[2]
+        out = sys.argv[3]
+    except:
+        print("Usage: scenario.py <config> generate <out> <hours> [seed] | "
+              "scenario.py <config> evaluate <out>")
+        sys.exit(1)
+
+    cfg = utils.load_json(cfg_path)
+
+    if action == "generate":
+        hours = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+        seed = int(sys.argv[5]) if len(sys.argv) > 5 else None
+
+        scenario = Scenario(cfg, seed)
+        t0 = time.perf_counter()
+        frames_path, labels_path, n_frames = write(scenario, out, hours * 3600)
+        dt = time.perf_counter() - t0
+        print(f"{datetime.now()}: {n_frames} frames of {hours} hours in {dt:.1f} s "
+              f"({hours * 3600 / dt:.0f}x real time) to '{frames_path}', '{labels_path}'")
+    elif action == "evaluate":
+        scenario = Scenario(cfg)
+        evaluate(cfg_path, scenario.unit, f"{out}{FrameRecorder.SUFFIX}", f"{out}{LABELS_SUFFIX}")
+    else:
+        print(f"Unknown action '{action}'")
+        sys.exit(1)
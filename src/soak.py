@@ -0,0 +1,294 @@
+import gc
+import json
+import os
+from pathlib import Path
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import traceback
+
+from radar_emulator import RadarEmulator
+import utils
+
+
+def proc_status(pid="self"):
+    # Resident memory in kB and open file descriptors of a process; None
+    # for a process that is gone.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, StopIteration):
+        return None, None
+    return rss, fds
+
+
+class Soak():
+    # Runs the controller for many emulated hours against emulated radars,
+    # with the simulated GPIO backend, while killing the glass driver and
+    # glitching the radars now and then. Memory, file descriptors and
+    # threads are sampled through the run and compared with a baseline
+    # taken after warm-up; growth over the limits fails the soak. Resident
+    # memory is judged by its slope after warm-up, as the allocator keeps
+    # arenas it has grown; tracemalloc snapshots, which cost memory of
+    # their own, are taken for the baseline and the end only.
+
+    # Real seconds between samples and faults, and the warm-up before the
+    # baseline, which fills windows and caches that are bounded anyway.
+    SAMPLE_INTERVAL = 10.0
+    FAULT_INTERVAL = 20.0
+    WARMUP = 60.0
+
+    # Allowed growth from the baseline to the end of the run, and of
+    # resident memory in kB per emulated hour.
+    MAX_TRACED_GROWTH = 1 << 20
+    MAX_RSS_SLOPE = 256
+    MAX_FD_GROWTH = 0
+    MAX_THREAD_GROWTH = 0
+
+    # The controller log is truncated past this size.
+    MAX_LOG_BYTES = 10 << 20
+
+    def __init__(self, cfg_path, hours, speed):
+        self.hours = hours
+        self.speed = speed
+        self.duration = hours * 3600 / speed
+
+        self.work_dir = Path(tempfile.mkdtemp(prefix="glass_soak_"))
+        self.out = sys.__stdout__
+
+        cfg = utils.load_json(cfg_path)
+        self.emulators = {}
+        self.cfg_path = self._soak_cfg(cfg)
+
+        self.samples = []
+        self.baseline = None
+        self.warm = False
+        self.faults = {'glitch': 0, 'driver_kill': 0}
+
+    def report(self, text):
+        print(text, file=self.out, flush=True)
+
+    def _soak_cfg(self, cfg):
+        # The configuration with emulated radars and no hardware, ports or
+        # hub; delays are shortened by the speed-up.
+        radars = set()
+        for cfg_unit in cfg.get('units', [{'radars': ["radar_1", "radar_2"]}]):
+            radars.update(cfg_unit['radars'])
+
+        for name in sorted(radars):
+            emulator = RadarEmulator(speed=self.speed)
+            self.emulators[name] = emulator
+            cfg[name]['uartdev'] = emulator.path
+            cfg[name]['baudrate'] = None
+            cfg[name]['toggle_delay'] /= self.speed
+
+        cfg['radar_hub'] = dict(cfg.get('radar_hub', {}), socket=None)
+        cfg['controller'] = dict(cfg.get('controller', {}), metrics=None, record=False)
+        cfg['glass_driver'] = dict(
+            cfg['glass_driver'], gpio_backend="sim", metrics=None,
+            state_delay=cfg['glass_driver']['state_delay'] / self.speed)
+
+        path = self.work_dir / "soak.cfg"
+        with path.open("w") as f:
+            json.dump(cfg, f, indent=4)
+        return path
+
+    def _sample(self, glass, snapshot=False):
+        gc.collect()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        rss, fds = proc_status()
+        driver_rss, driver_fds = proc_status(glass.glass_driver_proc.pid)
+
+        sample = {
+            'ts': time.monotonic(),
+            'traced': traced,
+            'traced_peak': traced_peak,
+            'rss': rss,
+            'fds': fds,
+            'threads': threading.active_count(),
+            'driver_rss': driver_rss,
+            'driver_fds': driver_fds,
+            'snapshot': tracemalloc.take_snapshot() if snapshot else None,
+        }
+        self.samples.append(sample)
+        return sample
+
+    def _print_sample(self, sample, t0):
+        hours = (sample['ts'] - t0) * self.speed / 3600
+        self.report(
+            f"{hours:7.2f} h: traced {sample['traced'] / 1024:8.1f} kB "
+            f"(peak {sample['traced_peak'] / 1024:8.1f} kB), rss {sample['rss']} kB, "
+            f"{sample['fds']} fds, {sample['threads']} threads, "
+            f"driver rss {sample['driver_rss']} kB, {sample['driver_fds']} fds")
+
+    def _inject_fault(self, glass, k):
+        # Alternately a radar glitch, which takes the radar offline and
+        # through a reconnect, and a killed glass driver.
+        if k % 2 == 0:
+            names = sorted(self.emulators)
+            name = names[(k // 2) % len(names)]
+            self.emulators[name].glitch(pause=2.0)
+            self.faults['glitch'] += 1
+        else:
+            try:
+                os.kill(glass.glass_driver_proc.pid, signal.SIGKILL)
+                self.faults['driver_kill'] += 1
+            except OSError:
+                pass
+
+    def _truncate_log(self, log):
+        if log.tell() > self.MAX_LOG_BYTES:
+            log.truncate(0)
+
+    def _rss_slope(self):
+        # Least squares slope of resident memory after the baseline, in kB
+        # per emulated hour; None with too few samples to tell, or with no
+        # baseline after warm-up, when memory is still settling. The samples
+        # start after the baseline, whose snapshot is kept and adds to the
+        # resident memory once.
+        samples = self.samples[self.samples.index(self.baseline) + 1:]
+        if (not self.warm) or len(samples) < 3:
+            return None
+
+        hours = [(s['ts'] - samples[0]['ts']) * self.speed / 3600 for s in samples]
+        rss = [s['rss'] for s in samples]
+        h_mean = sum(hours) / len(hours)
+        rss_mean = sum(rss) / len(rss)
+        var = sum((h - h_mean) ** 2 for h in hours)
+        cov = sum((h - h_mean) * (r - rss_mean) for h, r in zip(hours, rss))
+        return cov / var if var else None
+
+    def _check(self):
+        base = self.baseline
+        last = self.samples[-1]
+
+        growth = {
+            'traced': (last['traced'] - base['traced'], self.MAX_TRACED_GROWTH),
+            'fds': (last['fds'] - base['fds'], self.MAX_FD_GROWTH),
+            'threads': (last['threads'] - base['threads'], self.MAX_THREAD_GROWTH),
+        }
+        slope = self._rss_slope()
+        if slope is None:
+            self.report(f"  {'rss/h':10} too few samples after warm-up")
+        else:
+            growth['rss/h'] = (round(slope), self.MAX_RSS_SLOPE)
+        if (last['driver_fds'] is not None) and (base['driver_fds'] is not None):
+            growth['driver_fds'] = (last['driver_fds'] - base['driver_fds'], self.MAX_FD_GROWTH)
+
+        ok = True
+        for key, (delta, limit) in growth.items():
+            failed = delta > limit
+            ok &= not failed
+            self.report(f"  {key:10} {delta:+10} (limit {limit}){'  FAILED' if failed else ''}")
+
+        if not ok:
+            self.report("Top allocation growth since the baseline:")
+            stats = last['snapshot'].compare_to(base['snapshot'], "lineno")
+            for stat in stats[:10]:
+                self.report(f"  {stat}")
+
+        return ok
+
+    def monitor(self, glass, log):
+        t0 = time.monotonic()
+        next_sample = t0 + self.SAMPLE_INTERVAL
+        # Faults fall between samples, so that a sample never sees a
+        # driver half respawned.
+        next_fault = t0 + self.FAULT_INTERVAL + self.SAMPLE_INTERVAL / 2
+        k = 0
+
+        while time.monotonic() - t0 < self.duration:
+            time.sleep(1.0)
+            ts = time.monotonic()
+            self._truncate_log(log)
+
+            if ts >= next_fault:
+                next_fault += self.FAULT_INTERVAL
+                self._inject_fault(glass, k)
+                k += 1
+
+            if ts >= next_sample:
+                next_sample += self.SAMPLE_INTERVAL
+
+                # The first sample stands in for the baseline of a run
+                # shorter than the warm-up.
+                first = not self.samples
+                warm = (self.baseline is None) and ts - t0 >= self.WARMUP
+                sample = self._sample(glass, snapshot=first or warm)
+                self._print_sample(sample, t0)
+
+                if warm:
+                    self.baseline = sample
+                    self.warm = True
+                    if self.samples[0] is not sample:
+                        self.samples[0]['snapshot'] = None
+                    self.report("Baseline taken")
+
+        # One last sample, also when the run was shorter than the warm-up.
+        sample = self._sample(glass, snapshot=True)
+        self._print_sample(sample, t0)
+        if self.baseline is None:
+            self.baseline = self.samples[0]
+
+        frames = sum(emulator.frames_total for emulator in self.emulators.values())
+        self.report(f"{self.hours:.1f} emulated hours in {time.monotonic() - t0:.0f} s: "
+                    f"{frames} frames, {self.faults['glitch']} radar glitches, "
+                    f"{self.faults['driver_kill']} driver kills, "
+                    f"{int(glass.m_driver_restarts.value)} driver restarts")
+        self.report("Growth since the baseline:")
+        return self._check()
+
+
+if __name__ == "__main__":
+    # E.g. 'soak.py conf.cfg 24 60' runs 24 emulated hours in 24 minutes.
+    try:
+        cfg_path = Path(sys.argv[1]).resolve()
+    except:
+        print("No path for configuration provided")
+        sys.exit(1)
+
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24.0
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 60.0
+
+    soak = Soak(cfg_path, hours, speed)
+    soak.report(f"Soak of {hours} emulated hours at {speed}x in '{soak.work_dir}'")
+
+    # Stats go to the work directory and the controller output to a log
+    # there; the report stays on the terminal.
+    os.chdir(soak.work_dir)
+    log = open(soak.work_dir / "controller.log", "a", buffering=1)
+    sys.stdout = log
+    sys.stderr = log
+
+    tracemalloc.start()
+
+    from controller import Glass
+    glass = Glass(soak.cfg_path)
+
+    def run_monitor():
+        code = 1
+        try:
+            code = 0 if soak.monitor(glass, log) else 1
+        except:
+            traceback.print_exc(file=soak.out)
+        finally:
+            soak.report("PASSED" if code == 0 else "FAILED")
+            glass.cleanup()
+            glass.glass_driver_proc.kill()
+            for emulator in soak.emulators.values():
+                emulator.close()
+            os._exit(code)
+
+    # The controller loop needs the main thread for its signal handler.
+    threading.Thread(target=run_monitor, daemon=True).start()
+
+    try:
+        glass.start()
+    except:
+        traceback.print_exc()
+    finally:
+        glass.cleanup()
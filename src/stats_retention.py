@@ -0,0 +1,317 @@
+import ctypes
+from datetime import datetime
+import gzip
+import json
+import lzma
+import os
+from pathlib import Path
+import platform
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+import utils
+
+
+SESSION_FORMAT = "%Y%m%dT%H%M%S"
+
+# Compression by name: suffix added to the file and the opener.
+COMPRESSIONS = {
+    "gzip": (".gz", gzip.open),
+    "lzma": (".xz", lzma.open),
+}
+
+
+def uncompressed(path):
+    # Path without a compression suffix, and the opener for the file.
+    path = Path(path)
+    for suffix, opener in COMPRESSIONS.values():
+        if path.suffix == suffix:
+            return path.with_suffix(""), opener
+    return path, open
+
+
+def find_stats_file(path):
+    # `path` or its compressed version, whichever exists.
+    path = Path(path)
+    for suffix, _ in [("", None), *COMPRESSIONS.values()]:
+        p = path.with_name(path.name + suffix)
+        if p.exists():
+            return p
+    return path
+
+
+def session_of(path):
+    # Session files are named '<session>_<unit>.<ext>[.<compression>]', the
+    # session being the controller start time, or '<session>.<ext>' from
+    # before units; None for other files.
+    session = Path(path).name.split("_", 1)[0].split(".", 1)[0]
+    try:
+        datetime.strptime(session, SESSION_FORMAT)
+    except ValueError:
+        return None
+    return session
+
+
+# ioprio_set(2) numbers; there is no libc wrapper.
+IOPRIO_SET = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "armv6l": 314,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def lower_priority():
+    # Idle I/O class and lowest CPU priority for the calling thread only,
+    # so that the radar loops never wait behind retention work.
+    tid = threading.get_native_id()
+
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except OSError as e:
+        print(f"Failed to lower CPU priority of stats retention ({e})")
+
+    nr = IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        print(f"I/O priority of stats retention not lowered on '{platform.machine()}'")
+        return
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        print(f"Failed to lower I/O priority of stats retention "
+              f"({os.strerror(ctypes.get_errno())})")
+
+
+class StatsRetention():
+    # Keeps the stats directory within bounds: files of finished sessions
+    # are compressed, sessions older than the age limit are deleted and,
+    # oldest first, so are sessions over the size budget. The files are
+    # listed in manifest.json, so that tools need not scan the directory.
+    # The current session is never touched.
+
+    MANIFEST = "manifest.json"
+
+    # Read size while compressing and the pause after each chunk, which
+    # leaves the disk and the CPU to the controller.
+    CHUNK = 1 << 20
+    CHUNK_PAUSE = 0.01
+
+    # First run after start, when the controller is up.
+    START_DELAY = 30.0
+
+    def __init__(self, stat_dir, cfg, active_session=None):
+        self.stat_dir = Path(stat_dir)
+        self.active_session = active_session
+
+        self.configure(cfg)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.bytes = 0
+        self.compressed_total = 0
+        self.deleted_total = 0
+
+        reg = metrics.REGISTRY
+        reg.gauge_func(
+            "glass_stats_bytes", "Size of the stats directory.",
+            lambda: self.bytes)
+        reg.counter_func(
+            "glass_stats_compressed_total", "Stats files compressed.",
+            lambda: self.compressed_total)
+        reg.counter_func(
+            "glass_stats_deleted_total", "Stats files deleted for age or size.",
+            lambda: self.deleted_total)
+
+    def configure(self, cfg):
+        compression = cfg.get('compression', "gzip")
+        if (compression is not None) and (compression not in COMPRESSIONS):
+            text = f"Stats compression must be one of {', '.join(COMPRESSIONS)} or null."
+            # Fatal on start only; a bad edit keeps the running settings.
+            if not hasattr(self, 'COMPRESSION'):
+                raise ValueError(text)
+            print(f"{text} Stats retention settings unchanged.")
+            return
+        self.COMPRESSION = compression
+
+        # Sizes in MB and ages in days; None for no limit.
+        max_mb = cfg.get('max_mb')
+        self.MAX_BYTES = None if max_mb is None else int(max_mb * 1e6)
+        max_age_days = cfg.get('max_age_days')
+        self.MAX_AGE = None if max_age_days is None else max_age_days * 86400
+
+        self.INTERVAL = cfg.get('interval', 600)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        lower_priority()
+
+        if self._stop.wait(self.START_DELAY):
+            return
+
+        while True:
+            try:
+                self.run_once()
+            except:
+                traceback.print_exc()
+
+            if self._stop.wait(self.INTERVAL):
+                return
+
+    def _sessions(self):
+        # Files by session, leaving out temporary files.
+        sessions = {}
+        for p in self.stat_dir.iterdir():
+            session = session_of(p)
+            if (session is None) or (not p.is_file()) or p.suffix == ".tmp":
+                continue
+            sessions.setdefault(session, []).append(p)
+        return sessions
+
+    def _compress(self, path):
+        suffix, opener = COMPRESSIONS[self.COMPRESSION]
+        out_path = path.with_name(path.name + suffix)
+        tmp_path = out_path.with_name(out_path.name + ".tmp")
+
+        st = path.stat()
+        with path.open("rb") as f_in, opener(tmp_path, "wb") as f_out:
+            while True:
+                chunk = f_in.read(self.CHUNK)
+                if not chunk:
+                    break
+                f_out.write(chunk)
+                if self._stop.wait(self.CHUNK_PAUSE):
+                    break
+
+        if self._stop.is_set():
+            tmp_path.unlink()
+            return path
+
+        # Ages go by the time the data was written, not compressed.
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        tmp_path.replace(out_path)
+        path.unlink()
+
+        self.compressed_total += 1
+        print(f"{datetime.now()}: compressed '{path.name}' "
+              f"({st.st_size} -> {out_path.stat().st_size} bytes)")
+        return out_path
+
+    def _delete(self, session, files, reason):
+        for p in files:
+            try:
+                p.unlink()
+                self.deleted_total += 1
+            except FileNotFoundError:
+                pass
+        print(f"{datetime.now()}: deleted stats session '{session}' ({reason})")
+
+    def run_once(self):
+        sessions = self._sessions()
+        finished = sorted(s for s in sessions if s != self.active_session)
+
+        # Left over by an interrupted run.
+        for suffix, _ in COMPRESSIONS.values():
+            for p in self.stat_dir.glob(f"*{suffix}.tmp"):
+                p.unlink()
+
+        now = time.time()
+        if self.MAX_AGE is not None:
+            for s in finished:
+                if now - max(p.stat().st_mtime for p in sessions[s]) > self.MAX_AGE:
+                    self._delete(s, sessions.pop(s), "age")
+            finished = [s for s in finished if s in sessions]
+
+        if self.COMPRESSION is not None:
+            for s in finished:
+                files = []
+                for p in sessions[s]:
+                    # Playback caches are rebuilt on demand; compressed
+                    # files stay as they are.
+                    if p.suffix in (".csv", ".frames"):
+                        p = self._compress(p)
+                        if self._stop.is_set():
+                            return
+                    files.append(p)
+                sessions[s] = files
+
+        sizes = {s: sum(p.stat().st_size for p in files) for s, files in sessions.items()}
+
+        if self.MAX_BYTES is not None:
+            total = sum(sizes[s] for s in sessions)
+            for s in finished:
+                if total <= self.MAX_BYTES:
+                    break
+                total -= sizes[s]
+                self._delete(s, sessions.pop(s), "size")
+
+        self.bytes = sum(sizes[s] for s in sessions)
+        self._write_manifest(sessions)
+
+    def _write_manifest(self, sessions):
+        manifest = {
+            'updated': datetime.now().isoformat(),
+            'active_session': self.active_session,
+            'bytes': self.bytes,
+            'sessions': {},
+        }
+
+        for s in sorted(sessions):
+            files = []
+            for p in sorted(sessions[s]):
+                st = p.stat()
+                base, _ = uncompressed(p)
+                files.append({
+                    'name': p.name,
+                    'unit': base.stem.split("_", 1)[1] if "_" in base.stem else None,
+                    'kind': base.suffix.lstrip("."),
+                    'compression': next(
+                        (c for c, (suffix, _) in COMPRESSIONS.items() if p.suffix == suffix), None),
+                    'bytes': st.st_size,
+                    'mtime': datetime.fromtimestamp(st.st_mtime).isoformat(),
+                })
+            manifest['sessions'][s] = files
+
+        path = self.stat_dir / self.MANIFEST
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(manifest, f, indent=4)
+        tmp_path.replace(path)
+
+
+def load_manifest(stat_dir):
+    return utils.load_json(Path(stat_dir) / StatsRetention.MANIFEST)
+
+
+if __name__ == "__main__":
+    # One run over a stats directory, e.g. from cron on a machine the
+    # controller does not run on.
+    try:
+        cfg_path = sys.argv[1]
+    except:
+        print("No path for configuration provided")
+        sys.exit(1)
+
+    stat_dir = sys.argv[2] if len(sys.argv) > 2 else Path.cwd() / "stats"
+
+    cfg = utils.load_json(cfg_path)
+    retention = StatsRetention(stat_dir, cfg.get('stats_retention', {}))
+
+    # The newest session may still be written to.
+    retention.active_session = max(retention._sessions(), default=None)
+
+    lower_priority()
+    retention.run_once()
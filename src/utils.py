@@ -10,6 +10,12 @@ def linear_map(v, low, high, begin, end):
     v = (v - low) / (high - low) * (end - begin) + begin
     return v
 
+def percentile(values, p):
+    # Nearest rank, from below; NaN for no values.
+    if not values:
+        return float("nan")
+    return sorted(values)[min(len(values) - 1, len(values) * p // 100)]
+
 def load_json(path):
     with Path(path).open("r") as f:
         content = json.load(f)